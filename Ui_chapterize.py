@@ -50,11 +50,15 @@ class Ui_ChapterizeWindow(object):
         self.actionChangeDir.setObjectName("actionChangeDir")
         self.actionSave = QtWidgets.QAction(ChapterizeWindow)
         self.actionSave.setObjectName("actionSave")
+        self.actionSaveAll = QtWidgets.QAction(ChapterizeWindow)
+        self.actionSaveAll.setEnabled(False)
+        self.actionSaveAll.setObjectName("actionSaveAll")
         self.actionExit = QtWidgets.QAction(ChapterizeWindow)
         self.actionExit.setObjectName("actionExit")
         self.menu_File.addAction(self.actionChangeDir)
         self.menu_File.addSeparator()
         self.menu_File.addAction(self.actionSave)
+        self.menu_File.addAction(self.actionSaveAll)
         self.menu_File.addSeparator()
         self.menu_File.addAction(self.actionExit)
         self.menubar.addAction(self.menu_File.menuAction())
@@ -69,4 +73,5 @@ class Ui_ChapterizeWindow(object):
         self.actionOpen.setText(_translate("ChapterizeWindow", "&Open"))
         self.actionChangeDir.setText(_translate("ChapterizeWindow", "Change &Directory..."))
         self.actionSave.setText(_translate("ChapterizeWindow", "&Save"))
+        self.actionSaveAll.setText(_translate("ChapterizeWindow", "Save &All Modified"))
         self.actionExit.setText(_translate("ChapterizeWindow", "&Exit"))
@@ -0,0 +1,179 @@
+import re
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from cache import MetadataCache
+from chapter import ChapterList
+from library import is_mp3
+from mp3file import Mp3File
+from timestamp import Timestamp
+
+
+def _natural_key(path: Path):
+    """
+    Sort key that orders Part2 before Part10
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path.name)]
+
+
+class Part(object):
+    def __init__(self, mp3: Mp3File, offset: int):
+        """
+        One file of a multi-part audiobook
+        :param mp3: the loaded file
+        :param offset: start of the part within the whole book in milliseconds
+        """
+        self.mp3 = mp3
+        self.offset = offset
+
+    @property
+    def path(self) -> Path:
+        return self.mp3.path
+
+    @property
+    def duration(self) -> int:
+        return self.mp3.duration
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.duration
+
+
+class Audiobook(object):
+    def __init__(self, directory, cache: Optional[MetadataCache] = None, jobs: int = 4):
+        """
+        An audiobook made of the mp3 files in a directory, e.g. Part01.mp3 to PartNN.mp3, played in
+        natural sort order. Chapters are indexed over the whole book, from the OverDrive media markers
+        of all parts offset by the cumulative duration of the parts before them.
+        :param directory: directory holding the parts
+        :param cache: metadata cache used when loading parts, so reopening a book does not open its files
+        :param jobs: number of parts loaded or saved concurrently
+        """
+        self._directory = Path(directory)
+        self._cache = cache
+        self._jobs = jobs
+        self._parts = []  # type: List[Part]
+        self._chapters = ChapterList()
+
+        paths = sorted((path for path in self._directory.iterdir() if is_mp3(path.name) and path.is_file()),
+                       key=_natural_key)
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            mp3_files = list(executor.map(self._load_part, paths))
+
+        offset = 0
+        for mp3 in mp3_files:
+            self._parts.append(Part(mp3, offset))
+            offset += mp3.duration
+
+        self._chapters = self._index_chapters()
+
+    def _load_part(self, path: Path) -> Mp3File:
+        mp3 = Mp3File(path, cache=self._cache)
+        mp3.duration  # Computed here so that it happens in the pool
+        return mp3
+
+    def _index_chapters(self) -> ChapterList:
+        items = []
+        for part in self._parts:
+            for position, marker in enumerate(part.mp3.media_markers):
+                name = marker.name
+                # A chapter that runs over a part boundary is repeated at the start of the next part. Chapters
+                # of the same name within a part are separate chapters.
+                if position == 0 and len(items) > 0 and items[-1][0] == name:
+                    continue
+                start = part.offset + marker.time.total_milliseconds
+                items.append([name, start, None])
+                if len(items) > 1:
+                    items[-2][2] = start
+        if len(items) > 0:
+            items[-1][2] = self.duration
+        return ChapterList.from_milliseconds(tuple(item) for item in items)
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    @property
+    def parts(self) -> List[Part]:
+        return self._parts
+
+    @property
+    def duration(self) -> int:
+        """
+        Duration of the whole book in milliseconds
+        """
+        if len(self._parts) == 0:
+            return 0
+        return self._parts[-1].end
+
+    @property
+    def chapters(self) -> ChapterList:
+        """
+        Chapters of the whole book, with times from the start of the first part
+        """
+        return self._chapters
+
+    def locate(self, time: Timestamp) -> Tuple[int, Timestamp]:
+        """
+        Finds where a point in the whole book is
+        :param time: time from the start of the book
+        :return: index of the part and time from the start of that part
+        """
+        ms = time.total_milliseconds
+        if ms < 0 or ms >= self.duration:
+            raise ValueError("{} is outside the book".format(time))
+        index = bisect_right([part.offset for part in self._parts], ms) - 1
+        return index, Timestamp.from_milliseconds(ms - self._parts[index].offset)
+
+    def find_chapter(self, title: str) -> Optional[int]:
+        """
+        :return: index of the first chapter with the given title, None if there is none
+        """
+        for index, chapter_title in enumerate(self._chapters.titles):
+            if chapter_title == title:
+                return index
+        return None
+
+    def locate_chapter(self, index: int) -> Tuple[int, Timestamp]:
+        """
+        Finds where a chapter starts
+        :param index: index of the chapter in the whole book
+        :return: index of the part and time from the start of that part
+        """
+        return self.locate(self._chapters[index].start)
+
+    def part_chapters(self, index: int) -> ChapterList:
+        """
+        Chapters of one part, with times from the start of that part. Chapters that run over the
+        boundaries of the part are cut at the boundaries, so that every part has a complete set.
+        :param index: index of the part
+        :return: chapters of the part
+        """
+        part = self._parts[index]
+        items = []
+        for title, start, end in self._chapters.iter_milliseconds():
+            local_start = max(start, part.offset) - part.offset
+            local_end = min(end, part.end) - part.offset
+            if local_end > local_start:
+                items.append((title, local_start, local_end))
+        return ChapterList.from_milliseconds(items)
+
+    def save(self, indices: Optional[Iterable[int]] = None, seek_offsets: bool = False) -> Dict[Path, int]:
+        """
+        Writes the chapters of parts, concurrently
+        :param indices: indices of the parts to write, all parts if None
+        :param seek_offsets: if True, chapters are written with the byte offsets of their first and last frames
+        :return: number of bytes written, by path of the part
+        """
+        def save_part(index):
+            part = self._parts[index]
+            part.mp3.chapters = self.part_chapters(index)
+            return part.path, part.mp3.save(seek_offsets)
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            return dict(executor.map(save_part, range(len(self._parts)) if indices is None else indices))
+
+    def __str__(self):
+        return "{}:\n{}".format(self._directory.name, self._chapters)
@@ -0,0 +1,251 @@
+"""
+Builds synthetic mp3 files shaped like OverDrive downloads, without an encoder. The audio is made of
+silent MPEG1 Layer III frames, so files of any size and duration can be generated quickly. Frames can be
+given a global gain in their side information, so that they look loud to code that reads it.
+"""
+import os
+import random
+import struct
+from typing import Callable, List, Optional, Tuple, Union
+
+SAMPLE_RATE = 44100
+SAMPLES_PER_FRAME = 1152
+
+# Bitrate indices of MPEG1 Layer III, by kbps
+_BITRATE_INDEX = {32: 1, 40: 2, 48: 3, 56: 4, 64: 5, 80: 6, 96: 7, 112: 8, 128: 9, 160: 10, 192: 11,
+                  224: 12, 256: 13, 320: 14}
+
+# Bitrates that VBR files vary between
+_VBR_BITRATES = (48, 56, 64, 80, 96, 112, 128)
+
+_SIDE_INFO_SIZE = {True: 17, False: 32}
+
+_WRITE_BATCH_FRAMES = 4096
+
+
+def _syncsafe(n: int) -> bytes:
+    return bytes([(n >> 21) & 0x7F, (n >> 14) & 0x7F, (n >> 7) & 0x7F, n & 0x7F])
+
+
+def _frame(frame_id: bytes, body: bytes) -> bytes:
+    return frame_id + struct.pack('>IH', len(body), 0) + body
+
+
+def _text(frame_id: bytes, text: str) -> bytes:
+    return _frame(frame_id, b'\x01' + text.encode('utf-16') + b'\0\0')
+
+
+def _txxx(description: str, value: str) -> bytes:
+    return _frame(b'TXXX', b'\x01' + description.encode('utf-16') + b'\0\0' + value.encode('utf-16') + b'\0\0')
+
+
+def _apic(size: int, rng: random.Random) -> bytes:
+    # A JPEG signature followed by noise, which is all a tag reader sees of a cover
+    image = b'\xff\xd8\xff\xe0' + bytes(rng.getrandbits(8) for _ in range(max(size - 4, 0)))
+    return _frame(b'APIC', b'\x00image/jpeg\x00\x03\x00' + image)
+
+
+def _chap(element_id: bytes, title: str, start: int, end: int) -> bytes:
+    body = element_id + b'\0' + struct.pack('>IIII', start, end, 0xFFFFFFFF, 0xFFFFFFFF) + _text(b'TIT2', title)
+    return _frame(b'CHAP', body)
+
+
+def _ctoc(element_id: bytes, child_ids: List[bytes]) -> bytes:
+    body = element_id + b'\0' + bytes([0x03, len(child_ids)]) + b''.join(eid + b'\0' for eid in child_ids)
+    return _frame(b'CTOC', body)
+
+
+def _format_time(ms: int) -> str:
+    # OverDrive writes minutes without hours, e.g. 75:02.500
+    mins, ms = divmod(ms, 60000)
+    return '{}:{:02d}.{:03d}'.format(mins, ms // 1000, ms % 1000)
+
+
+def make_markers(count: int, duration: int, rng: random.Random) -> List[Tuple[str, int]]:
+    """
+    Chapter markers spread over the duration, with uneven chapter lengths and some names needing escaping
+    :param count: number of markers
+    :param duration: duration in milliseconds
+    :param rng: random source
+    :return: (name, milliseconds) pairs in order
+    """
+    if count == 0:
+        return []
+    starts = sorted(rng.randrange(1, duration) for _ in range(count - 1))
+    markers = []
+    for index, start in enumerate([0] + starts):
+        name = 'Chapter {}'.format(index + 1)
+        if index % 7 == 3:
+            name += ' & Interlude'
+        elif index % 5 == 4:
+            name = 'Chapter {} (continued)'.format(index)
+        markers.append((name, start))
+    return markers
+
+
+def markers_xml(markers: List[Tuple[str, int]]) -> str:
+    """
+    :return: markers in the layout of the 'OverDrive MediaMarkers' user frame
+    """
+    items = ''.join('<Marker><Name>{}</Name><Time>{}</Time></Marker>'.format(
+        name.replace('&', '&amp;').replace('<', '&lt;'), _format_time(start)) for name, start in markers)
+    return '<?xml version="1.0" encoding="utf-8"?><Markers>{}</Markers>'.format(items)
+
+
+def _frame_header(bitrate: int, padding: int, mono: bool) -> bytes:
+    return bytes([0xFF, 0xFB, (_BITRATE_INDEX[bitrate] << 4) | padding << 1, 0xC0 if mono else 0x40])
+
+
+def _frame_length(bitrate: int, padding: int) -> int:
+    return 144 * bitrate * 1000 // SAMPLE_RATE + padding
+
+
+def _side_info(gain: int, mono: bool) -> bytes:
+    """
+    Side information of a frame whose granules all have the given global gain, and one bit of main data
+    so that they do not count as digitally silent
+    """
+    bits = _SIDE_INFO_SIZE[mono] * 8
+    pos = 18 if mono else 20  # main_data_begin, private bits and scfsi
+    side = 0
+    for _ in range(2 if mono else 4):
+        # part2_3_length, big_values and global_gain lead every granule of 59 bits
+        side |= ((1 << 17) | gain) << (bits - pos - 29)
+        pos += 59
+    return side.to_bytes(bits // 8, 'big')
+
+
+def _audio_frames(count: int, bitrates: List[int], mono: bool, gain: Optional[Callable[[int], int]] = None):
+    """
+    Generates silent frames. Padding slots are spread the way encoders do, to keep the exact bitrate.
+    """
+    remainder = 0
+    for index in range(count):
+        bitrate = bitrates[index % len(bitrates)]
+        remainder += 144 * bitrate * 1000 % SAMPLE_RATE
+        padding = 0
+        if remainder >= SAMPLE_RATE:
+            remainder -= SAMPLE_RATE
+            padding = 1
+        frame_gain = gain(index) if gain is not None else 0
+        side = _side_info(frame_gain, mono) if frame_gain > 0 else b''
+        yield _frame_header(bitrate, padding, mono) + side + bytes(_frame_length(bitrate, padding) - 4 - len(side))
+
+
+def _vbr_header(tag: bytes, frames: int, size: int, bitrate: int, mono: bool) -> bytes:
+    """
+    A Xing or Info header frame. As in LAME, the byte count includes the header frame and the frame count does not.
+    """
+    frame = bytearray(_frame_length(bitrate, 0))
+    frame[:4] = _frame_header(bitrate, 0, mono)
+    pos = 4 + _SIDE_INFO_SIZE[mono]
+    toc = bytes(min(255, i * 256 // 100) for i in range(100))
+    frame[pos:pos + 120] = tag + struct.pack('>III', 0x0F, frames, size) + toc + struct.pack('>I', 50)
+    return bytes(frame)
+
+
+def build_tag(markers: List[Tuple[str, int]], duration: int, chapters: bool = False, cover_size: int = 0,
+              padding: int = 2048, seed: int = 0) -> bytes:
+    """
+    An ID3v2.3 tag like the ones in OverDrive downloads
+    :param markers: (name, milliseconds) pairs for the MediaMarkers frame
+    :param duration: duration in milliseconds, used as the end of the last chapter
+    :param chapters: if True, CHAP and CTOC frames matching the markers are included
+    :param cover_size: size of an APIC frame in bytes, 0 for none
+    :param padding: bytes of padding after the frames
+    :param seed: seed of the random source used for the cover
+    :return: the whole tag
+    """
+    frames = [_text(b'TIT2', 'Synthetic Audiobook'), _text(b'TPE1', 'Benchmark Author'),
+              _text(b'TALB', 'Synthetic Audiobook'), _txxx('OverDrive MediaMarkers', markers_xml(markers))]
+    if cover_size > 0:
+        frames.append(_apic(cover_size, random.Random(seed)))
+    if chapters and len(markers) > 0:
+        ends = [start for _, start in markers[1:]] + [duration]
+        child_ids = ['ch{}'.format(index).encode('ascii') for index in range(1, len(markers) + 1)]
+        frames.append(_ctoc(b'toc', child_ids))
+        for element_id, (name, start), end in zip(child_ids, markers, ends):
+            frames.append(_chap(element_id, name, start, end))
+    body = b''.join(frames) + bytes(padding)
+    return b'ID3\x03\x00\x00' + _syncsafe(len(body)) + body
+
+
+def build_mp3(path, duration: float = 600.0, bitrate: int = 64, vbr: bool = False,
+              markers: Union[int, List[Tuple[str, int]]] = 20, chapters: bool = False, cover_size: int = 0,
+              padding: int = 2048, mono: bool = True, seed: int = 0,
+              gain: Optional[Callable[[int], int]] = None) -> dict:
+    """
+    Writes a synthetic mp3 file
+    :param path: file to write
+    :param duration: duration in seconds
+    :param bitrate: bitrate in kbps for CBR files; VBR files vary around it
+    :param vbr: if True, frames vary in bitrate and the file starts with a Xing header, else with an Info header
+    :param markers: number of OverDrive media markers, or the (name, milliseconds) pairs of the markers
+    :param chapters: if True, the tag already has CHAP and CTOC frames matching the markers
+    :param cover_size: size of the cover art in bytes, 0 for none
+    :param padding: bytes of padding in the tag
+    :param mono: if True, frames are single channel, else joint stereo
+    :param seed: seed of the random source, so that the same parameters always give the same file
+    :param gain: global gain of every audio frame by its position, 0 for digital silence, all silent if None
+    :return: description of the file, with its size, number of frames, duration in milliseconds and markers
+    """
+    rng = random.Random(seed)
+    frame_count = int(duration * SAMPLE_RATE / SAMPLES_PER_FRAME)
+    duration_ms = frame_count * SAMPLES_PER_FRAME * 1000 // SAMPLE_RATE
+
+    if vbr:
+        bitrates = [rate for rate in _VBR_BITRATES if rate <= bitrate * 2] or [bitrate]
+        bitrates = [rng.choice(bitrates) for _ in range(997)]
+    else:
+        bitrates = [bitrate]
+
+    marker_list = make_markers(markers, duration_ms, rng) if isinstance(markers, int) else list(markers)
+    tag = build_tag(marker_list, duration_ms, chapters, cover_size, padding, seed)
+
+    with open(path, 'wb') as f:
+        f.write(tag)
+        header_pos = f.tell()
+        header_frame_size = _frame_length(bitrates[0], 0)
+        f.write(bytes(header_frame_size))  # Rewritten once the frame and byte counts are known
+
+        written = 0
+        batch = []
+        for frame in _audio_frames(frame_count, bitrates, mono, gain):
+            batch.append(frame)
+            if len(batch) == _WRITE_BATCH_FRAMES:
+                chunk = b''.join(batch)
+                f.write(chunk)
+                written += len(chunk)
+                batch = []
+        chunk = b''.join(batch)
+        f.write(chunk)
+        written += len(chunk)
+
+        f.seek(header_pos)
+        f.write(_vbr_header(b'Xing' if vbr else b'Info', frame_count, written + header_frame_size,
+                            bitrates[0], mono))
+
+    return {'path': str(path), 'size': os.path.getsize(path), 'frames': frame_count, 'duration': duration_ms,
+            'tag_size': len(tag), 'markers': marker_list, 'audio_size': written + header_frame_size}
+
+
+def build_library(directory, files: int, nested: int = 10, size: int = 4096) -> List[str]:
+    """
+    Writes a tree of small placeholder mp3 files, for timing directory scans
+    :param directory: root of the tree
+    :param files: number of files
+    :param nested: number of files per directory
+    :param size: size of each file in bytes
+    :return: paths of the files
+    """
+    paths = []
+    content = bytes(size)
+    for index in range(files):
+        subdirectory = os.path.join(directory, 'author{:03d}'.format(index // (nested * nested)),
+                                    'book{:03d}'.format(index // nested))
+        os.makedirs(subdirectory, exist_ok=True)
+        path = os.path.join(subdirectory, 'Part{:02d}.mp3'.format(index % nested + 1))
+        with open(path, 'wb') as f:
+            f.write(content)
+        paths.append(path)
+    return paths
@@ -0,0 +1,172 @@
+"""
+Times the stages of chapterizing synthetic files and writes the results as JSON, so that runs on
+different revisions can be compared.
+
+    python3 benchmarks/run.py --out results.json
+"""
+from argparse import ArgumentParser
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures  # noqa: E402
+from duration import build_seek_index, read_duration  # noqa: E402
+from library import LibraryScanner  # noqa: E402
+from mp3file import Mp3File  # noqa: E402
+from overdrive import iter_markers  # noqa: E402
+from startup import bench_startup  # noqa: E402
+
+
+def _time(func, repeat: int, setup=None) -> dict:
+    """
+    Calls func repeatedly
+    :param func: function to time, called with the result of setup
+    :param repeat: number of calls
+    :param setup: untimed function called before every call, if any
+    :return: timings in seconds
+    """
+    seconds = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg) if setup is not None else func()
+        seconds.append(time.perf_counter() - start)
+    return {'seconds': seconds, 'min': min(seconds), 'median': statistics.median(seconds), 'max': max(seconds)}
+
+
+def _retained(func) -> int:
+    """
+    :return: bytes allocated by func that are still held by what it returns
+    """
+    result = None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        del result
+        tracemalloc.stop()
+
+
+def _bench_file(workdir: str, params: dict, repeat: int) -> list:
+    """
+    Times loading, marker parsing, duration, seek index and saving of one synthetic file
+    :param workdir: directory for the fixture and its copies
+    :param params: arguments of fixtures.build_mp3
+    :param repeat: number of runs of every stage
+    :return: result records, one per stage
+    """
+    path = os.path.join(workdir, 'fixture.mp3')
+    info = fixtures.build_mp3(path, **params)
+    xml = fixtures.markers_xml(info['markers'])
+    copy = os.path.join(workdir, 'copy.mp3')
+
+    def fresh_copy():
+        shutil.copyfile(path, copy)
+        return copy
+
+    def save(filepath):
+        mp3 = Mp3File(filepath)
+        mp3.chapters = mp3.media_markers_as_chapters
+        mp3.save()
+
+    stages = [
+        ('load', _time(lambda: Mp3File(path), repeat)),
+        ('markers', _time(lambda: list(iter_markers(xml)), repeat)),
+        ('duration', _time(lambda: read_duration(path), repeat)),
+        ('seek_index', _time(lambda: build_seek_index(path), repeat)),
+        ('save', _time(save, repeat, setup=fresh_copy)),
+    ]
+    os.remove(copy)
+
+    file_info = {'size': info['size'], 'tag_size': info['tag_size'], 'frames': info['frames']}
+    results = [dict(case='file', stage=stage, params=params, file=file_info, **timings) for stage, timings in stages]
+    # Memory an open file holds, which should stay in kilobytes whatever the size of the cover art
+    results.append(dict(case='file', stage='memory', params=params, file=file_info,
+                        retained_kb=_retained(lambda: Mp3File(path)) / 1024,
+                        reported_kb=Mp3File(path).memory_usage / 1024))
+    return results
+
+
+def _bench_scan(workdir: str, files: int, repeat: int) -> list:
+    """
+    Times a full scan of a library tree
+    :param workdir: directory to build the tree in
+    :param files: number of files in the tree
+    :param repeat: number of scans
+    :return: result records
+    """
+    root = os.path.join(workdir, 'library')
+    fixtures.build_library(root, files)
+    timings = _time(lambda: sum(1 for _ in LibraryScanner().scan([root])), repeat)
+    shutil.rmtree(root)
+    return [dict(case='scan', stage='scan', params={'files': files}, **timings)]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.description = "Benchmarks chapterizing synthetic mp3 files"
+    parser.add_argument('--out', metavar='FILE', help='Write results to FILE as JSON instead of standard output')
+    parser.add_argument('--durations', metavar='SECONDS', type=float, nargs='+', default=[600.0, 3600.0],
+                        help='Durations of the generated files. Default: %(default)s')
+    parser.add_argument('--bitrates', metavar='KBPS', type=int, nargs='+', default=[64],
+                        help='Bitrates of the generated files. Default: %(default)s')
+    parser.add_argument('--markers', metavar='COUNT', type=int, nargs='+', default=[20, 500],
+                        help='Numbers of markers in the generated files. Default: %(default)s')
+    parser.add_argument('--cover', metavar='BYTES', type=int, default=200 * 1024,
+                        help='Size of the cover art in the generated files. Default: %(default)s')
+    parser.add_argument('--scan-files', metavar='COUNT', type=int, default=5000,
+                        help='Number of files in the library scanned. Default: %(default)s')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of every stage. Default: %(default)s')
+    parser.add_argument('--dir', metavar='DIR', help='Directory for the generated files. Default: a temporary one')
+    args = parser.parse_args()
+
+    workdir = args.dir if args.dir is not None else tempfile.mkdtemp(prefix='chapterize-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    try:
+        for duration, bitrate, vbr, markers, chapters in itertools.product(
+                args.durations, args.bitrates, (False, True), args.markers, (False, True)):
+            params = {'duration': duration, 'bitrate': bitrate, 'vbr': vbr, 'markers': markers,
+                      'chapters': chapters, 'cover_size': args.cover}
+            print("Benchmarking {}".format(params), file=sys.stderr)
+            results.extend(_bench_file(workdir, params, args.repeat))
+
+        print("Benchmarking scan of {} files".format(args.scan_files), file=sys.stderr)
+        results.extend(_bench_scan(workdir, args.scan_files, args.repeat))
+
+        print("Benchmarking startup", file=sys.stderr)
+        results.extend(bench_startup(args.repeat))
+    finally:
+        if args.dir is None:
+            shutil.rmtree(workdir)
+
+    report = {
+        'environment': {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                        'platform': platform.platform(), 'machine': platform.machine(),
+                        'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')},
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
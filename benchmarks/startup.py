@@ -0,0 +1,128 @@
+"""
+Measures the startup cost of chapterize_cmd.py with python -X importtime, for --help and for a run over
+files that are all unchanged since they were chapterized, and checks it against a budget.
+
+    python3 benchmarks/startup.py --budget 100
+"""
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fixtures
+
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_CLI = os.path.join(_REPO, 'chapterize_cmd.py')
+
+# Modules that should only be imported on the code paths that need them
+_LAZY_MODULES = ('eyed3', 'tabulate', 'recordclass', 'PyQt5', 'concurrent.futures.process',
+                 'xml.etree.ElementTree', 'cProfile', 'ctypes', 'export', 'snap')
+
+
+def _parse_importtime(stderr: str):
+    """
+    :return: total import time in seconds and the imported modules with their cumulative times in seconds
+    """
+    total = 0
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        modules[name.strip()] = int(cumulative_us) / 1e6
+    return total / 1e6, modules
+
+
+def _measure(args, repeat: int, cwd: str) -> dict:
+    """
+    Runs the CLI repeatedly
+    :param args: command line arguments of the CLI
+    :param repeat: number of runs
+    :param cwd: working directory of the runs
+    :return: import and wall times in seconds, the slowest imports and any modules that should have been lazy
+    """
+    import_times = []
+    wall_times = []
+    modules = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', _CLI] + args, cwd=cwd,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        wall_times.append(time.perf_counter() - start)
+        import_time, modules = _parse_importtime(process.stderr)
+        import_times.append(import_time)
+
+    slowest = sorted(((name, seconds) for name, seconds in modules.items() if '.' not in name),
+                     key=lambda item: -item[1])[:10]
+    return {'import_seconds': import_times, 'import_median': statistics.median(import_times),
+            'wall_seconds': wall_times, 'wall_median': statistics.median(wall_times),
+            'slowest_imports': [{'module': name, 'cumulative': seconds} for name, seconds in slowest],
+            'eager_modules': [name for name in modules if name.split('.')[0] in _LAZY_MODULES or name in _LAZY_MODULES]}
+
+
+def bench_startup(repeat: int, files: int = 3) -> list:
+    """
+    Measures startup for --help and for a run over files that were already chapterized
+    :param repeat: number of runs of each command
+    :param files: number of files in the already chapterized directory
+    :return: result records, one per command
+    """
+    workdir = tempfile.mkdtemp(prefix='chapterize-startup-')
+    try:
+        library = os.path.join(workdir, 'library')
+        os.makedirs(library)
+        for index in range(files):
+            fixtures.build_mp3(os.path.join(library, 'Part{:02d}.mp3'.format(index + 1)), duration=60.0,
+                               markers=10, chapters=True, seed=index)
+        cache = os.path.join(workdir, 'cache.sqlite3')
+        unchanged = [library, '--cache', cache]
+        # The first run records the files as chapterized, so that the measured runs skip all of them
+        subprocess.run([sys.executable, _CLI] + unchanged, cwd=workdir, stdout=subprocess.DEVNULL)
+
+        commands = [('help', ['--help']), ('unchanged', unchanged)]
+        return [dict(case='startup', stage=name, params={'args': args}, **_measure(args, repeat, workdir))
+                for name, args in commands]
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.description = "Measures the startup time of chapterize_cmd.py"
+    parser.add_argument('--repeat', type=int, default=10, help='Runs of every command. Default: %(default)s')
+    parser.add_argument('--budget', metavar='MS', type=float,
+                        help='Exit with status 1 if the median import time of any command exceeds MS milliseconds, '
+                             'or if any command imports a module that should be imported lazily')
+    parser.add_argument('--out', metavar='FILE', help='Write results to FILE as JSON instead of standard output')
+    args = parser.parse_args()
+
+    results = bench_startup(args.repeat)
+    report = {'python': sys.version.split()[0], 'budget_ms': args.budget, 'results': results}
+
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.budget is not None:
+        over = [result for result in results
+                if result['import_median'] * 1000 > args.budget or len(result['eager_modules']) > 0]
+        for result in over:
+            print("Over budget: {} imports in {:.1f} ms{}".format(
+                result['stage'], result['import_median'] * 1000,
+                ', eagerly imports ' + ', '.join(result['eager_modules']) if result['eager_modules'] else ''),
+                file=sys.stderr)
+        if len(over) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# Bytes hashed from each end of a file when content hashing is enabled
+_HASH_BLOCK_SIZE = 64 * 1024
+
+_METADATA_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT,
+    markers TEXT NOT NULL,
+    chapters TEXT NOT NULL,
+    has_chapters INTEGER NOT NULL,
+    duration INTEGER
+)
+'''
+
+
+def default_cache_path() -> Path:
+    """
+    Location of the cache database, under $XDG_CACHE_HOME or ~/.cache
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(cache_home) / 'overdrive-chapterizer' / 'metadata.sqlite3'
+
+
+def _content_hash(filepath, size: int) -> str:
+    """
+    Hashes the first and last blocks of a file. The start covers the ID3v2 tag in most audiobooks,
+    so this catches tag edits that preserve both size and modification time.
+    """
+    import hashlib
+
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        h.update(f.read(_HASH_BLOCK_SIZE))
+        if size > 2 * _HASH_BLOCK_SIZE:
+            f.seek(size - _HASH_BLOCK_SIZE)
+        h.update(f.read(_HASH_BLOCK_SIZE))
+    return h.hexdigest()
+
+
+class CachedMetadata(object):
+    def __init__(self, markers: List[Tuple[str, int]], chapters: List[Tuple[str, int, int]],
+                 has_chapters: bool, duration: Optional[int]):
+        """
+        Parsed metadata of an mp3 file
+        :param markers: Overdrive media markers as (name, milliseconds) pairs
+        :param chapters: ID3v2 chapters from the top-level table of contents as (title, start, end) in milliseconds
+        :param has_chapters: True if the file has any CTOC or CHAP frames
+        :param duration: duration in milliseconds, None if it was not computed
+        """
+        self.markers = markers
+        self.chapters = chapters
+        self.has_chapters = has_chapters
+        self.duration = duration
+
+
+_CHAPTERIZED_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chapterized (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+)
+'''
+
+
+_SEEK_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS seek_index (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    data BLOB NOT NULL
+)
+'''
+
+
+class _SqliteStore(object):
+    _schema = None
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path: path of the SQLite database, defaults to default_cache_path()
+        """
+        self._db_path = Path(db_path) if db_path is not None else default_cache_path()
+        self._local = threading.local()
+
+    @property
+    def path(self) -> Path:
+        return self._db_path
+
+    @property
+    def _db(self) -> 'sqlite3.Connection':
+        # SQLite connections cannot be shared across threads, so every thread gets its own
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            import sqlite3  # Connected on first use, so that runs that never need the database do not load it
+
+            self._db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self._db_path), timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(self._schema)
+            self._local.db = db
+        return db
+
+    def close(self) -> None:
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+class MetadataCache(_SqliteStore):
+    _schema = _METADATA_SCHEMA
+
+    def __init__(self, db_path=None, hash_contents: bool = False):
+        """
+        Persistent cache of parsed mp3 metadata, keyed by path, size and modification time
+        :param db_path: path of the SQLite database, defaults to default_cache_path()
+        :param hash_contents: if True, entries are also validated against a hash of the start and end of the file
+        """
+        super().__init__(db_path)
+        self._hash_contents = hash_contents
+
+    def _key(self, filepath):
+        path = os.path.abspath(filepath)
+        st = os.stat(path)
+        content_hash = _content_hash(path, st.st_size) if self._hash_contents else None
+        return path, st.st_size, st.st_mtime_ns, content_hash
+
+    def get(self, filepath) -> Optional[CachedMetadata]:
+        """
+        Looks up the metadata of a file
+        :param filepath: path to mp3 file
+        :return: cached metadata if present and the file is unchanged, else None
+        """
+        path, size, mtime_ns, content_hash = self._key(filepath)
+        row = self._db.execute('SELECT size, mtime_ns, content_hash, markers, chapters, has_chapters, duration '
+                               'FROM metadata WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        if row[0] != size or row[1] != mtime_ns or (content_hash is not None and row[2] != content_hash):
+            return None
+        markers = [tuple(m) for m in json.loads(row[3])]
+        chapters = [tuple(c) for c in json.loads(row[4])]
+        return CachedMetadata(markers, chapters, bool(row[5]), row[6])
+
+    def put(self, filepath, metadata: CachedMetadata) -> None:
+        """
+        Stores the metadata of a file, replacing any previous entry
+        :param filepath: path to mp3 file
+        :param metadata: parsed metadata of the file in its current state
+        """
+        path, size, mtime_ns, content_hash = self._key(filepath)
+        with self._db as db:
+            db.execute('INSERT OR REPLACE INTO metadata '
+                       '(path, size, mtime_ns, content_hash, markers, chapters, has_chapters, duration) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (path, size, mtime_ns, content_hash, json.dumps(metadata.markers),
+                        json.dumps(metadata.chapters), int(metadata.has_chapters), metadata.duration))
+
+    def invalidate(self, filepath) -> None:
+        """
+        Removes the entry of a file, e.g. after its tags were saved
+        :param filepath: path to mp3 file
+        """
+        with self._db as db:
+            db.execute('DELETE FROM metadata WHERE path = ?', (os.path.abspath(filepath),))
+
+
+class ChapterizedState(_SqliteStore):
+    """
+    Size and modification time of files as they were when last chapterized successfully,
+    so that unchanged files can be skipped without opening them
+    """
+    _schema = _CHAPTERIZED_SCHEMA
+
+    def unchanged(self, filepath, st: Optional[os.stat_result] = None) -> bool:
+        """
+        :param filepath: path to mp3 file
+        :param st: result of stat on the file, if already known
+        :return: True if the file was chapterized and has not changed since
+        """
+        if st is None:
+            st = os.stat(filepath)
+        row = self._db.execute('SELECT size, mtime_ns FROM chapterized WHERE path = ?',
+                               (os.path.abspath(filepath),)).fetchone()
+        return row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns
+
+    def record(self, filepath) -> None:
+        """
+        Records a file as chapterized in its current state
+        """
+        st = os.stat(filepath)
+        with self._db as db:
+            db.execute('INSERT OR REPLACE INTO chapterized (path, size, mtime_ns) VALUES (?, ?, ?)',
+                       (os.path.abspath(filepath), st.st_size, st.st_mtime_ns))
+
+    def forget(self, filepath) -> None:
+        with self._db as db:
+            db.execute('DELETE FROM chapterized WHERE path = ?', (os.path.abspath(filepath),))
+
+
+class SeekIndexCache(_SqliteStore):
+    """
+    Seek indices of mp3 files, keyed by path, size and modification time, so that the frame headers
+    of a file are only walked over once
+    """
+    _schema = _SEEK_INDEX_SCHEMA
+
+    def get(self, filepath) -> Optional['SeekIndex']:
+        """
+        :param filepath: path to mp3 file
+        :return: the cached index if present and the file is unchanged, else None
+        """
+        from duration import SeekIndex
+
+        st = os.stat(filepath)
+        row = self._db.execute('SELECT size, mtime_ns, data FROM seek_index WHERE path = ?',
+                               (os.path.abspath(filepath),)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        return SeekIndex.from_bytes(row[2])
+
+    def put(self, filepath, index: 'SeekIndex') -> None:
+        """
+        Stores the index of a file in its current state. As the offsets are relative to the ID3v2 tag,
+        the index of a file can be stored again after only its tag was rewritten.
+        """
+        st = os.stat(filepath)
+        with self._db as db:
+            db.execute('INSERT OR REPLACE INTO seek_index (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)',
+                       (os.path.abspath(filepath), st.st_size, st.st_mtime_ns, index.to_bytes()))
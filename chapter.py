@@ -1,3 +1,9 @@
+import sys
+from array import array
+from bisect import bisect_right
+from collections.abc import MutableSequence
+from typing import Iterable, Iterator, List, Optional, Tuple
+
 from timestamp import Timestamp
 
 
@@ -9,3 +15,214 @@ class Chapter(object):
 
     def __str__(self):
         return '{}'.format(', '.join([self.title, str(self.start), str(self.end)]))
+
+    def __eq__(self, other):
+        # ChapterList returns a new Chapter on every access, so chapters compare by value, e.g. for index and remove
+        if isinstance(other, Chapter):
+            return (self.title, self.start, self.end) == (other.title, other.start, other.end)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, Chapter):
+            return (self.title, self.start, self.end) != (other.title, other.start, other.end)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.title, self.start, self.end))
+
+
+class ChapterList(MutableSequence):
+    """
+    A list of chapters with start and end times kept in parallel arrays of milliseconds.
+    Items are returned as new Chapter objects, so changes to them have to be stored back
+    through item assignment or set_title, set_start and set_end.
+    """
+
+    def __init__(self, chapters: Iterable[Chapter] = ()):
+        self._titles = []  # type: List[str]
+        self._starts = array('q')
+        self._ends = array('q')
+        self._sorted = True  # Whether starts are known to be in order, None if unknown
+        self.insert_range(0, chapters)
+
+    @classmethod
+    def from_milliseconds(cls, items: Iterable[Tuple[str, int, int]]):
+        """
+        Builds a ChapterList without creating Chapter or Timestamp objects
+        :param items: (title, start, end) tuples, with times in milliseconds
+        :return: a ChapterList
+        """
+        chapters = cls()
+        for title, start, end in items:
+            chapters._titles.append(title)
+            chapters._starts.append(start)
+            chapters._ends.append(end)
+        chapters._sorted = None
+        return chapters
+
+    def _chapter(self, index: int) -> Chapter:
+        return Chapter(self._titles[index],
+                       start=Timestamp.from_milliseconds(self._starts[index]),
+                       end=Timestamp.from_milliseconds(self._ends[index]))
+
+    def __len__(self):
+        return len(self._titles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ChapterList.from_milliseconds(zip(self._titles[index], self._starts[index], self._ends[index]))
+        return self._chapter(index)
+
+    def __setitem__(self, index, chapter: Chapter):
+        if isinstance(index, slice):
+            raise TypeError("ChapterList does not support slice assignment")
+        self._titles[index] = chapter.title
+        self._starts[index] = chapter.start.total_milliseconds
+        self._ends[index] = chapter.end.total_milliseconds
+        self._sorted = None
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise TypeError("ChapterList only supports deleting contiguous ranges")
+            self.delete_range(start, stop)
+        else:
+            del self._titles[index]
+            del self._starts[index]
+            del self._ends[index]
+
+    def __iter__(self) -> Iterator[Chapter]:
+        for index in range(len(self)):
+            yield self._chapter(index)
+
+    def __str__(self):
+        return '\n'.join(str(ch) for ch in self)
+
+    def insert(self, index: int, chapter: Chapter) -> None:
+        self.insert_range(index, [chapter])
+
+    def insert_range(self, index: int, chapters: Iterable[Chapter]) -> None:
+        """
+        Inserts several chapters before index in one operation
+        :param index: position to insert at
+        :param chapters: chapters to insert, in order
+        """
+        titles = []
+        starts = array('q')
+        ends = array('q')
+        for chapter in chapters:
+            titles.append(chapter.title)
+            starts.append(chapter.start.total_milliseconds)
+            ends.append(chapter.end.total_milliseconds)
+        if len(titles) == 0:
+            return
+        index = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        self._titles[index:index] = titles
+        self._starts[index:index] = starts
+        self._ends[index:index] = ends
+        self._sorted = None
+
+    def delete_range(self, start: int, stop: int) -> None:
+        """
+        Deletes chapters start to stop - 1 in one operation
+        """
+        del self._titles[start:stop]
+        del self._starts[start:stop]
+        del self._ends[start:stop]
+
+    def set_title(self, index: int, title: str) -> None:
+        self._titles[index] = title
+
+    def set_start(self, index: int, start: Timestamp) -> None:
+        self._starts[index] = start.total_milliseconds
+        self._sorted = None
+
+    def set_end(self, index: int, end: Timestamp) -> None:
+        self._ends[index] = end.total_milliseconds
+
+    def shift(self, index: int, delta: int) -> None:
+        """
+        Moves chapters index onwards by a number of milliseconds
+        :param index: first chapter to move
+        :param delta: milliseconds to move by, negative to move towards the start
+        """
+        starts = array('q', [start + delta for start in self._starts[index:]])
+        ends = array('q', [end + delta for end in self._ends[index:]])
+        if len(starts) > 0 and min(starts) < 0:
+            raise ValueError("Chapters cannot start before 0")
+        self._starts[index:] = starts
+        self._ends[index:] = ends
+        self._sorted = None
+
+    def chapter_at(self, time: Timestamp) -> Optional[int]:
+        """
+        Finds the chapter containing a point in time
+        :param time: point in time
+        :return: index of the chapter, or None if no chapter contains it
+        """
+        ms = time.total_milliseconds
+        if self._sorted is None:
+            self._sorted = all(a <= b for a, b in zip(self._starts, self._starts[1:]))
+
+        if self._sorted:
+            index = bisect_right(self._starts, ms) - 1
+            if index >= 0 and ms < self._ends[index]:
+                return index
+            return None
+
+        for index, (start, end) in enumerate(zip(self._starts, self._ends)):
+            if start <= ms < end:
+                return index
+        return None
+
+    def iter_milliseconds(self) -> Iterator[Tuple[str, int, int]]:
+        """
+        Iterates over chapters as (title, start, end) tuples, with times in milliseconds
+        """
+        return zip(self._titles, self._starts, self._ends)
+
+    @property
+    def memory_usage(self) -> int:
+        """
+        Approximate memory held by the list in bytes
+        """
+        return sys.getsizeof(self._titles) + sum(sys.getsizeof(title) for title in self._titles) + \
+            sys.getsizeof(self._starts) + sys.getsizeof(self._ends)
+
+    @property
+    def titles(self) -> List[str]:
+        return list(self._titles)
+
+    @property
+    def starts(self) -> array:
+        return array('q', self._starts)
+
+    @property
+    def ends(self) -> array:
+        return array('q', self._ends)
+
+
+def diff_chapters(existing: ChapterList, computed: ChapterList,
+                  tolerance: int = 0) -> List[Tuple[int, Optional[Chapter], Optional[Chapter]]]:
+    """
+    Compares two chapter lists position by position
+    :param existing: chapters currently in the file
+    :param computed: chapters that would be written
+    :param tolerance: largest difference in milliseconds between start or end times that still counts as equal
+    :return: (index, existing chapter, computed chapter) for every position that differs, with None for the
+             side that has no chapter at that position. An empty list means nothing has to be written.
+    """
+    existing_items = list(existing.iter_milliseconds())
+    computed_items = list(computed.iter_milliseconds())
+    diff = []
+    for index in range(max(len(existing_items), len(computed_items))):
+        old = existing_items[index] if index < len(existing_items) else None
+        new = computed_items[index] if index < len(computed_items) else None
+        if old is not None and new is not None and old[0] == new[0] and \
+                abs(old[1] - new[1]) <= tolerance and abs(old[2] - new[2]) <= tolerance:
+            continue
+        diff.append((index,
+                     existing[index] if old is not None else None,
+                     computed[index] if new is not None else None))
+    return diff
@@ -1,12 +1,16 @@
+from collections import OrderedDict
 from pathlib import Path
 import sys
 
 from PyQt5.QtGui import QContextMenuEvent, QRegularExpressionValidator
 from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QFileSystemModel, QMenu, QAction, \
     QStyledItemDelegate, QLineEdit
-from PyQt5.QtCore import pyqtSlot, QAbstractTableModel, Qt, QDir, QItemSelection, QModelIndex, QRegularExpression
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QAbstractTableModel, Qt, QDir, QItemSelection, QModelIndex, \
+    QRegularExpression, QObject, QRunnable, QThreadPool
 
 from Ui_chapterize import Ui_ChapterizeWindow
+from cache import MetadataCache
+from export import split_chapters
 from mp3file import Mp3File
 from chapter import Chapter
 from timestamp import Timestamp
@@ -38,27 +42,246 @@ class TimestampDelegate(QStyledItemDelegate):
         editor.setGeometry(option.rect)
 
 
+class Mp3LoaderSignals(QObject):
+    loaded = pyqtSignal(str, object)
+
+
+class Mp3Loader(QRunnable):
+    """
+    Loads an Mp3File on a thread pool thread, emitting signals.loaded with the path and
+    the Mp3File, or None if it could not be loaded
+    """
+
+    def __init__(self, mp3_filepath, cache):
+        super().__init__()
+        self.path = mp3_filepath
+        self.signals = Mp3LoaderSignals()
+        self._cache = cache
+
+    def run(self):
+        try:
+            mp3 = Mp3File(self.path, cache=self._cache)
+        except Exception:
+            mp3 = None
+        self.signals.loaded.emit(self.path, mp3)
+
+
+class Mp3SaverSignals(QObject):
+    finished = pyqtSignal(list, list)
+
+
+class Mp3Saver(QRunnable):
+    """
+    Saves several Mp3File objects on a thread pool thread, emitting signals.finished with a list of
+    (path, bytes written) for saved files and a list of (path, error) for files that failed
+    """
+
+    def __init__(self, mp3_files):
+        super().__init__()
+        self.signals = Mp3SaverSignals()
+        self._mp3_files = mp3_files
+
+    def run(self):
+        saved = []
+        failed = []
+        for path, mp3 in self._mp3_files:
+            try:
+                saved.append((path, mp3.save()))
+            except Exception as e:
+                failed.append((path, str(e)))
+        self.signals.finished.emit(saved, failed)
+
+
+class Mp3SplitterSignals(QObject):
+    finished = pyqtSignal(str, list, str)
+
+
+class Mp3Splitter(QRunnable):
+    """
+    Writes every chapter of an Mp3File to a file of its own on a thread pool thread, emitting
+    signals.finished with the path of the mp3 file, a list of (path, bytes written) for the files
+    written and an error message, which is empty on success
+    """
+
+    def __init__(self, mp3, out_dir):
+        super().__init__()
+        self.signals = Mp3SplitterSignals()
+        self._mp3 = mp3
+        # A copy, so that the chapters can be edited while splitting
+        self._chapters = mp3.chapters[:]
+        self._out_dir = out_dir
+
+    def run(self):
+        try:
+            files = split_chapters(self._mp3.path, self._chapters, self._out_dir, self._mp3.seek_index)
+        except Exception as e:
+            self.signals.finished.emit(str(self._mp3.path), [], str(e))
+            return
+        self.signals.finished.emit(str(self._mp3.path), [(str(path), size) for path, size in files], '')
+
+
+class Mp3FileLRU(object):
+    """
+    Loaded Mp3File objects by path, bounded by number and approximate memory. The least recently used
+    files are evicted first, but files with unsaved changes are never evicted.
+    """
+
+    def __init__(self, max_files: int = 32, max_bytes: int = 16 * 1024 * 1024):
+        self._max_files = max_files
+        self._max_bytes = max_bytes
+        self._files = OrderedDict()  # path -> (Mp3File, approximate size)
+        self._dirty = set()
+        self._bytes = 0
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, path):
+        """
+        :return: the file if loaded, else None. The file becomes the most recently used one.
+        """
+        if path not in self._files:
+            return None
+        self._files.move_to_end(path)
+        return self._files[path][0]
+
+    def put(self, path, mp3, pinned=()):
+        """
+        Adds a loaded file and evicts clean files over the limits
+        :param pinned: paths that must not be evicted, e.g. the file being shown
+        """
+        self._remove(path)
+        size = mp3.memory_usage
+        self._files[path] = (mp3, size)
+        self._bytes += size
+        self._evict(pinned)
+
+    def _remove(self, path):
+        if path in self._files:
+            self._bytes -= self._files.pop(path)[1]
+
+    def _evict(self, pinned):
+        for path in list(self._files):
+            if len(self._files) <= self._max_files and self._bytes <= self._max_bytes:
+                break
+            if path not in self._dirty and path not in pinned:
+                self._remove(path)
+
+    def mark_dirty(self, path):
+        if path in self._files:
+            self._dirty.add(path)
+            # Edits change the size, so it is updated here
+            mp3, size = self._files[path]
+            self._bytes += mp3.memory_usage - size
+            self._files[path] = (mp3, mp3.memory_usage)
+
+    def mark_clean(self, path):
+        self._dirty.discard(path)
+
+    def is_dirty(self, path) -> bool:
+        return path in self._dirty
+
+    def dirty_files(self):
+        """
+        :return: list of (path, Mp3File) for files with unsaved changes
+        """
+        return [(path, self._files[path][0]) for path in self._files if path in self._dirty]
+
+
 class ChaptersTableModel(QAbstractTableModel):
 
     headers = ["Title", "Start", "End"]
 
+    # Number of files with unsaved changes
+    modifiedCountChanged = pyqtSignal(int)
+    # Lists of (path, bytes written) and (path, error) once a background save of all modified files is done
+    saveAllFinished = pyqtSignal(list, list)
+    # Path of the mp3 file, list of (path, bytes written) and an error message once a split is done
+    splitFinished = pyqtSignal(str, list, str)
+
     def __init__(self, mp3_filepath=''):
         super().__init__()
+        self._cache = MetadataCache()
+        self._pool = QThreadPool.globalInstance()
+        self._mp3 = None
+        self._filepath = ''
+        self._loading = False
+        self._saving = False
+        self._loaders = {}  # Loaders queued or running, by path
+        self._saver = None
+        self._splitter = None
+        self._files = Mp3FileLRU()
         self.set_file(mp3_filepath)
 
-    def set_file(self, mp3_filepath):
-        mp3 = None
-        if mp3_filepath != '':
-            try:
-                mp3 = Mp3File(mp3_filepath)
-            except IOError:
-                return
-
+    def set_file(self, mp3_filepath, prefetch=()):
+        """
+        Shows the chapters of a file, loading it in the background unless it was prefetched
+        :param mp3_filepath: path to mp3 file, or '' to show nothing
+        :param prefetch: paths of files likely to be shown next, which are loaded in the background too
+        """
+        wanted = set(prefetch)
+        wanted.add(mp3_filepath)
+        self._filepath = mp3_filepath
+
+        # Cancel loads no longer needed. Loads already running finish, and their result is kept.
+        for path in list(self._loaders):
+            if path not in wanted and self._pool.tryTake(self._loaders[path]):
+                del self._loaders[path]
+
+        mp3 = self._files.get(mp3_filepath)
+        if mp3 is not None or mp3_filepath == '':
+            self._show(mp3)
+        else:
+            self._show(None, loading=True)
+            self._load(mp3_filepath)
+
+        for path in prefetch:
+            if path not in self._files:
+                self._load(path)
+
+    def _load(self, mp3_filepath):
+        if mp3_filepath in self._loaders:
+            return
+        loader = Mp3Loader(mp3_filepath, self._cache)
+        loader.signals.loaded.connect(self._on_loaded)
+        self._loaders[mp3_filepath] = loader
+        self._pool.start(loader)
+
+    @pyqtSlot(str, object)
+    def _on_loaded(self, mp3_filepath, mp3):
+        if self._loaders.pop(mp3_filepath, None) is None:
+            return  # Cancelled
+        if mp3 is not None:
+            self._files.put(mp3_filepath, mp3, pinned=(self._filepath,))
+        if mp3_filepath == self._filepath:
+            self._show(mp3)
+
+    def _modified(self):
+        self._files.mark_dirty(self._filepath)
+        self.modifiedCountChanged.emit(len(self._files.dirty_files()))
+
+    @property
+    def editable(self) -> bool:
+        return self._mp3 is not None and not self._saving
+
+    def _show(self, mp3, loading=False):
         self.beginResetModel()
         self._mp3 = mp3
+        self._loading = loading
         self.endResetModel()
 
+    @property
+    def loading(self) -> bool:
+        return self._loading
+
     def data(self, index, role):
+        if self._loading:
+            if role == Qt.DisplayRole and index.isValid() and index.column() == 0:
+                return "Loading..."
+            return None
         if self._mp3 is None:
             return None
         if role not in (Qt.DisplayRole, Qt.EditRole):
@@ -81,15 +304,16 @@ class ChaptersTableModel(QAbstractTableModel):
         return None
 
     def setData(self, index, value, role):
-        if index.isValid() and role == Qt.EditRole:
+        if self.editable and index.isValid() and role == Qt.EditRole:
             row, col = index.row(), index.column()
-            ch = self._mp3.chapters[row]
+            chapters = self._mp3.chapters
             if col == 0:
-                ch.title = value
+                chapters.set_title(row, value)
             elif col == 1:
-                ch.start = Timestamp.from_string(value)
+                chapters.set_start(row, Timestamp.from_string(value))
             elif col == 2:
-                ch.end = Timestamp.from_string(value)
+                chapters.set_end(row, Timestamp.from_string(value))
+            self._modified()
             self.dataChanged.emit(index, index, [role])
             return True
         else:
@@ -101,7 +325,11 @@ class ChaptersTableModel(QAbstractTableModel):
         return ChaptersTableModel.headers[section]
 
     def rowCount(self, parent=QModelIndex()):
-        if parent.isValid() or self._mp3 is None:
+        if parent.isValid():
+            return 0
+        if self._loading:
+            return 1
+        if self._mp3 is None:
             return 0
         return len(self._mp3.chapters)
 
@@ -111,26 +339,88 @@ class ChaptersTableModel(QAbstractTableModel):
         return len(ChaptersTableModel.headers)
 
     def insertRows(self, row, count, parent=QModelIndex()):
+        if not self.editable:
+            return False
         self.beginInsertRows(parent, row, row+count-1)
-        for i in range(count):
-            self._mp3.chapters.insert(row + i, Chapter(title='', start=Timestamp(), end=Timestamp()))
+        self._mp3.chapters.insert_range(row, [Chapter(title='', start=Timestamp(), end=Timestamp())] * count)
+        self._modified()
         self.endInsertRows()
         return True
 
     def removeRows(self, row, count, parent=QModelIndex()):
+        if not self.editable or row >= len(self._mp3.chapters):
+            return False
         self.beginRemoveRows(parent, row, row+count-1)
-        for _ in range(count):
-            self._mp3.chapters.pop(row)
+        self._mp3.chapters.delete_range(row, row + count)
+        self._modified()
         self.endRemoveRows()
         return True
 
     def flags(self, index: QModelIndex) -> Qt.ItemFlags:
-        if index.isValid():
+        if index.isValid() and self.editable:
             return super().flags(index) | Qt.ItemIsEditable
         return super().flags(index)
 
-    def save(self):
-        self._mp3.save()
+    def save(self) -> int:
+        """
+        Saves the chapters of the current file
+        :return: number of bytes written
+        """
+        if not self.editable:
+            return 0
+        written = self._mp3.save()
+        self._files.mark_clean(self._filepath)
+        self.modifiedCountChanged.emit(len(self._files.dirty_files()))
+        return written
+
+    def save_all(self) -> bool:
+        """
+        Saves every file with unsaved changes in one batch on a background thread.
+        Editing is disabled until saveAllFinished is emitted.
+        :return: True if a save was started, False if there was nothing to save or a save is running
+        """
+        mp3_files = self._files.dirty_files()
+        if self._saving or len(mp3_files) == 0:
+            return False
+
+        self._saving = True
+        self._saver = Mp3Saver(mp3_files)
+        self._saver.signals.finished.connect(self._on_saved_all)
+        self._pool.start(self._saver)
+        return True
+
+    @pyqtSlot(list, list)
+    def _on_saved_all(self, saved, failed):
+        for path, _ in saved:
+            self._files.mark_clean(path)
+        self._saving = False
+        self._saver = None
+        self.modifiedCountChanged.emit(len(self._files.dirty_files()))
+        self.saveAllFinished.emit(saved, failed)
+
+    def split(self, out_dir) -> bool:
+        """
+        Writes every chapter of the current file, as currently edited, to a file of its own on a background
+        thread. splitFinished is emitted once done.
+        :param out_dir: directory to write the chapter files to
+        :return: True if the split was started, False if there is no file or a split is running
+        """
+        if self._mp3 is None or self._splitter is not None:
+            return False
+
+        self._splitter = Mp3Splitter(self._mp3, out_dir)
+        self._splitter.signals.finished.connect(self._on_split)
+        self._pool.start(self._splitter)
+        return True
+
+    @pyqtSlot(str, list, str)
+    def _on_split(self, mp3_filepath, files, error):
+        self._splitter = None
+        self.splitFinished.emit(mp3_filepath, files, error)
+
+    @property
+    def mp3_file(self):
+        return self._mp3
 
 
 class Chapterize(QMainWindow):
@@ -159,7 +449,12 @@ class Chapterize(QMainWindow):
 
         self.ui.actionChangeDir.triggered.connect(self.onDirectoryChange)
         self.ui.actionExit.triggered.connect(self.close)
-        self.ui.actionSave.triggered.connect(self.chaptersTableModel.save)
+        self.ui.actionSave.triggered.connect(self.onSave)
+        self.ui.actionSaveAll.triggered.connect(self.onSaveAll)
+
+        self.chaptersTableModel.modifiedCountChanged.connect(self.onModifiedCountChanged)
+        self.chaptersTableModel.saveAllFinished.connect(self.onSaveAllFinished)
+        self.chaptersTableModel.splitFinished.connect(self.onSplitFinished)
 
     @pyqtSlot()
     def onDirectoryChange(self):
@@ -169,11 +464,66 @@ class Chapterize(QMainWindow):
             self.mp3ListModel.setRootPath(self.dir)
             self.ui.mp3List.setRootIndex(self.mp3ListModel.index(self.dir))
 
+    @pyqtSlot()
+    def onSave(self):
+        mp3 = self.chaptersTableModel.mp3_file
+        if mp3 is None or not self.chaptersTableModel.editable:
+            return
+        written = self.chaptersTableModel.save()
+        self.statusBar().showMessage("Saved {}: {} bytes written".format(mp3.path.name, written))
+
+    @pyqtSlot()
+    def onSaveAll(self):
+        if self.chaptersTableModel.save_all():
+            self.statusBar().showMessage("Saving modified files...")
+
+    @pyqtSlot(list, list)
+    def onSaveAllFinished(self, saved, failed):
+        written = sum(n for _, n in saved)
+        message = "Saved {} files: {} bytes written".format(len(saved), written)
+        if len(failed) > 0:
+            message += ". Failed: {}".format(', '.join(Path(path).name for path, _ in failed))
+        self.statusBar().showMessage(message)
+
+    @pyqtSlot()
+    def onSplit(self):
+        mp3 = self.chaptersTableModel.mp3_file
+        if mp3 is None:
+            return
+        chosen_dir = QFileDialog.getExistingDirectory(self, "Split Into Chapters...", self.dir,
+                                                      QFileDialog.ShowDirsOnly)
+        if chosen_dir != '' and self.chaptersTableModel.split(Path(chosen_dir) / mp3.path.stem):
+            self.statusBar().showMessage("Splitting {}...".format(mp3.path.name))
+
+    @pyqtSlot(str, list, str)
+    def onSplitFinished(self, mp3_filepath, files, error):
+        if error != '':
+            self.statusBar().showMessage("Failed to split {}: {}".format(Path(mp3_filepath).name, error))
+            return
+        self.statusBar().showMessage("Split {} into {} files: {} bytes written".format(
+            Path(mp3_filepath).name, len(files), sum(size for _, size in files)))
+
+    @pyqtSlot(int)
+    def onModifiedCountChanged(self, count):
+        self.ui.actionSaveAll.setEnabled(count > 0)
+        if count > 0:
+            self.statusBar().showMessage("{} modified files".format(count))
+
     @pyqtSlot(QItemSelection, QItemSelection)
     def onMp3Select(self, selected, deselected):
+        if len(selected.indexes()) == 0:
+            return
         sel_idx = selected.indexes()[0]
         pth = self.mp3ListModel.fileInfo(sel_idx).absoluteFilePath()
-        self.chaptersTableModel.set_file(pth)
+
+        # Files next to the selected one are loaded ahead, so that moving through the list is instant
+        neighbors = []
+        for offset in (1, -1):
+            idx = sel_idx.sibling(sel_idx.row() + offset, 0)
+            if idx.isValid():
+                neighbors.append(self.mp3ListModel.fileInfo(idx).absoluteFilePath())
+
+        self.chaptersTableModel.set_file(pth, prefetch=neighbors)
 
     @pyqtSlot(QContextMenuEvent)
     def onChapterContextMenu(self, e):
@@ -194,6 +544,14 @@ class Chapterize(QMainWindow):
 
         menu.addAction(deleteAction)
 
+        menu.addSeparator()
+
+        splitAction = QAction('&Split Into Chapters...', menu)
+        splitAction.setEnabled(self.chaptersTableModel.mp3_file is not None)
+        splitAction.triggered.connect(self.onSplit)
+
+        menu.addAction(splitAction)
+
         menu.exec_(e.globalPos())
 
 
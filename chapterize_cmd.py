@@ -1,57 +1,51 @@
 from pathlib import Path
-from typing import List
+from typing import Callable, Iterable, List, Optional, Tuple
 from argparse import ArgumentParser
-import xml.etree.ElementTree as ET
+from contextlib import redirect_stdout
+from functools import partial
+from itertools import chain
+import io
+import json
+import os
 import sys
+import threading
+import time
 
-from recordclass import recordclass
-import eyed3
-from eyed3.mp3 import Mp3AudioFile
-import tabulate
+import id3tag
+import profiling
+from chapter import Chapter, ChapterList, diff_chapters
+from cache import CachedMetadata, ChapterizedState, MetadataCache, SeekIndexCache, default_cache_path
+from duration import Duration, SeekIndex, read_duration
+from library import LibraryScanner
+from mp3file import Mp3File, load_seek_index
+from overdrive import iter_markers
 
-tabulate.PRESERVE_WHITESPACE = True
+# Heavier modules, such as tabulate, asyncio and concurrent.futures, are imported by the functions that use them,
+# so that --help and runs over unchanged files start quickly.
 
-Chap = recordclass('Chap', 'title start end')
 
+class Chap(object):
+    __slots__ = ('title', 'start', 'end')
 
-def _time_to_milliseconds(t: str) -> int:
-    """
-    Converts hh:mm:ss.zzz into integer milliseconds
-    :param t: a string formatted as [[hh:]mm:]ss[.zzz]
-    :return: number of milliseconds
-    """
-    time_comp = t.strip().split(':')
-    secs = 0.0
-    if len(time_comp) > 0:
-        secs = float(time_comp[-1])
-        mins = 0
-        if len(time_comp) > 1:
-            mins = int(time_comp[-2])
-            hours = 0
-            if len(time_comp) > 2:
-               hours = int(time_comp[-3])
-    seconds = (hours * 3600) + (mins * 60) + secs
-    return int(seconds * 1000)
+    def __init__(self, title: str, start: int, end: Optional[int]):
+        """
+        A chapter parsed from Overdrive markers, with times in milliseconds
+        """
+        self.title = title
+        self.start = start
+        self.end = end
 
 
-def _parse_markers(markers) -> List[Chap]:
+def _parse_markers(markers: List[Tuple[str, int]]) -> List[Chap]:
     """
     Parses markers into Chap items
-    :param markers: a user frame called 'Overdrive MediaMarkers' containing XML formatted markers
+    :param markers: a list of (name, milliseconds) pairs
     :return: a list of Chap items
     """
-    titles = []
-    starts = []
-
     print("Parsing Overdrive chapters: ", end='')
 
-    root = ET.fromstring(markers.text)
-    for marker in root.iter('Marker'):
-        name = marker.find('Name')
-        time = marker.find('Time')
-        if name is not None and time is not None:
-            titles.append(name.text)
-            starts.append(_time_to_milliseconds(time.text))
+    titles = [name for name, _ in markers]
+    starts = [start for _, start in markers]
 
     if len(starts) > 0:
         ends = starts[1:] + [None]
@@ -68,107 +62,63 @@ def _parse_markers(markers) -> List[Chap]:
     return chapters
 
 
-def _load_markers(mp3: Mp3AudioFile):
+def _load_markers(metadata: CachedMetadata):
     """
-    Returns 'Overdrive MediaMarkers' user frame (containing markers) from the loaded mp3 file
-    :param mp3: the loaded mp3 file
-    :return: 'Overdrive MediaMarkers' user frame if found, else None
+    Returns the markers in 'Overdrive MediaMarkers' user frame of an mp3 file
+    :param metadata: the metadata read from the mp3 file
+    :return: a list of (name, milliseconds) pairs if found, else None
     """
     print("Looking for Overdrive chapters: ", end='')
-    user_frames = mp3.tag.user_text_frames
-    if 'OverDrive MediaMarkers' in user_frames:
-        markers = user_frames.get('OverDrive MediaMarkers')
+    if len(metadata.markers) > 0:
         print("Succeeded.")
-        return markers
+        return metadata.markers
     print("Failed.")
     return None
 
 
-def _find_mp3_files(dir: str) -> List[Path]:
-    """
-    Provides a list of paths to mp3 files in a given directory
-    :param dir: A directory
-    :return: List of mp3 file paths
-    """
-    p = Path(dir)
-    print("Finding mp3 files: ", end='')
-    mp3_files = list(p.glob('*.mp3'))
-
-    if len(mp3_files) == 0:
-        print("Failed.")
-    else:
-        print("{} files found.".format(len(mp3_files)))
-
-    return mp3_files
-
-
-def _has_chapter_metadata(mp3: Mp3AudioFile) -> bool:
+def _has_chapter_metadata(metadata: CachedMetadata) -> bool:
     """
     Returns True if mp3 file has chapter metadata otherwise False
-    :param mp3: loaded mp3 file
+    :param metadata: the metadata read from the mp3 file
     :return: True if mp3 file has chapter metadata otherwise False
     """
-    for _ in mp3.tag.table_of_contents:
-        return True
+    return metadata.has_chapters
 
-    for _ in mp3.tag.chapters:
-        return True
 
-    return False
+def _abort():
+    print("Aborting.")
+    sys.exit(0)
 
 
-def _remove_existing_chapter_metadata(mp3: Mp3AudioFile) -> None:
+def _frame_index(mp3_file: Path, cache_path: Optional[str] = None):
     """
-    Removes existing chapter tags from the loaded mp3 file if present.
-    Note that this does not save the modified tags.
-    :param mp3: the loaded mp3 file
+    Finds an index of the frames of an mp3 file, reading as little of it as possible
+    :param mp3_file: path to mp3 file
+    :param cache_path: path of the metadata cache database, which also holds the seek indices, if any
+    :return: a SeekIndex or ConstantBitrateIndex, None if the file has no audio frames
     """
-    toc_eids = [toc.element_id for toc in mp3.tag.table_of_contents]
-    chap_eids = [chap.element_id for chap in mp3.tag.chapters]
-
-    for toc_eid in toc_eids:
-        mp3.tag.table_of_contents.remove(toc_eid)
+    from snap import frame_index
 
-    for chap_eid in chap_eids:
-        mp3.tag.chapters.remove(chap_eid)
+    seek_cache = SeekIndexCache(cache_path) if cache_path is not None else None
+    try:
+        return frame_index(mp3_file, seek_cache)
+    finally:
+        if seek_cache is not None:
+            seek_cache.close()
 
 
-def _load_mp3_file(mp3_file: str) -> Mp3AudioFile:
+def _write_chapters(mp3_file: Path, chapters: ChapterList, seek_index: Optional[SeekIndex] = None) -> int:
     """
-    Load an mp3 file from a path
+    Replaces the chapter frames of an mp3 file. The audio is only rewritten when the tag has to grow,
+    into a temporary file that is renamed over the original once complete.
     :param mp3_file: path to mp3 file
-    :return: loaded mp3 audio file if success, else None
+    :param chapters: chapters to write
+    :param seek_index: seek index of the file, if given the chapters get byte offsets
+    :return: number of bytes written
     """
-    print("Reading tags in {}: ".format(mp3_file), end='')
-
-    mp3 = None
-    try:
-        mp3 = eyed3.load(mp3_file)
-        if mp3 is None:
-            print("Failed.")
-        print("Succeeded.")
-    except IOError:
-        print("Failed.")
-    return mp3
-
-
-def _abort():
-    print("Aborting.")
-    sys.exit(0)
-
-
-def _write_chapters(mp3: Mp3AudioFile, chapters: List[Chap]) -> None:
-    if len(chapters) == 0:
-        return
-
-    toc = mp3.tag.table_of_contents.set(b'toc', toplevel=True, description=u'Table of Contents')
-
-    for index, chapter in zip(range(1, len(chapters) + 1), chapters):
-        ch = mp3.tag.chapters.set('ch{}'.format(index).encode('ascii'), (chapter.start, chapter.end))
-        ch.title = chapter.title
-
-        toc.child_ids.append(ch.element_id)
-        print("Added chapter: {}".format(chapter.title))
+    for title in chapters.titles:
+        print("Added chapter: {}".format(title))
+    return id3tag.save_chapters(mp3_file, chapters, seek_index=seek_index)
 
 
 def _parse_selection(selection: str):
@@ -213,6 +163,9 @@ def _print_chapters(chapters: List[Chap], index=False, title=True, start=False,
          if end:
              data[-1].append(chap.end)
 
+    import tabulate
+
+    tabulate.PRESERVE_WHITESPACE = True
     print(tabulate.tabulate(data, headers="firstrow"))
 
 
@@ -255,70 +208,924 @@ def _select_chapters(chapters: List[Chap]):
     return all_selected
 
 
+def _print_diff(diff: List[Tuple[int, Optional[Chapter], Optional[Chapter]]]) -> None:
+    """
+    Prints how the chapters of a file would change
+    :param diff: differences as returned by diff_chapters
+    """
+    changed = sum(1 for _, old, new in diff if old is not None and new is not None)
+    added = sum(1 for _, old, _ in diff if old is None)
+    removed = sum(1 for _, _, new in diff if new is None)
+    print("Chapters differ: {} changed, {} added, {} removed.".format(changed, added, removed))
+    for index, old, new in diff:
+        if old is None:
+            print("  + {}: {}".format(index + 1, new))
+        elif new is None:
+            print("  - {}: {}".format(index + 1, old))
+        else:
+            print("  ~ {}: {} -> {}".format(index + 1, old, new))
+
+
+class _FileJob(object):
+    def __init__(self, mp3_file: Path):
+        """
+        An mp3 file on its way through the steps of chapterizing it, with what the steps found so far
+        :param mp3_file: path to mp3 file
+        """
+        self.path = mp3_file
+        self.result = {'path': str(mp3_file), 'status': 'failed', 'chapters': 0, 'error': None}
+        self.done = False
+        self.output = None  # Console output of the steps, when they run in a pipeline
+        self.tag = None  # type: Optional[id3tag.Tag]
+        self.metadata = None  # type: Optional[CachedMetadata]
+        self.chapters = None  # type: Optional[List[Chap]]
+        self.selected = None  # type: Optional[List[Chap]]
+        self.computed = None  # type: Optional[ChapterList]
+        self.existing = False
+        self.written = 0
+
+    def finish(self, status: str, chapters: int = 0, error: Optional[str] = None) -> None:
+        """
+        Records the outcome of the file, so that the remaining steps are skipped
+        """
+        self.result['status'] = status
+        self.result['chapters'] = chapters
+        self.result['error'] = error
+        self.done = True
+
+
+def _parse_media_markers(mp3_file: Path, xml_txt: Optional[str]) -> List[Tuple[str, int]]:
+    """
+    :param mp3_file: path to mp3 file, for profiling
+    :param xml_txt: Overdrive MediaMarkers of the file, if any
+    :return: a list of (name, milliseconds) pairs
+    """
+    with profiling.stage('parse_markers', mp3_file):
+        return list(iter_markers(xml_txt)) if xml_txt is not None else []
+
+
+def _read_duration(mp3_file: Path) -> Duration:
+    """
+    :param mp3_file: path to mp3 file
+    :return: duration of the audio
+    """
+    with profiling.stage('duration', mp3_file):
+        return read_duration(mp3_file)
+
+
+def _snap_chapters(mp3_file: Path, chapters: ChapterList, max_shift: int, cache_path: Optional[str] = None):
+    """
+    Moves chapter starts to the nearest quiet gaps
+    :param mp3_file: path to mp3 file
+    :param chapters: chapters to change, which are returned rather than changed when run in a worker process
+    :param max_shift: largest move of a start in milliseconds
+    :param cache_path: path of the metadata cache database, which also holds the seek indices, if any
+    :return: tuple of the chapters and the moves made
+    """
+    from snap import snap_chapters
+
+    moves = snap_chapters(mp3_file, chapters, max_shift=max_shift, index=_frame_index(mp3_file, cache_path))
+    return chapters, moves
+
+
+def _call(pool: Optional['_WorkerPool'], func: Callable, *args):
+    """
+    Calls func in a worker process of pool, or in this thread if there is no pool
+    """
+    return pool.run(func, *args) if pool is not None else func(*args)
+
+
+def _read_step(job: _FileJob, cache: Optional[MetadataCache] = None) -> None:
+    """
+    Reads the tag of an mp3 file, without loading the audio stream. If the file is unchanged since its
+    metadata was cached, it is not opened at all.
+    :param job: the file
+    :param cache: metadata cache to consult first, if any
+    """
+    print("Reading tags in {}: ".format(job.path), end='')
+
+    try:
+        job.metadata = cache.get(job.path) if cache is not None else None
+        if job.metadata is not None:
+            print("Succeeded (cached).")
+            return
+
+        with profiling.stage('read_tag', job.path):
+            job.tag = id3tag.read_tag(job.path)
+    except IOError:
+        print("Failed.")
+        job.finish('failed', error='Unable to read mp3 file')
+        return
+
+    print("Succeeded.")
+
+
+def _parse_step(job: _FileJob, overwrite: bool = False, cache: Optional[MetadataCache] = None,
+                pool: Optional['_WorkerPool'] = None) -> None:
+    """
+    Parses the Overdrive markers of an mp3 file into chapters, and finds out whether the file needs them
+    :param job: the file, with its tag or cached metadata
+    :param overwrite: if True, existing chapter information is replaced, otherwise the file is ignored
+    :param cache: metadata cache to store the parsed metadata in, if any
+    :param pool: worker processes to parse the markers in, if any
+    """
+    if job.tag is not None:
+        markers = _call(pool, _parse_media_markers, job.path, job.tag.media_markers)
+        chapters = [(ch.title, ch.start.total_milliseconds, ch.end.total_milliseconds) for ch in job.tag.chapters]
+        job.metadata = CachedMetadata(markers, chapters, job.tag.has_chapters, None)
+        job.tag = None
+        if cache is not None:
+            cache.put(job.path, job.metadata)
+
+    markers = _load_markers(job.metadata)
+
+    if markers is None:
+        job.finish('failed', error='No Overdrive chapters found')
+        return
+
+    with profiling.stage('build_chapters', job.path):
+        job.chapters = _parse_markers(markers)
+
+    if len(job.chapters) == 0:
+        print("Skipping.")
+        job.finish('skipped')
+        return
+
+    job.existing = _has_chapter_metadata(job.metadata)
+
+    if job.existing and not overwrite:
+        print("Existing chapter information found. Ignoring.", end='\n\n')
+        job.finish('ignored')
+
+
+def _duration_step(job: _FileJob, cache: Optional[MetadataCache] = None, select: bool = False,
+                   snap: int = 0, pool: Optional['_WorkerPool'] = None) -> None:
+    """
+    Ends the last chapter at the end of the audio, and moves chapter starts to quiet gaps if asked to
+    :param job: the file, with its chapters
+    :param cache: metadata cache to store the duration in, if any
+    :param select: if True, user will be asked to select chapters
+    :param snap: if greater than 0, chapter starts are moved by up to this many milliseconds to the nearest quiet gap
+    :param pool: worker processes to measure the duration and snap chapters in, if any
+    """
+    if job.metadata.duration is None:
+        mp3_duration = _call(pool, _read_duration, job.path)
+        print("Duration: {}".format(mp3_duration))
+        job.metadata.duration = mp3_duration.milliseconds
+        if cache is not None:
+            cache.put(job.path, job.metadata)
+    job.chapters[-1].end = job.metadata.duration
+
+    job.selected = _select_chapters(job.chapters) if select else job.chapters
+    job.computed = ChapterList.from_milliseconds((ch.title, ch.start, ch.end) for ch in job.selected)
+
+    if snap > 0:
+        job.computed, moves = _call(pool, _snap_chapters, job.path, job.computed, snap,
+                                    cache.path if cache is not None else None)
+        print("Moved {} chapter starts to quiet gaps.".format(len(moves)))
+
+
+def _build_step(job: _FileJob, dry_run: bool = False, tolerance: int = 0) -> None:
+    """
+    Compares the chapters with those already in the file
+    :param job: the file, with its chapters complete
+    :param dry_run: if True, print what would change and stop
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    """
+    if job.existing:
+        diff = diff_chapters(ChapterList.from_milliseconds(job.metadata.chapters), job.computed, tolerance)
+        if len(diff) == 0:
+            print("Existing chapter information matches. Nothing to write.", end='\n\n')
+            job.finish('unchanged', len(job.computed))
+            return
+        _print_diff(diff)
+
+    if dry_run:
+        print("Dry run, {} chapters not written.".format(len(job.computed)), end='\n\n')
+        job.finish('dry-run', len(job.computed))
+
+
+def _save_step(job: _FileJob, cache: Optional[MetadataCache] = None, seek_offsets: bool = False) -> None:
+    """
+    Writes the chapters to the file
+    :param job: the file, with chapters that differ from those it has
+    :param cache: metadata cache to update, if any
+    :param seek_offsets: if True, chapters are written with the byte offsets of their first and last frames
+    """
+    if job.existing:
+        print("Existing chapter information found. Overwriting.", end='\n\n')
+
+    seek_cache = SeekIndexCache(cache.path) if seek_offsets and cache is not None else None
+    try:
+        seek_index = load_seek_index(job.path, seek_cache) if seek_offsets else None
+        with profiling.stage('save', job.path):
+            job.written = _write_chapters(job.path, job.computed, seek_index)
+        if seek_cache is not None and seek_index is not None:
+            # Only the tag was rewritten, so the index still describes the audio
+            seek_cache.put(job.path, seek_index)
+    finally:
+        if seek_cache is not None:
+            seek_cache.close()
+    print("Saved tags: {} bytes written.".format(job.written), end='\n\n')
+
+    if cache is not None:
+        # Replace the entry of the file as it was before saving
+        cache.put(job.path, CachedMetadata(job.metadata.markers, list(job.computed.iter_milliseconds()),
+                                           len(job.selected) > 0, job.metadata.duration))
+
+    job.finish('chapterized', len(job.selected))
+
+
+def _chapterize_steps(overwrite: bool = False, select: bool = False, cache: Optional[MetadataCache] = None,
+                      dry_run: bool = False, tolerance: int = 0, seek_offsets: bool = False, snap: int = 0,
+                      pool: Optional['_WorkerPool'] = None) -> List[Tuple[str, Callable[[_FileJob], None]]]:
+    """
+    The steps of chapterizing a file, in order, with their names. See _chapterize_file for the parameters.
+    :param pool: worker processes to parse markers, measure durations and snap chapters in, if any
+    :return: list of (name, step) pairs, each step taking a _FileJob
+    """
+    return [('read', partial(_read_step, cache=cache)),
+            ('parse', partial(_parse_step, overwrite=overwrite, cache=cache, pool=pool)),
+            ('duration', partial(_duration_step, cache=cache, select=select, snap=snap, pool=pool)),
+            ('build', partial(_build_step, dry_run=dry_run, tolerance=tolerance)),
+            ('save', partial(_save_step, cache=cache, seek_offsets=seek_offsets))]
+
+
+def _chapterize_file(mp3_file: Path, overwrite: bool = False, select: bool = False,
+                     cache: Optional[MetadataCache] = None, dry_run: bool = False, tolerance: int = 0,
+                     seek_offsets: bool = False, snap: int = 0) -> dict:
+    """
+    Adds ID3v2 chapter tags to a single mp3 file based on its Overdrive markers
+    :param mp3_file: path to mp3 file
+    :param overwrite: if True, existing chapter information is replaced, otherwise the file is ignored
+    :param select: if True, user will be asked to select chapters
+    :param cache: metadata cache to consult before reading the file, if any
+    :param dry_run: if True, print what would change without opening the file for writing
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    :param seek_offsets: if True, chapters are written with the byte offsets of their first and last frames
+    :param snap: if greater than 0, chapter starts are moved by up to this many milliseconds to the nearest quiet gap
+    :return: a result record with the path, status ('chapterized', 'unchanged', 'skipped', 'ignored', 'dry-run'
+             or 'failed'), number of chapters written and an error message for failures
+    """
+    job = _FileJob(mp3_file)
+    for _, step in _chapterize_steps(overwrite=overwrite, select=select, cache=cache, dry_run=dry_run,
+                                     tolerance=tolerance, seek_offsets=seek_offsets, snap=snap):
+        step(job)
+        if job.done:
+            break
+    return job.result
+
+
+def _chapterize_book(directory: str, overwrite: bool = False, cache: Optional[MetadataCache] = None,
+                     dry_run: bool = False, tolerance: int = 0, seek_offsets: bool = False) -> List[dict]:
+    """
+    Adds ID3v2 chapter tags to all parts of a multi-part audiobook, using one chapter index for the
+    whole book so that chapters running over part boundaries are neither cut off nor duplicated.
+    Only parts whose chapters differ from what they already have are written.
+    :param directory: directory holding the parts
+    :param overwrite: if True, existing chapter information is replaced, otherwise the book is ignored
+    :param cache: metadata cache consulted when loading the parts, if any
+    :param dry_run: if True, print what would change without opening any part for writing
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    :param seek_offsets: if True, chapters are written with the byte offsets of their first and last frames
+    :return: a result record per part
+    """
+    from audiobook import Audiobook
+
+    print("Loading audiobook in {}: ".format(directory), end='')
+    try:
+        book = Audiobook(directory, cache=cache)
+    except Exception as e:
+        print("Failed.")
+        return [{'path': str(directory), 'status': 'failed', 'chapters': 0,
+                 'error': '{}: {}'.format(type(e).__name__, e)}]
+    print("{} parts, {} chapters.".format(len(book.parts), len(book.chapters)), end='\n\n')
+
+    results = [{'path': str(part.path), 'status': 'failed', 'chapters': 0, 'error': None} for part in book.parts]
+
+    if len(book.chapters) == 0:
+        print("No Overdrive chapters found. Skipping.", end='\n\n')
+        for result in results:
+            result['status'] = 'skipped'
+        return results
+
+    _print_chapters(book.chapters, index=True, title=True, start=True, end=True)
+    print()
+
+    if any(part.mp3.has_id3v2_chapters for part in book.parts):
+        print("Existing chapter information found.", end='')
+        if not overwrite:
+            print(" Ignoring.", end='\n\n')
+            for result in results:
+                result['status'] = 'ignored'
+            return results
+        print(" Overwriting.")
+
+    changed = []
+    for index, (part, result) in enumerate(zip(book.parts, results)):
+        result['chapters'] = len(book.part_chapters(index))
+        diff = diff_chapters(part.mp3.id3v2_chapters, book.part_chapters(index), tolerance)
+        if part.mp3.has_id3v2_chapters and len(diff) == 0:
+            result['status'] = 'unchanged'
+            continue
+        print("{}: ".format(part.path.name), end='')
+        _print_diff(diff)
+        result['status'] = 'dry-run' if dry_run else 'chapterized'
+        changed.append(index)
+
+    if len(changed) == 0:
+        print("Existing chapter information matches. Nothing to write.", end='\n\n')
+        return results
+    if dry_run:
+        print("Dry run, {} parts not written.".format(len(changed)), end='\n\n')
+        return results
+
+    print("Saving tags: ", end='')
+    written = book.save(changed, seek_offsets=seek_offsets)
+    print("Succeeded. {} parts, {} bytes written.".format(len(written), sum(written.values())), end='\n\n')
+    return results
+
+
+def _split_file(mp3_file: Path, out_dir: str, cache: Optional[MetadataCache] = None, dry_run: bool = False) -> dict:
+    """
+    Writes every chapter of an mp3 file to a file of its own, in a directory named after the mp3 file.
+    The chapters are those of the ID3v2 tag, or the Overdrive markers if the file has none.
+    :param mp3_file: path to mp3 file
+    :param out_dir: directory to create the directory of the chapter files in
+    :param cache: metadata cache consulted before reading the file, if any
+    :param dry_run: if True, print the files that would be written without writing them
+    :return: a result record with the path, status ('split', 'dry-run', 'skipped' or 'failed'),
+             number of chapter files and an error message for failures
+    """
+    from export import split_chapters
+
+    result = {'path': str(mp3_file), 'status': 'failed', 'chapters': 0, 'error': None}
+
+    print("Splitting {}: ".format(mp3_file), end='')
+    seek_cache = SeekIndexCache(cache.path) if cache is not None else None
+    try:
+        mp3 = Mp3File(mp3_file, cache=cache)
+        if len(mp3.chapters) == 0:
+            print("No chapters found. Skipping.", end='\n\n')
+            result['status'] = 'skipped'
+            return result
+        files = split_chapters(mp3_file, mp3.chapters, Path(out_dir) / mp3_file.stem,
+                               load_seek_index(mp3_file, seek_cache), dry_run=dry_run)
+    except Exception as e:
+        print("Failed.", end='\n\n')
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return result
+    finally:
+        if seek_cache is not None:
+            seek_cache.close()
+
+    print("{} files{}.".format(len(files), ' would be written' if dry_run else ' written'))
+    for path, size in files:
+        print("  {} ({} bytes)".format(path, size))
+    print()
+    result['status'] = 'dry-run' if dry_run else 'split'
+    result['chapters'] = len(files)
+    return result
+
+
+def _merge_book(directory: str, out_dir: str, cache: Optional[MetadataCache] = None) -> dict:
+    """
+    Joins the parts of a multi-part audiobook into one chaptered mp3 file, named after the directory
+    :param directory: directory holding the parts
+    :param out_dir: directory to write the merged file to
+    :param cache: metadata cache consulted when loading the parts, if any
+    :return: a result record with the path of the merged file, status ('merged' or 'failed'),
+             number of chapters and an error message for failures
+    """
+    from export import merge_book
+
+    out_path = Path(out_dir) / (Path(directory).resolve().name + '.mp3')
+    result = {'path': str(out_path), 'status': 'failed', 'chapters': 0, 'error': None}
+
+    print("Merging {} into {}: ".format(directory, out_path), end='')
+    try:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        chapters, written = merge_book(directory, out_path, cache=cache)
+    except Exception as e:
+        print("Failed.", end='\n\n')
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return result
+    print("{} chapters, {} bytes written.".format(chapters, written), end='\n\n')
+    result['status'] = 'merged'
+    result['chapters'] = chapters
+    return result
+
+
+_worker_cache = None
+
+
+def _init_worker(cache_path: Optional[str], profile: bool = False,
+                 cprofile: Optional[Tuple[str, str]] = None) -> None:
+    """
+    Opens the metadata cache in a worker process. Workers ignore Ctrl+C, which the parent handles by shutting
+    the pool down, so that they do not each print a traceback.
+    :param cache_path: path of the cache database, None to disable the cache
+    :param profile: if True, stages are recorded and returned with each result
+    :param cprofile: path of an mp3 file and of a file to dump cProfile statistics of its processing to, if any
+    """
+    import signal
+
+    global _worker_cache
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_cache = MetadataCache(cache_path) if cache_path is not None else None
+    if profile:
+        profiling.enable(cprofile)
+
+
+def _run_captured(func: Callable, *args):
+    """
+    Runs func in a worker process
+    :return: tuple of the result, the stages recorded if profiling, the id of the process and the seconds taken
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, profiling.take_records(), os.getpid(), time.perf_counter() - start
+
+
+class _WorkerPool(object):
+    def __init__(self, jobs: int):
+        """
+        Worker processes that the steps of a pipeline hand their CPU-bound work to, counting what they did
+        :param jobs: number of worker processes
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        self._executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                             initargs=(None, profiling.enabled()))
+        # A worker forked once the pipeline has started its threads could inherit a lock one of them holds, such
+        # as the import lock, and wait for it forever, so all workers are started before that
+        for future in [self._executor.submit(os.getpid) for _ in range(jobs)]:
+            future.result()
+        self._lock = threading.Lock()
+        self._pids = set()
+        self.tasks = 0
+        self.busy = 0.0
+
+    def run(self, func: Callable, *args):
+        """
+        Calls func in a worker process and waits for its result
+        """
+        result, records, pid, seconds = self._executor.submit(_run_captured, func, *args).result()
+        profiling.add_records(records)
+        with self._lock:
+            self._pids.add(pid)
+            self.tasks += 1
+            self.busy += seconds
+        return result
+
+    @property
+    def processes(self) -> int:
+        """
+        Number of worker processes that ran at least one task
+        """
+        return len(self._pids)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+def _chapterize_file_captured(mp3_file: Path, overwrite: bool = False, dry_run: bool = False, tolerance: int = 0,
+                              seek_offsets: bool = False, snap: int = 0):
+    """
+    Runs _chapterize_file in a worker process, capturing its console output so that it can be
+    printed by the parent in the same order as a serial run would print it
+    :param mp3_file: path to mp3 file
+    :param overwrite: if True, existing chapter information is replaced
+    :param dry_run: if True, print what would change without writing
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    :param seek_offsets: if True, chapters are written with byte offsets
+    :param snap: largest move of chapter starts to quiet gaps in milliseconds, 0 to leave them
+    :return: tuple of the result record, the captured output and the stages recorded if profiling
+    """
+    out = io.StringIO()
+    with redirect_stdout(out):
+        try:
+            result = profiling.run(mp3_file, _chapterize_file, mp3_file, overwrite=overwrite, cache=_worker_cache,
+                                   dry_run=dry_run, tolerance=tolerance, seek_offsets=seek_offsets, snap=snap)
+        except Exception as e:
+            print("Failed.")
+            result = {'path': str(mp3_file), 'status': 'failed', 'chapters': 0,
+                      'error': '{}: {}'.format(type(e).__name__, e)}
+    return result, out.getvalue(), profiling.take_records()
+
+
+def _record_result(result: dict, state: Optional[ChapterizedState]) -> None:
+    """
+    Remembers files that now have chapters, so that later runs skip them while they are unchanged
+    :param result: result record of a file
+    :param state: record of chapterized files, None to remember nothing
+    """
+    if state is not None and result['status'] in ('chapterized', 'unchanged', 'ignored'):
+        state.record(result['path'])
+
+
+def _run_serial(mp3_files: Iterable[Path], overwrite: bool, select: bool, cache_path: Optional[str],
+                state: Optional[ChapterizedState] = None, dry_run: bool = False, tolerance: int = 0,
+                seek_offsets: bool = False, snap: int = 0) -> List[dict]:
+    """
+    Chapterizes mp3 files one at a time in this process. Required for select mode.
+    :param mp3_files: paths to mp3 files, consumed as they are found
+    :param overwrite: if True, existing chapter information is replaced
+    :param select: if True, user will be asked to select chapters for each mp3 file
+    :param cache_path: path of the metadata cache database, None to disable the cache
+    :param state: record of chapterized files to update, if any
+    :param dry_run: if True, print what would change without writing
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    :param seek_offsets: if True, chapters are written with byte offsets
+    :param snap: largest move of chapter starts to quiet gaps in milliseconds, 0 to leave them
+    :return: list of result records, one per mp3 file
+    """
+    cache = MetadataCache(cache_path) if cache_path is not None else None
+    results = []
+    for mp3_file in mp3_files:
+        try:
+            result = profiling.run(mp3_file, _chapterize_file, mp3_file, overwrite=overwrite, select=select,
+                                   cache=cache, dry_run=dry_run, tolerance=tolerance, seek_offsets=seek_offsets,
+                                   snap=snap)
+        except (KeyboardInterrupt, EOFError):
+            sys.exit(0)
+        except Exception as e:
+            print("Failed.")
+            result = {'path': str(mp3_file), 'status': 'failed', 'chapters': 0,
+                      'error': '{}: {}'.format(type(e).__name__, e)}
+        _record_result(result, state)
+        results.append(result)
+    return results
+
+
+def _run_pipeline(mp3_files: Iterable[Path], overwrite: bool, jobs: int, reads: int, writes: int,
+                  cache_path: Optional[str], state: Optional[ChapterizedState] = None, dry_run: bool = False,
+                  tolerance: int = 0, seek_offsets: bool = False, snap: int = 0):
+    """
+    Chapterizes mp3 files in a pipeline, so that while one file is saved the next ones are already being read
+    and parsed, and disk and CPU are busy at the same time. The steps of _chapterize_file run as stages on an
+    asyncio event loop, connected by bounded queues. Reading tags, durations and the audio around chapter
+    starts share one concurrency limit and saving has its own, so that writes can be kept sequential.
+    Parsing markers, measuring durations and snapping chapters run in worker processes, so that they are not
+    held up by the GIL. Results and output are reported in the order of mp3_files.
+    :param mp3_files: paths to mp3 files, consumed as they are found
+    :param overwrite: if True, existing chapter information is replaced
+    :param jobs: number of worker processes, 1 to do all work in this process
+    :param reads: largest number of files read at the same time
+    :param writes: largest number of files written at the same time
+    :param cache_path: path of the metadata cache database, None to disable the cache
+    :param state: record of chapterized files to update, if any
+    :param dry_run: if True, print what would change without writing
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    :param seek_offsets: if True, chapters are written with byte offsets
+    :param snap: largest move of chapter starts to quiet gaps in milliseconds, 0 to leave them
+    :return: tuple of the list of result records, one per mp3 file, and the statistics of the pipeline,
+             None if there were no files
+    """
+    mp3_files = iter(mp3_files)
+    first = next(mp3_files, None)
+    if first is None:
+        # Runs over libraries where every file is unchanged do not need to load asyncio
+        return [], None
+    mp3_files = chain([first], mp3_files)
+
+    from pipeline import Stage, run_pipeline
+
+    cache = MetadataCache(cache_path) if cache_path is not None else None
+    results = []
+    written = 0
+
+    def guarded(step):
+        def run(job: _FileJob):
+            try:
+                step(job)
+            except Exception as e:
+                print("Failed.")
+                job.finish('failed', error='{}: {}'.format(type(e).__name__, e))
+        return run
+
+    def report(job: _FileJob):
+        nonlocal written
+        print(job.output.getvalue(), end='')
+        _record_result(job.result, state)
+        results.append(job.result)
+        written += job.written
+
+    def new_job(mp3_file: Path) -> _FileJob:
+        job = _FileJob(mp3_file)
+        job.output = io.StringIO()
+        return job
+
+    pool = _WorkerPool(jobs) if jobs > 1 else None
+
+    steps = dict(_chapterize_steps(overwrite=overwrite, cache=cache, dry_run=dry_run, tolerance=tolerance,
+                                   seek_offsets=seek_offsets, snap=snap, pool=pool))
+    stages = [Stage('read', guarded(steps['read']), workers=reads, limit='read'),
+              Stage('parse', guarded(steps['parse']), workers=jobs),
+              Stage('duration', guarded(steps['duration']), workers=reads, limit='read'),
+              Stage('build', guarded(steps['build']), inline=True),
+              Stage('save', guarded(steps['save']), workers=writes, limit='write')]
+    try:
+        stats = run_pipeline((new_job(mp3_file) for mp3_file in mp3_files), stages, report,
+                             limits={'read': reads, 'write': writes}, window=4 * (reads + jobs + writes))
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    stats.bytes_written = written
+    if pool is not None:
+        stats.pool_tasks, stats.pool_processes, stats.pool_busy = pool.tasks, pool.processes, pool.busy
+    else:
+        stats.pool_tasks = 0
+    return results, stats
+
+
+def _file_key(path: str) -> Optional[Tuple[int, int]]:
+    """
+    :return: size and modification time of a file, None if it is gone
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _write_status(status: dict, status_file: str) -> None:
+    """
+    Replaces the status file in one step, so that readers never see it half written
+    :param status: current status and metrics of watch mode
+    :param status_file: path of the status file
+    """
+    tmp_file = status_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_file, status_file)
+
+
+def _run_watch(roots: List[str], overwrite: bool, jobs: int, cache_path: Optional[str],
+               state: Optional[ChapterizedState], skip_unchanged: bool, settle: float,
+               poll_interval: Optional[float] = None, status_file: Optional[str] = None,
+               dry_run: bool = False, tolerance: int = 0, seek_offsets: bool = False,
+               snap: int = 0) -> List[dict]:
+    """
+    Watches directories and chapterizes mp3 files as they are added or changed, until interrupted.
+    Files already in the directories are processed first. Files are only taken once they have stopped
+    changing, and only while fewer than two per worker are in flight; the rest wait in the debouncer.
+    Changes made by the saves of this loop are ignored, so files it saved are neither processed nor counted again.
+    :param roots: directories to watch, including their subdirectories
+    :param overwrite: if True, existing chapter information is replaced
+    :param jobs: number of worker processes
+    :param cache_path: path of the metadata cache database, None to disable the cache
+    :param state: record of chapterized files to update, if any
+    :param skip_unchanged: if True, files unchanged since they were chapterized by an earlier run are skipped
+    :param settle: seconds a file has to stay unchanged before it is processed
+    :param poll_interval: if given, poll at this interval in seconds instead of using inotify
+    :param status_file: path of a JSON file kept up to date with status and metrics, if any
+    :param dry_run: if True, print what would change without writing
+    :param tolerance: difference in milliseconds up to which existing chapter times count as unchanged
+    :param seek_offsets: if True, chapters are written with byte offsets
+    :param snap: largest move of chapter starts to quiet gaps in milliseconds, 0 to leave them
+    :return: list of result records, one per processed file
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from watch import Debouncer, create_watcher
+
+    watcher = create_watcher(roots, poll_interval)
+    debouncer = Debouncer(settle)
+    for mp3_file in LibraryScanner(state if skip_unchanged else None).scan(roots):
+        debouncer.touch(str(mp3_file))
+
+    print("Watching {} with {}. Press Ctrl+C to stop.".format(', '.join(roots), watcher.kind), end='\n\n')
+
+    results = []
+    in_flight = {}  # Futures by path
+    processed = {}  # Size and modification time by path, as they were after processing
+    counts = {'chapterized': 0, 'unchanged': 0, 'dry-run': 0, 'skipped': 0, 'ignored': 0, 'failed': 0}
+    started = time.time()
+    status_written = 0.0
+
+    def update_status(force=False):
+        nonlocal status_written
+        if status_file is None or (not force and time.monotonic() - status_written < 1.0):
+            return
+        _write_status({'pid': os.getpid(), 'watcher': watcher.kind, 'started': started,
+                       'uptime': time.time() - started, 'pending': len(debouncer), 'in_flight': len(in_flight),
+                       'processed': counts, 'recent_failures': [r for r in results if r['status'] == 'failed'][-20:]},
+                      status_file)
+        status_written = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(cache_path, profiling.enabled(), profiling.cprofile_target())) as executor:
+        try:
+            while True:
+                for path, future in list(in_flight.items()):
+                    if not future.done():
+                        continue
+                    del in_flight[path]
+                    result, output, records = future.result()
+                    print(output, end='')
+                    profiling.add_records(records)
+                    _record_result(result, state)
+                    key = _file_key(path)
+                    if key is not None:
+                        processed[path] = key
+                    else:
+                        processed.pop(path, None)
+                    counts[result['status']] += 1
+                    results.append(result)
+
+                capacity = 2 * jobs - len(in_flight)
+                for path in debouncer.ready(limit=capacity, exclude=set(in_flight)) if capacity > 0 else []:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if processed.get(path) == (st.st_size, st.st_mtime_ns):
+                        continue  # Touched by a save of this loop while it was in flight
+                    if skip_unchanged and state is not None and state.unchanged(path, st):
+                        counts['unchanged'] += 1
+                        continue
+                    in_flight[path] = executor.submit(_chapterize_file_captured, Path(path), overwrite,
+                                                     dry_run, tolerance, seek_offsets, snap)
+
+                update_status()
+                for path in watcher.read(timeout=0.5):
+                    # Saves of this loop come back as changes, which are left out
+                    if path not in processed or _file_key(path) != processed[path]:
+                        debouncer.touch(path)
+        except KeyboardInterrupt:
+            print("Stopping.")
+            for future in in_flight.values():
+                future.cancel()
+        finally:
+            watcher.close()
+            update_status(force=True)
+    return results
+
+
+def _write_report(results: List[dict], report_file: str) -> None:
+    """
+    Writes per-file results as JSON
+    :param results: list of result records
+    :param report_file: path of the report to write
+    """
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump({'summary': summary, 'files': results}, f, indent=2)
+
+
+def _print_summary(results: List[dict],
+                   statuses=('chapterized', 'unchanged', 'dry-run', 'skipped', 'ignored', 'failed')) -> None:
+    failed = [result for result in results if result['status'] == 'failed']
+    counts = ', '.join('{} {}'.format(sum(1 for r in results if r['status'] == status), status)
+                       for status in statuses)
+    print("Processed {} files: {}.".format(len(results), counts))
+    for result in failed:
+        print("Failed: {} ({})".format(result['path'], result['error']))
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.description = "Adds ID3v2 chapter tags to mp3 audiobook files downloaded from Overdrive"
-    parser.add_argument('path', help='Path to audiobook directory')
+    parser.add_argument('paths', metavar='path', nargs='+', help='Path to audiobook directory')
     parser.add_argument('-o', '--overwrite', action='store_const', const=True, default=False,
                         help='Overwrite existing chapter information. Without this flag, mp3 files with '
                              'existing chapter information will be ignored')
+    parser.add_argument('-n', '--dry-run', action='store_const', const=True, default=False,
+                        help='Print how the chapters of each file would change, without writing any file')
+    parser.add_argument('-t', '--tolerance', metavar='MS', type=int, default=1,
+                        help='Existing chapters whose start and end times are within MS milliseconds of the '
+                             'markers count as unchanged, and are not rewritten. Default: %(default)s')
+    parser.add_argument('--seek-offsets', action='store_const', const=True, default=False,
+                        help='Also write the byte offset of the first and last mp3 frame of every chapter, '
+                             'so that players can seek to chapters without scanning the file. The frame '
+                             'index this needs is kept in the cache')
+    parser.add_argument('--snap', metavar='MS', type=int, default=0,
+                        help='Move every chapter start by up to MS milliseconds to the nearest quiet gap, so that '
+                             'skipping to a chapter does not cut into speech. Only the audio around the chapter '
+                             'starts is read. Ignored with --book')
+    parser.add_argument('--split', metavar='DIR',
+                        help='Instead of adding chapter tags, write every chapter of each mp3 file to a file of its '
+                             'own, in a directory named after the mp3 file under DIR. The audio is copied without '
+                             're-encoding')
+    parser.add_argument('--merge', metavar='DIR',
+                        help='Instead of adding chapter tags, join the parts of each path, taken as a multi-part '
+                             'audiobook, into one mp3 file with chapters, named after the path and written to DIR. '
+                             'The audio is copied without re-encoding')
     parser.add_argument('-s', '--select', action='store_const', const=True, default=False,
                         help='In select mode, user will be asked to select chapters for each mp3 file')
+    parser.add_argument('-b', '--book', action='store_const', const=True, default=False,
+                        help='Treat each path as one multi-part audiobook, with chapters indexed over all its parts')
+    parser.add_argument('-r', '--recursive', action='store_const', const=True, default=False,
+                        help='Look for mp3 files in all subdirectories as well, e.g. of a whole library root')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes used to parse markers, measure durations and snap '
+                             'chapters, or to chapterize files in watch mode. 0 uses all available cores. '
+                             'Ignored in select mode')
+    parser.add_argument('--reads', metavar='N', type=int, default=4,
+                        help='Number of files read at the same time. Default: %(default)s')
+    parser.add_argument('--writes', metavar='N', type=int, default=1,
+                        help='Number of files written at the same time. Keep this at 1 on spinning disks, '
+                             'where concurrent writes cause seeking. Default: %(default)s')
+    parser.add_argument('-w', '--watch', action='store_const', const=True, default=False,
+                        help='Keep running and chapterize mp3 files as they are added to the directories '
+                             'or any of their subdirectories')
+    parser.add_argument('--settle', metavar='SECONDS', type=float, default=10.0,
+                        help='In watch mode, wait until a file has not changed for SECONDS. Default: %(default)s')
+    parser.add_argument('--poll', metavar='SECONDS', type=float,
+                        help='In watch mode, look for changes every SECONDS instead of using inotify. '
+                             'Polling every 30 seconds is used anyway where inotify is unavailable')
+    parser.add_argument('--status', metavar='FILE',
+                        help='In watch mode, keep FILE up to date with status and metrics as JSON')
+    parser.add_argument('--report', metavar='FILE',
+                        help='Write per-file results and errors to FILE as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Record wall time, bytes read and written and peak memory of every stage of every file, '
+                             'write them to FILE as JSON and print a summary per stage')
+    parser.add_argument('--cprofile', metavar=('MP3', 'OUT'), nargs=2,
+                        help='Dump cProfile statistics of processing the file MP3 to OUT. Implies profiling, and '
+                             'files are processed one at a time')
+    parser.add_argument('--cache', metavar='FILE', default=str(default_cache_path()),
+                        help='Metadata cache used to skip reading unchanged files. Default: %(default)s')
+    parser.add_argument('--no-cache', action='store_const', const=True, default=False,
+                        help='Do not use the metadata cache, and do not skip files chapterized by earlier runs')
+    parser.add_argument('--rescan', action='store_const', const=True, default=False,
+                        help='Process files even if they are unchanged since they were last chapterized. '
+                             'Implied by --overwrite and --select')
 
     args = parser.parse_args()
 
-    mp3_files = _find_mp3_files(args.path)
-
-    if len(mp3_files) == 0:
-        _abort()
-
-    for mp3_file in mp3_files:
-        mp3 = _load_mp3_file(mp3_file)
-
-        if mp3 is None:
+    cache_path = None if args.no_cache else args.cache
+
+    if args.profile is not None or args.cprofile is not None:
+        profiling.enable(tuple(args.cprofile) if args.cprofile is not None else None)
+
+    statuses = ('chapterized', 'unchanged', 'dry-run', 'skipped', 'ignored', 'failed')
+    pipeline_stats = None
+
+    if args.merge is not None:
+        cache = MetadataCache(cache_path) if cache_path is not None else None
+        results = [_merge_book(path, args.merge, cache) for path in args.paths]
+        statuses = ('merged', 'failed')
+    elif args.split is not None:
+        cache = MetadataCache(cache_path) if cache_path is not None else None
+        scanner = LibraryScanner(recursive=args.recursive)
+        results = [_split_file(mp3_file, args.split, cache, dry_run=args.dry_run)
+                   for mp3_file in scanner.scan(args.paths)]
+        statuses = ('split', 'dry-run', 'skipped', 'failed')
+        if scanner.found == 0:
             _abort()
+    elif args.book:
+        cache = MetadataCache(cache_path) if cache_path is not None else None
+        results = []
+        for path in args.paths:
+            results.extend(_chapterize_book(path, overwrite=args.overwrite, cache=cache, dry_run=args.dry_run,
+                                            tolerance=args.tolerance, seek_offsets=args.seek_offsets))
+    else:
+        state = ChapterizedState(cache_path) if cache_path is not None else None
+        skip_unchanged = not (args.rescan or args.overwrite or args.select)
+        scanner = LibraryScanner(state if skip_unchanged else None, recursive=args.recursive)
+        mp3_files = scanner.scan(args.paths)
 
-        markers = _load_markers(mp3)
-
-        if markers is None:
-            _abort()
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
 
-        chapters = _parse_markers(markers)
+        if args.watch:
+            results = _run_watch(args.paths, args.overwrite, jobs, cache_path, state, skip_unchanged, args.settle,
+                                 poll_interval=args.poll, status_file=args.status, dry_run=args.dry_run,
+                                 tolerance=args.tolerance, seek_offsets=args.seek_offsets, snap=args.snap)
+        else:
+            if args.select or args.cprofile is not None:
+                results = _run_serial(mp3_files, args.overwrite, args.select, cache_path, state,
+                                      dry_run=args.dry_run, tolerance=args.tolerance,
+                                      seek_offsets=args.seek_offsets, snap=args.snap)
+            else:
+                results, pipeline_stats = _run_pipeline(mp3_files, args.overwrite, jobs, args.reads, args.writes,
+                                                        cache_path, state, dry_run=args.dry_run,
+                                                        tolerance=args.tolerance, seek_offsets=args.seek_offsets,
+                                                        snap=args.snap)
 
-        if len(chapters) == 0:
-            print("Skipping.")
-            continue
+            print("Found {} mp3 files, {} unchanged since they were chapterized.".format(scanner.found,
+                                                                                         scanner.unchanged))
+            if scanner.found == 0:
+                _abort()
 
-        mp3_duration = int(mp3.info.time_secs * 1000)  # Duration of audio file in milliseconds
-        chapters[-1].end = mp3_duration
+    _print_summary(results, statuses)
 
-        if _has_chapter_metadata(mp3):
-            print("Existing chapter information found.", end='')
+    if pipeline_stats is not None:
+        print()
+        pipeline_stats.print_summary()
 
-            if args.overwrite:
-                print(" Overwriting.", end='\n\n')
-                _remove_existing_chapter_metadata(mp3)
-                try:
-                    selected = _select_chapters(chapters) if args.select else chapters
-                    _write_chapters(mp3, selected)
-                except KeyboardInterrupt:
-                    sys.exit(0)
-                except EOFError:
-                    sys.exit(0)
+    if profiling.enabled():
+        records = profiling.take_records()
+        print()
+        profiling.print_summary(records)
+        if args.profile is not None:
+            profiling.write_report(records, args.profile)
 
-                print()
-            else:
-                print(" Ignoring.", end='\n\n')
-                continue
-        else:
-            try:
-                selected = _select_chapters(chapters) if args.select else chapters
-                _write_chapters(mp3, selected)
-            except KeyboardInterrupt:
-                sys.exit(0)
-            except EOFError:
-                sys.exit(0)
-
-        print("Saving tags: ", end='')
-        mp3.tag.save()
-        print("Succeeded.", end='\n\n')
+    if args.report is not None:
+        _write_report(results, args.report)
@@ -0,0 +1,526 @@
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from typing import Optional, Tuple
+
+# Bitrates in kbps indexed by [version is MPEG1][layer][bitrate index]
+_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+# Sample rates indexed by version bits, then sample rate index
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG1
+    2: (22050, 24000, 16000),  # MPEG2
+    0: (11025, 12000, 8000),  # MPEG2.5
+}
+
+# How far past the ID3v2 tag to look for the first frame
+_SYNC_SEARCH_LIMIT = 64 * 1024
+
+# Number of leading frames that must share a bitrate for a file without a VBR header to be taken as CBR
+_CBR_CHECK_FRAMES = 16
+
+_SCAN_BUFFER_SIZE = 1024 * 1024
+
+XING = 'xing'
+INFO = 'info'
+VBRI = 'vbri'
+CBR = 'cbr'
+SCAN = 'scan'
+
+
+class FrameHeader(object):
+    def __init__(self, version: int, layer: int, bitrate: int, sample_rate: int, padding: int, mono: bool):
+        """
+        A parsed MPEG audio frame header
+        :param version: version bits, 3 for MPEG1, 2 for MPEG2 and 0 for MPEG2.5
+        :param layer: 1, 2 or 3
+        :param bitrate: bitrate in bits per second
+        :param sample_rate: sample rate in Hz
+        :param padding: 1 if the frame has a padding slot, else 0
+        :param mono: True if the channel mode is single channel
+        """
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.mono = mono
+
+    @property
+    def samples(self) -> int:
+        """
+        Number of samples per channel in the frame
+        """
+        if self.layer == 1:
+            return 384
+        if self.layer == 3 and self.version != 3:
+            return 576
+        return 1152
+
+    @property
+    def length(self) -> int:
+        """
+        Length of the frame in bytes, including the header
+        """
+        if self.layer == 1:
+            return (12 * self.bitrate // self.sample_rate + self.padding) * 4
+        return self.samples // 8 * self.bitrate // self.sample_rate + self.padding
+
+    @property
+    def side_info_size(self) -> int:
+        if self.version == 3:
+            return 17 if self.mono else 32
+        return 9 if self.mono else 17
+
+
+def parse_frame_header(data: bytes, pos: int = 0) -> Optional[FrameHeader]:
+    """
+    Parses the 4 byte frame header at pos
+    :param data: buffer holding the header
+    :param pos: offset of the header in data
+    :return: the header if valid, else None
+    """
+    if pos + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = _BITRATES[version == 3][layer][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    return FrameHeader(version, layer, bitrate, sample_rate, (b2 >> 1) & 0x01, (b3 >> 6) == 0x03)
+
+
+class Duration(object):
+    def __init__(self, milliseconds: int, method: str, frames: Optional[int] = None,
+                 encoder_delay: int = 0, encoder_padding: int = 0):
+        """
+        Duration of an mp3 file
+        :param milliseconds: duration in milliseconds
+        :param method: how the duration was found, one of XING, INFO, VBRI, CBR or SCAN
+        :param frames: number of audio frames if known
+        :param encoder_delay: samples of encoder delay from the LAME tag, if present
+        :param encoder_padding: samples of encoder padding from the LAME tag, if present
+        """
+        self.milliseconds = milliseconds
+        self.method = method
+        self.frames = frames
+        self.encoder_delay = encoder_delay
+        self.encoder_padding = encoder_padding
+
+    def __str__(self):
+        return '{} ms ({})'.format(self.milliseconds, self.method)
+
+
+def _id3v2_size(f) -> int:
+    """
+    Size of the ID3v2 tag at the start of the file, 0 if there is none
+    """
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    footer = 10 if header[3] == 4 and header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _trailing_tags_size(f, file_size: int) -> int:
+    """
+    Size of ID3v1 and APEv2 tags at the end of the file, which are not part of the audio
+    """
+    size = 0
+    if file_size >= 128:
+        f.seek(file_size - 128)
+        if f.read(3) == b'TAG':
+            size += 128
+    if file_size - size >= 32:
+        f.seek(file_size - size - 32)
+        footer = f.read(32)
+        if footer[:8] == b'APETAGEX':
+            ape_size, ape_flags = struct.unpack('<I4xI', footer[12:24])
+            size += ape_size + (32 if ape_flags & 0x80000000 else 0)
+    return size
+
+
+def audio_range(f) -> Tuple[int, int]:
+    """
+    :param f: binary file
+    :return: offsets at which the audio of an mp3 file starts and ends, between its ID3v2 tag and any
+             ID3v1 or APEv2 tags
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    return _id3v2_size(f), file_size - _trailing_tags_size(f, file_size)
+
+
+def find_first_frame(f, start: int):
+    """
+    Finds the first frame at or after start that is followed by another valid frame header
+    :param f: binary file
+    :param start: offset to start searching at, usually the end of the ID3v2 tag
+    :return: tuple of frame offset and parsed header, or (None, None) if no frame is found
+    """
+    f.seek(start)
+    buf = f.read(_SYNC_SEARCH_LIMIT + 4096)
+    pos = buf.find(b'\xff')
+    while 0 <= pos < _SYNC_SEARCH_LIMIT:
+        header = parse_frame_header(buf, pos)
+        if header is not None:
+            next_pos = pos + header.length
+            if next_pos + 4 > len(buf) or parse_frame_header(buf, next_pos) is not None:
+                return start + pos, header
+        pos = buf.find(b'\xff', pos + 1)
+    return None, None
+
+
+def _read_vbr_header(frame: bytes, header: FrameHeader):
+    """
+    Reads a Xing/Info or VBRI header from the first frame
+    :return: tuple of method, frame count, encoder delay and encoder padding, or None if there is no usable header
+    """
+    xing_pos = 4 + header.side_info_size
+    tag_id = frame[xing_pos:xing_pos + 4]
+    if tag_id in (b'Xing', b'Info') and len(frame) >= xing_pos + 8:
+        flags = struct.unpack('>I', frame[xing_pos + 4:xing_pos + 8])[0]
+        if not flags & 0x01:
+            return None
+        frames = struct.unpack('>I', frame[xing_pos + 8:xing_pos + 12])[0]
+
+        delay = padding = 0
+        # The LAME extension directly follows the Xing fields. Its position depends on which fields are present.
+        lame_pos = xing_pos + 8 + 4 * bool(flags & 0x01) + 4 * bool(flags & 0x02) + \
+            100 * bool(flags & 0x04) + 4 * bool(flags & 0x08)
+        if frame[lame_pos:lame_pos + 4] in (b'LAME', b'Lavf', b'Lavc', b'GOGO') and len(frame) >= lame_pos + 24:
+            d0, d1, d2 = frame[lame_pos + 21:lame_pos + 24]
+            delay = (d0 << 4) | (d1 >> 4)
+            padding = ((d1 & 0x0F) << 8) | d2
+
+        return (XING if tag_id == b'Xing' else INFO), frames, delay, padding
+
+    # VBRI is always at a fixed offset of 32 bytes after the frame header
+    if frame[36:40] == b'VBRI' and len(frame) >= 54:
+        frames = struct.unpack('>I', frame[50:54])[0]
+        return VBRI, frames, 0, 0
+
+    return None
+
+
+def build_info_frame(header: bytes, frames: int, audio_size: int, vbr: bool) -> Optional[bytes]:
+    """
+    Builds a silent frame holding a Xing or Info header, which players read the exact duration from
+    :param header: 4 byte header of the first audio frame, whose format the new frame copies
+    :param frames: number of audio frames following the new frame
+    :param audio_size: size of those frames in bytes
+    :param vbr: True for a Xing header of a variable bitrate stream, False for an Info header
+    :return: the frame, None for layers other than III, which have no such header
+    """
+    data = bytearray(header[:4])
+    data[1] |= 0x01  # No CRC, so that the header directly follows the side information
+    data[2] &= 0xFD  # No padding slot
+    parsed = parse_frame_header(data)
+    if parsed is None or parsed.layer != 3:
+        return None
+
+    frame = bytearray(parsed.length)
+    frame[:4] = data
+    pos = 4 + parsed.side_info_size
+    # Flags: frame count and byte count present. The byte count includes this frame.
+    frame[pos:pos + 16] = (b'Xing' if vbr else b'Info') + struct.pack('>III', 0x03, frames, audio_size + len(frame))
+    return bytes(frame)
+
+
+def _is_constant_bitrate(f, offset: int, header: FrameHeader, audio_end: int) -> bool:
+    f.seek(offset)
+    buf = f.read(min(audio_end - offset, _CBR_CHECK_FRAMES * 2 * header.length))
+    pos = 0
+    for _ in range(_CBR_CHECK_FRAMES):
+        h = parse_frame_header(buf, pos)
+        if h is None:
+            # Running out of data is fine for very short files
+            return pos + 4 > len(buf)
+        if h.bitrate != header.bitrate:
+            return False
+        pos += h.length
+    return True
+
+
+def scan_frames(f, offset: int, audio_end: int):
+    """
+    Walks over all frame headers in the audio stream using buffered reads
+    :param f: binary file
+    :param offset: offset of the first frame
+    :param audio_end: offset at which the audio stream ends
+    :return: generator of tuples of frame offset and parsed header
+    """
+    f.seek(offset)
+    buf = b''
+    buf_start = offset
+    pos = offset
+    while pos + 4 <= audio_end:
+        if pos + 4 > buf_start + len(buf):
+            f.seek(pos)
+            buf = f.read(min(_SCAN_BUFFER_SIZE, audio_end - pos))
+            buf_start = pos
+            if len(buf) < 4:
+                break
+
+        header = parse_frame_header(buf, pos - buf_start)
+        if header is None:
+            # Lost sync, look for the next frame header
+            nxt = buf.find(b'\xff', pos - buf_start + 1)
+            pos = buf_start + nxt if nxt >= 0 else buf_start + len(buf)
+            continue
+
+        yield pos, header
+        pos += header.length
+
+
+def read_duration(filepath) -> Duration:
+    """
+    Finds the duration of an mp3 file from its Xing/Info or VBRI header, less the encoder delay and padding given by
+    a LAME tag, from the bitrate of constant bitrate files, or, if neither works, by walking over every frame header.
+    :param filepath: path to mp3 file
+    :return: the duration along with the method used to find it
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        audio_start = _id3v2_size(f)
+        audio_end = file_size - _trailing_tags_size(f, file_size)
+
+        offset, header = find_first_frame(f, audio_start)
+        if header is None:
+            return Duration(0, SCAN, frames=0)
+
+        f.seek(offset)
+        first_frame = f.read(header.length)
+        vbr_header = _read_vbr_header(first_frame, header)
+        if vbr_header is not None:
+            method, frames, delay, padding = vbr_header
+            # Players leave out the samples the encoder added at either end
+            samples = max(0, frames * header.samples - delay - padding)
+            milliseconds = samples * 1000 // header.sample_rate
+            return Duration(milliseconds, method, frames=frames, encoder_delay=delay, encoder_padding=padding)
+
+        if _is_constant_bitrate(f, offset, header, audio_end):
+            milliseconds = (audio_end - offset) * 8 * 1000 // header.bitrate
+            return Duration(milliseconds, CBR)
+
+        samples = 0
+        frames = 0
+        sample_rate = header.sample_rate
+        for _, h in scan_frames(f, offset, audio_end):
+            samples += h.samples
+            frames += 1
+        return Duration(samples * 1000 // sample_rate, SCAN, frames=frames)
+
+
+class AudioStream(object):
+    def __init__(self, start: int, end: int, header: FrameHeader, header_bytes: bytes, frames: int, vbr: bool):
+        """
+        Where the audio frames of an mp3 file are, without its tags and any Xing/Info or VBRI header frame
+        :param start: offset of the first audio frame
+        :param end: offset at which the audio ends
+        :param header: parsed header of the first audio frame
+        :param header_bytes: the 4 bytes of that header
+        :param frames: number of audio frames
+        :param vbr: True if the frames do not all have the same bitrate
+        """
+        self.start = start
+        self.end = end
+        self.header = header
+        self.header_bytes = header_bytes
+        self.frames = frames
+        self.vbr = vbr
+
+    @property
+    def samples(self) -> int:
+        return self.frames * self.header.samples
+
+
+def read_audio_stream(filepath) -> Optional[AudioStream]:
+    """
+    Locates the audio frames of an mp3 file. The frame count is taken from the Xing/Info or VBRI header
+    where there is one, and otherwise counted in a pass over the frame headers, which keeps nothing
+    but the count in memory.
+    :param filepath: path to mp3 file
+    :return: the audio stream, None if the file has no audio frames
+    """
+    with open(filepath, 'rb') as f:
+        audio_start, audio_end = audio_range(f)
+        offset, header = find_first_frame(f, audio_start)
+        if header is None:
+            return None
+
+        f.seek(offset)
+        vbr_header = _read_vbr_header(f.read(header.length), header)
+        if vbr_header is not None:
+            method, frames, _, _ = vbr_header
+            offset += header.length
+            vbr = method != INFO
+        else:
+            frames = sum(1 for _ in scan_frames(f, offset, audio_end))
+            vbr = not _is_constant_bitrate(f, offset, header, audio_end)
+
+        f.seek(offset)
+        header_bytes = f.read(4)
+        first = parse_frame_header(header_bytes)
+        if first is None:
+            return None
+    return AudioStream(offset, audio_end, first, header_bytes, frames, vbr)
+
+
+class SeekIndex(object):
+    """
+    Byte offset of every audio frame of an mp3 file, for mapping times to positions in the stream.
+    Offsets are relative to the end of the ID3v2 tag, so that they stay valid when only the tag changes.
+    All frames of a stream hold the same number of samples, so a time maps to a frame by arithmetic and
+    a byte offset maps to a frame by binary search.
+    """
+
+    # Serialised form: magic, array typecode, sample rate, samples per frame, audio size, then the offsets
+    _HEADER = struct.Struct('<4scIIQ')
+    _MAGIC = b'MPSI'
+
+    def __init__(self, offsets: array, audio_size: int, sample_rate: int, samples_per_frame: int):
+        """
+        :param offsets: offsets of the audio frames, in order
+        :param audio_size: offset at which the audio stream ends, after the last frame
+        :param sample_rate: sample rate in Hz
+        :param samples_per_frame: number of samples per channel in every frame
+        """
+        self._offsets = offsets
+        self.audio_size = audio_size
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def duration(self) -> int:
+        """
+        Duration of the indexed frames in milliseconds
+        """
+        return len(self._offsets) * self.samples_per_frame * 1000 // self.sample_rate
+
+    def frame_at(self, milliseconds: int) -> int:
+        """
+        :param milliseconds: time from the start of the audio
+        :return: number of the frame playing at that time, len(self) at or past the end
+        """
+        frame = milliseconds * self.sample_rate // (1000 * self.samples_per_frame)
+        return min(max(frame, 0), len(self._offsets))
+
+    def nearest_frame(self, milliseconds: int) -> int:
+        """
+        :param milliseconds: time from the start of the audio
+        :return: number of the frame whose start is closest to that time, len(self) for the end of the audio
+        """
+        frame = (2 * milliseconds * self.sample_rate + 1000 * self.samples_per_frame) // \
+            (2000 * self.samples_per_frame)
+        return min(max(frame, 0), len(self._offsets))
+
+    def time_at(self, frame: int) -> int:
+        """
+        :param frame: frame number
+        :return: first whole millisecond within the frame, so that frame_at(time_at(frame)) == frame
+        """
+        return -(-frame * self.samples_per_frame * 1000 // self.sample_rate)
+
+    def offset_of(self, frame: int) -> int:
+        """
+        :param frame: frame number, len(self) for the end of the audio
+        :return: offset of the frame header
+        """
+        return self._offsets[frame] if frame < len(self._offsets) else self.audio_size
+
+    def offset_at(self, milliseconds: int) -> int:
+        """
+        :param milliseconds: time from the start of the audio
+        :return: offset of the frame playing at that time, the end of the audio at or past the end
+        """
+        return self.offset_of(self.frame_at(milliseconds))
+
+    def frame_at_offset(self, offset: int) -> Optional[int]:
+        """
+        :param offset: byte offset relative to the end of the ID3v2 tag
+        :return: number of the frame containing the offset, None if it lies before the first frame
+        """
+        frame = bisect_right(self._offsets, offset) - 1
+        return frame if frame >= 0 else None
+
+    @property
+    def memory_usage(self) -> int:
+        """
+        Approximate memory held by the index in bytes
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self._offsets)
+
+    def to_bytes(self) -> bytes:
+        offsets = array(self._offsets.typecode, self._offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return self._HEADER.pack(self._MAGIC, self._offsets.typecode.encode('ascii'), self.sample_rate,
+                                 self.samples_per_frame, self.audio_size) + offsets.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        :param data: an index serialised by to_bytes
+        :return: the index, or None if data is not a serialised index
+        """
+        if len(data) < cls._HEADER.size or data[:4] != cls._MAGIC:
+            return None
+        _, typecode, sample_rate, samples_per_frame, audio_size = cls._HEADER.unpack_from(data)
+        offsets = array(typecode.decode('ascii'))
+        offsets.frombytes(data[cls._HEADER.size:])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return cls(offsets, audio_size, sample_rate, samples_per_frame)
+
+
+def build_seek_index(filepath) -> Optional[SeekIndex]:
+    """
+    Builds the seek index of an mp3 file in one buffered pass over its frame headers. A Xing/Info or VBRI
+    header frame holds no audio and is left out, so frame 0 is the first frame that plays.
+    :param filepath: path to mp3 file
+    :return: the index, None if the file has no audio frames
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        audio_start = _id3v2_size(f)
+        audio_end = file_size - _trailing_tags_size(f, file_size)
+
+        offset, header = find_first_frame(f, audio_start)
+        if header is None:
+            return None
+        f.seek(offset)
+        if _read_vbr_header(f.read(header.length), header) is not None:
+            offset += header.length
+
+        # 4 byte offsets take half the memory and cover all but the largest files
+        offsets = array('I' if audio_end - audio_start < 1 << 32 and array('I').itemsize == 4 else 'Q')
+        for pos, _ in scan_frames(f, offset, audio_end):
+            offsets.append(pos - audio_start)
+
+    return SeekIndex(offsets, audio_end - audio_start, header.sample_rate, header.samples)
@@ -0,0 +1,148 @@
+import re
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import fileio
+import id3tag
+import profiling
+from cache import MetadataCache
+from chapter import ChapterList
+from duration import CBR, INFO, SeekIndex, audio_range, build_info_frame, build_seek_index, read_audio_stream, \
+    read_duration
+from timestamp import Timestamp
+
+# Frames of the source tag carried over to every file split from it
+_SPLIT_TEXT_FRAMES = (b'TALB', b'TPE1')
+
+# Frames of the tag of the first part carried over to a merged book
+_MERGE_TEXT_FRAMES = (b'TALB', b'TPE1', b'TPE2', b'TCOM', b'TCON', b'TPUB')
+
+# Characters that are not allowed in file names on common filesystems
+_UNSAFE_FILENAME = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+def _filename(track: int, tracks: int, title: str) -> str:
+    title = _UNSAFE_FILENAME.sub('_', title).strip(' .') or 'Chapter'
+    return '{:0{}d} {}.mp3'.format(track, len(str(tracks)), title)
+
+
+def split_chapters(filepath, chapters: ChapterList, out_dir, seek_index: Optional[SeekIndex] = None,
+                   dry_run: bool = False) -> List[Tuple[Path, int]]:
+    """
+    Writes every chapter of an mp3 file to a file of its own, cut at the frame boundaries nearest to the
+    chapter start and end times. The frames are copied inside the kernel, without decoding. Every file
+    starts with a small tag holding the chapter title, the track number and the album and artist of the
+    source, followed by an Info/Xing frame with its exact length. As frames are not decoded, the first
+    frame of a chapter may depend on the bit reservoir of the frame before it and play as a short glitch.
+    :param filepath: path to mp3 file
+    :param chapters: chapters to write, chapters shorter than one frame are left out
+    :param out_dir: directory to write the files to, created if missing
+    :param seek_index: seek index of the file, built if not given
+    :param dry_run: if True, only work out the files that would be written
+    :return: path and size in bytes of every file written
+    """
+    if seek_index is None:
+        with profiling.stage('seek_index', filepath):
+            seek_index = build_seek_index(filepath)
+    if seek_index is None:
+        raise ValueError("No mp3 frames found in {}".format(filepath))
+
+    source = id3tag.read_tag(filepath, decode=_SPLIT_TEXT_FRAMES + (b'TIT2',))
+    album = source.text_frames.get(b'TALB', source.text_frames.get(b'TIT2'))
+    vbr = read_duration(filepath).method not in (CBR, INFO)
+
+    ranges = []
+    for title, start, end in chapters.iter_milliseconds():
+        first, last = seek_index.nearest_frame(start), seek_index.nearest_frame(end)
+        if last > first:
+            ranges.append((title, first, last))
+
+    out_dir = Path(out_dir)
+    if not dry_run:
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    written = []
+    with open(filepath, 'rb') as src:
+        audio_start, _ = audio_range(src)
+        src.seek(audio_start + seek_index.offset_of(0))
+        header_bytes = src.read(4)
+
+        for track, (title, first, last) in enumerate(ranges, start=1):
+            path = out_dir / _filename(track, len(ranges), title)
+            offset = seek_index.offset_of(first)
+            count = seek_index.offset_of(last) - offset
+
+            text_frames = {b'TIT2': title, b'TRCK': '{}/{}'.format(track, len(ranges))}
+            if album is not None:
+                text_frames[b'TALB'] = album
+            if b'TPE1' in source.text_frames:
+                text_frames[b'TPE1'] = source.text_frames[b'TPE1']
+            tag = id3tag.render_tag(text_frames)
+            info = build_info_frame(header_bytes, last - first, count, vbr) or b''
+
+            if dry_run:
+                written.append((path, len(tag) + len(info) + count))
+                continue
+            with profiling.stage('split', path), fileio.atomic_replace(path) as dst:
+                dst.write(tag)
+                dst.write(info)
+                fileio.copy_exact(src, dst, audio_start + offset, count)
+                written.append((path, dst.tell()))
+    return written
+
+
+def merge_book(directory, out_path, cache: Optional[MetadataCache] = None,
+               padding: int = id3tag.DEFAULT_PADDING) -> Tuple[int, int]:
+    """
+    Joins the parts of a multi-part audiobook, e.g. Part01.mp3 to PartNN.mp3, into one mp3 file with a
+    chapter for every chapter of the book. The tags and any Xing/Info or VBRI header frames of the parts
+    are left out and the audio frames are copied inside the kernel, one part after the other, so memory
+    use does not depend on the size of the book. The merged file starts with a new Info/Xing frame
+    counting all frames, so that its duration is exact.
+    :param directory: directory holding the parts
+    :param out_path: path of the merged file, which should not be in directory
+    :param cache: metadata cache used when loading the parts, if any
+    :param padding: padding reserved in the tag for later edits
+    :return: number of chapters and number of bytes written
+    :raises ValueError: if the directory holds no mp3 files, or if the parts differ in format
+    """
+    from audiobook import Audiobook
+
+    book = Audiobook(directory, cache=cache)
+    if len(book.parts) == 0:
+        raise ValueError("No mp3 files found in {}".format(directory))
+
+    with profiling.stage('merge_scan', directory):
+        streams = [read_audio_stream(part.path) for part in book.parts]
+    for part, stream in zip(book.parts, streams):
+        if stream is None:
+            raise ValueError("No mp3 frames found in {}".format(part.path))
+        h, first = stream.header, streams[0].header
+        if (h.version, h.layer, h.sample_rate, h.mono) != (first.version, first.layer, first.sample_rate, first.mono):
+            raise ValueError("{} differs in format from {}".format(part.path.name, book.parts[0].path.name))
+
+    frames = sum(stream.frames for stream in streams)
+    audio_size = sum(stream.end - stream.start for stream in streams)
+    vbr = any(stream.vbr for stream in streams) or len(set(stream.header.bitrate for stream in streams)) > 1
+    info = build_info_frame(streams[0].header_bytes, frames, audio_size, vbr) or b''
+
+    # The book is as long as the frames copied, which may differ slightly from the sum of the part durations
+    chapters = book.chapters[:]
+    if len(chapters) > 0:
+        duration = frames * streams[0].header.samples * 1000 // streams[0].header.sample_rate
+        chapters.set_end(len(chapters) - 1, Timestamp.from_milliseconds(duration))
+
+    source = id3tag.read_tag(book.parts[0].path, decode=_MERGE_TEXT_FRAMES + (b'TIT2',))
+    text_frames = {b'TIT2': source.text_frames.get(b'TALB', source.text_frames.get(b'TIT2', book.directory.name))}
+    text_frames.update((frame_id, source.text_frames[frame_id]) for frame_id in _MERGE_TEXT_FRAMES
+                       if frame_id in source.text_frames)
+    tag = id3tag.render_tag(text_frames, padding=padding, chapters=chapters)
+
+    with fileio.atomic_replace(out_path) as dst:
+        dst.write(tag)
+        dst.write(info)
+        for part, stream in zip(book.parts, streams):
+            with profiling.stage('merge', part.path), open(part.path, 'rb') as src:
+                fileio.copy_exact(src, dst, stream.start, stream.end - stream.start)
+        written = dst.tell()
+    return len(chapters), written
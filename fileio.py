@@ -0,0 +1,136 @@
+import os
+from contextlib import contextmanager
+
+import profiling
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Largest count passed to a single copy_file_range or sendfile call
+_CHUNK_SIZE = 1 << 30
+
+
+def copy_range(src, dst, offset: int, count: int) -> int:
+    """
+    Copies bytes from one file to the current position of another inside the kernel, with copy_file_range
+    where available (which may share blocks on copy-on-write filesystems), then sendfile, then plain reads
+    and writes, each carrying on from where the one before stopped
+    :param src: file object to copy from
+    :param dst: file object to copy to, flushed first
+    :param offset: position in src to copy from
+    :param count: number of bytes to copy, fewer are copied if src ends first
+    :return: number of bytes copied
+    """
+    dst.flush()
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    copied = 0
+
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        counters = profiling.io_snapshot()
+        start = copied
+        try:
+            while copied < count:
+                if name == 'copy_file_range':
+                    n = func(src_fd, dst_fd, min(count - copied, _CHUNK_SIZE), offset + copied)
+                else:
+                    n = func(dst_fd, src_fd, offset + copied, min(count - copied, _CHUNK_SIZE))
+                if n == 0:
+                    # The end of src, or a call that copies nothing between these files on some filesystems
+                    # and kernels, so the next method carries on from here
+                    break
+                copied += n
+        except OSError:
+            # Not supported between these files, e.g. across filesystems on older kernels
+            pass
+        profiling.add_copied(copied - start, counters)
+        # The descriptor moved without the file object, so its buffered position has to be resynchronised
+        dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+        if copied == count:
+            return copied
+
+    src.seek(offset + copied)
+    while copied < count:
+        chunk = src.read(min(count - copied, _COPY_BUFFER_SIZE))
+        if len(chunk) == 0:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def copy_exact(src, dst, offset: int, count: int) -> None:
+    """
+    Copies bytes like copy_range, for callers that would otherwise produce a truncated file
+    :raises IOError: if src ended, or changed, before count bytes were copied
+    """
+    copied = copy_range(src, dst, offset, count)
+    if copied != count:
+        raise IOError("Copied {} of {} bytes from {}".format(copied, count, getattr(src, 'name', 'the file')))
+
+
+def fsync_path(filepath) -> None:
+    """
+    Flushes a file to disk by path, e.g. after a library replaced it behind an open file object
+    """
+    fd = os.open(str(filepath), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(directory) -> None:
+    """
+    Makes a rename in a directory durable. Does nothing where directories cannot be opened.
+    """
+    try:
+        fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_replace(filepath, copy_original: bool = False):
+    """
+    Builds the new content of a file in a temporary file in the same directory, then renames it over the
+    original. If anything fails, or the process dies, the original is left untouched:
+
+        with atomic_replace(path) as f:
+            f.write(...)
+
+    :param filepath: file to replace, which need not exist yet
+    :param copy_original: if True, the temporary file starts as a copy of the original, e.g. for libraries
+                          that edit a file by name
+    :return: a context manager giving the temporary file, opened for reading and writing
+    """
+    import shutil
+    import tempfile
+
+    dirname, basename = os.path.split(os.path.abspath(filepath))
+    tmp = tempfile.NamedTemporaryFile(dir=dirname, prefix='.' + basename, suffix='.tmp', delete=False)
+    try:
+        with tmp:
+            if copy_original:
+                with open(filepath, 'rb') as src:
+                    copy_exact(src, tmp, 0, os.fstat(src.fileno()).st_size)
+                tmp.flush()
+            yield tmp
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmp.name)
+        os.replace(tmp.name, filepath)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+    fsync_directory(dirname)
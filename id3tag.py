@@ -0,0 +1,644 @@
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional, Tuple, Union
+
+import fileio
+import profiling
+from chapter import Chapter, ChapterList
+from duration import SeekIndex
+from timestamp import Timestamp
+
+MEDIA_MARKERS = 'OverDrive MediaMarkers'
+
+_HEADER_SIZE = 10
+
+# Frame format flags, per tag major version
+_FRAME_COMPRESSED = {3: 0x0080, 4: 0x0008}
+_FRAME_ENCRYPTED = {3: 0x0040, 4: 0x0004}
+_FRAME_GROUPED = {3: 0x0020, 4: 0x0040}
+_FRAME_UNSYNCHRONISED = {3: 0x0000, 4: 0x0002}
+_FRAME_DATA_LENGTH = {3: 0x0000, 4: 0x0001}
+
+# Frames that are decoded by this reader. All others are only walked over.
+_DECODED_FRAMES = (b'TXXX', b'CHAP', b'CTOC', b'TIT2')
+
+_TEXT_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+# Padding reserved when a tag has to be written from scratch or grown, so that
+# later chapter edits can be saved in place without rewriting the audio.
+DEFAULT_PADDING = 16 * 1024
+
+TOC_ELEMENT_ID = b'toc'
+
+# Byte offset of a CHAP frame telling players to use the start and end times instead
+_NO_OFFSET = 0xFFFFFFFF
+
+
+class UnsupportedTagError(Exception):
+    """
+    Raised when a tag uses a feature this reader does not handle, e.g. ID3v2.2 or unsynchronisation
+    """
+    pass
+
+
+class Frame(object):
+    __slots__ = ('id', 'offset', 'size', 'flags')
+
+    def __init__(self, frame_id: bytes, offset: int, size: int, flags: int):
+        """
+        Location of a raw ID3v2 frame. The body itself is not kept, see FrameIndex.body.
+        :param frame_id: four character frame id, e.g. b'CHAP'
+        :param offset: offset of the frame header from the start of the file
+        :param size: size of the frame body in bytes, excluding the frame header
+        :param flags: frame format and status flags
+        """
+        self.id = frame_id
+        self.offset = offset
+        self.size = size
+        self.flags = flags
+
+
+class ChapterFrame(object):
+    def __init__(self, element_id: bytes, start: int, end: int, title: Optional[str]):
+        self.element_id = element_id
+        self.start = start
+        self.end = end
+        self.title = title
+
+
+class TocFrame(object):
+    def __init__(self, element_id: bytes, toplevel: bool, ordered: bool, child_ids: List[bytes]):
+        self.element_id = element_id
+        self.toplevel = toplevel
+        self.ordered = ordered
+        self.child_ids = child_ids
+
+
+class Tag(object):
+    def __init__(self, version=None, size: int = 0, frames: Optional[List[Frame]] = None, flags: int = 0):
+        """
+        The parts of an ID3v2 tag needed for chapterizing
+        :param version: (major, revision) of the tag, None if the file has no ID3v2 tag
+        :param size: total size of the tag in bytes including header and padding, 0 if there is no tag
+        :param frames: raw frames in the tag, None if the tag was read through eyed3
+        :param flags: tag header flags
+        """
+        self.version = version
+        self.size = size
+        self.frames = frames
+        self.flags = flags
+        self.user_text_frames = {}  # type: Dict[str, str]
+        self.text_frames = {}  # type: Dict[bytes, str]
+        self.chapter_frames = {}  # type: Dict[bytes, ChapterFrame]
+        self.toc_frames = []  # type: List[TocFrame]
+
+    @property
+    def media_markers(self) -> Optional[str]:
+        """
+        XML text of the 'OverDrive MediaMarkers' user text frame
+        :return: XML formatted markers if present, else None
+        """
+        return self.user_text_frames.get(MEDIA_MARKERS)
+
+    @property
+    def has_chapters(self) -> bool:
+        if self.frames is not None:
+            return any(frame.id in (b'CHAP', b'CTOC') for frame in self.frames)
+        return len(self.toc_frames) > 0 or len(self.chapter_frames) > 0
+
+    @property
+    def chapters(self) -> List[Chapter]:
+        """
+        Chapters listed by the top-level table of contents, in order
+        :return: list of chapters
+        """
+        chapters = []
+        for toc in self.toc_frames:
+            if toc.toplevel:
+                for ch_eid in toc.child_ids:
+                    ch = self.chapter_frames.get(ch_eid)
+                    if ch is None:
+                        continue
+                    start, end = map(Timestamp.from_milliseconds, (ch.start, ch.end))
+                    chapters.append(Chapter(ch.title, start=start, end=end))
+        return chapters
+
+
+def _syncsafe(data: bytes) -> int:
+    b0, b1, b2, b3 = data
+    return (b0 << 21) | (b1 << 14) | (b2 << 7) | b3
+
+
+def _split_terminated(data: bytes, encoding: int):
+    """
+    Splits data at the first string terminator for the given text encoding
+    :return: tuple of the bytes before the terminator and the bytes after it
+    """
+    if encoding in (1, 2):
+        idx = 0
+        while True:
+            idx = data.find(b'\x00\x00', idx)
+            if idx < 0:
+                return data, b''
+            if idx % 2 == 0:
+                return data[:idx], data[idx + 2:]
+            idx += 1
+    idx = data.find(b'\x00')
+    if idx < 0:
+        return data, b''
+    return data[:idx], data[idx + 1:]
+
+
+def _decode_text(data: bytes, encoding: int) -> str:
+    if encoding not in _TEXT_ENCODINGS:
+        raise UnsupportedTagError("Unknown text encoding {}".format(encoding))
+    # Only the first of multiple null separated values is used
+    text, _ = _split_terminated(data, encoding)
+    return text.decode(_TEXT_ENCODINGS[encoding], errors='replace')
+
+
+def _parse_txxx(data: bytes):
+    encoding = data[0]
+    description, value = _split_terminated(data[1:], encoding)
+    if encoding not in _TEXT_ENCODINGS:
+        raise UnsupportedTagError("Unknown text encoding {}".format(encoding))
+    return description.decode(_TEXT_ENCODINGS[encoding], errors='replace'), _decode_text(value, encoding)
+
+
+def _parse_chap(data: bytes, major: int) -> ChapterFrame:
+    element_id, rest = _split_terminated(data, 0)
+    start, end, _, _ = struct.unpack('>IIII', rest[:16])
+    title = None
+    for sub, body in _iter_frames(rest[16:], major, 0):
+        if sub.id == b'TIT2':
+            payload = _strip_payload(sub.id, sub.flags, body, major)
+            if len(payload) > 0:
+                title = _decode_text(payload[1:], payload[0])
+    return ChapterFrame(element_id, start, end, title)
+
+
+def _parse_ctoc(data: bytes) -> TocFrame:
+    element_id, rest = _split_terminated(data, 0)
+    flags, count = rest[0], rest[1]
+    rest = rest[2:]
+    child_ids = []
+    for _ in range(count):
+        child_id, rest = _split_terminated(rest, 0)
+        child_ids.append(child_id)
+    return TocFrame(element_id, toplevel=bool(flags & 0x02), ordered=bool(flags & 0x01), child_ids=child_ids)
+
+
+def _strip_payload(frame_id: bytes, flags: int, body, major: int):
+    """
+    Removes the grouping and data length prefixes from the body of a frame that is decoded here
+    :raises UnsupportedTagError: if the frame is compressed, encrypted or unsynchronised
+    """
+    if flags & (_FRAME_COMPRESSED[major] | _FRAME_ENCRYPTED[major] | _FRAME_UNSYNCHRONISED[major]):
+        raise UnsupportedTagError("Frame {!r} is compressed, encrypted or unsynchronised".format(frame_id))
+    if flags & _FRAME_GROUPED[major]:
+        body = body[1:]
+    if flags & _FRAME_DATA_LENGTH[major]:
+        body = body[4:]
+    return body
+
+
+def _iter_frames(data, major: int, base_offset: int):
+    """
+    Walks over the frames in data, stopping at padding
+    :param data: tag body, or the sub-frames area of a CHAP/CTOC frame, as bytes or a memoryview
+    :param major: tag major version
+    :param base_offset: file offset of data, used to record frame offsets
+    :return: generator of tuples of the frame and its body, a slice of data
+    """
+    pos = 0
+    end = len(data)
+    while pos + _HEADER_SIZE <= end:
+        frame_id = bytes(data[pos:pos + 4])
+        if frame_id[0] == 0:
+            break  # padding
+        if not all(48 <= c <= 57 or 65 <= c <= 90 for c in frame_id):
+            raise UnsupportedTagError("Invalid frame id {!r} at offset {}".format(frame_id, base_offset + pos))
+
+        size_bytes = bytes(data[pos + 4:pos + 8])
+        size = _syncsafe(size_bytes) if major == 4 else struct.unpack('>I', size_bytes)[0]
+        flags = (data[pos + 8] << 8) | data[pos + 9]
+        body_start = pos + _HEADER_SIZE
+        if body_start + size > end:
+            raise UnsupportedTagError("Frame {!r} overruns the tag".format(frame_id))
+
+        yield Frame(frame_id, base_offset + pos, size, flags), data[body_start:body_start + size]
+        pos = body_start + size
+
+
+class FrameIndex(object):
+    def __init__(self, f):
+        """
+        Finds every frame of the ID3v2 tag at the start of a file through a read-only memory map, without
+        copying frame bodies. Bodies are handed out as memoryview slices of the map, so that large frames
+        such as cover art are never read unless asked for. The index has to be closed, or used as a
+        context manager, and slices must not be used after that.
+        :param f: file opened for reading in binary mode
+        :raises UnsupportedTagError: if the tag uses features not handled here
+        """
+        self.version = None
+        self.size = 0
+        self.flags = 0
+        self.frames = []  # type: List[Frame]
+        self._map = None
+        self._view = None
+
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return  # Empty files cannot be mapped, and have no tag anyway
+        self._view = memoryview(self._map)
+        try:
+            self._index()
+        except BaseException:
+            self.close()
+            raise
+
+    def _index(self) -> None:
+        header = bytes(self._view[:_HEADER_SIZE])
+        if len(header) < _HEADER_SIZE or header[:3] != b'ID3':
+            return
+
+        major, revision, flags = header[3], header[4], header[5]
+        if major not in (3, 4):
+            raise UnsupportedTagError("ID3v2.{} is not supported".format(major))
+        if flags & 0x80:
+            raise UnsupportedTagError("Unsynchronised tags are not supported")
+        if major == 4 and flags & 0x10:
+            raise UnsupportedTagError("Tags with a footer are not supported")
+
+        size = _syncsafe(header[6:10])
+        if _HEADER_SIZE + size > len(self._view):
+            raise UnsupportedTagError("Tag is truncated")
+
+        frames_start = _HEADER_SIZE
+        if flags & 0x40:
+            extended = bytes(self._view[_HEADER_SIZE:_HEADER_SIZE + 4])
+            if major == 4:
+                frames_start += _syncsafe(extended)
+            else:
+                frames_start += struct.unpack('>I', extended)[0] + 4
+
+        self.version = (major, revision)
+        self.size = _HEADER_SIZE + size
+        self.flags = flags
+        # Reads of the map are not seen by the I/O counters
+        profiling.add_io(read=self.size)
+        body = self._view[frames_start:self.size]
+        try:
+            self.frames = [frame for frame, _ in _iter_frames(body, major, frames_start)]
+        finally:
+            body.release()
+
+    def find(self, frame_id: bytes) -> List[Frame]:
+        """
+        :return: frames with the given id, in tag order
+        """
+        return [frame for frame in self.frames if frame.id == frame_id]
+
+    def body(self, frame: Frame) -> memoryview:
+        """
+        :return: the body of a frame, as a slice of the map
+        """
+        start = frame.offset + _HEADER_SIZE
+        return self._view[start:start + frame.size]
+
+    def payload(self, frame: Frame) -> memoryview:
+        """
+        :return: the body of a frame without grouping and data length prefixes
+        :raises UnsupportedTagError: if the frame is compressed, encrypted or unsynchronised
+        """
+        return _strip_payload(frame.id, frame.flags, self.body(frame), self.version[0])
+
+    def close(self) -> None:
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # A slice is still referenced somewhere, the map is closed once it is collected
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _tag_from_index(index: FrameIndex, decode=_DECODED_FRAMES) -> Tag:
+    """
+    Builds a Tag, decoding only the frames that are asked for
+    :param index: frames of the tag
+    :param decode: ids of the frames to decode, any of b'TXXX', b'CHAP', b'CTOC' and text frames such as b'TIT2'
+    :return: the tag
+    """
+    if index.version is None:
+        return Tag(frames=[])
+
+    major = index.version[0]
+    tag = Tag(version=index.version, size=index.size, frames=index.frames, flags=index.flags)
+    for frame in index.frames:
+        if frame.id not in decode:
+            continue
+        payload = bytes(index.payload(frame))
+        if frame.id == b'TXXX':
+            description, value = _parse_txxx(payload)
+            tag.user_text_frames[description] = value
+        elif frame.id == b'CHAP':
+            ch = _parse_chap(payload, major)
+            tag.chapter_frames[ch.element_id] = ch
+        elif frame.id == b'CTOC':
+            tag.toc_frames.append(_parse_ctoc(payload))
+        elif frame.id[:1] == b'T' and len(payload) > 0:
+            tag.text_frames[frame.id] = _decode_text(payload[1:], payload[0])
+    return tag
+
+
+def _read_eyed3(filepath) -> Tag:
+    import eyed3  # Only needed for the tags that cannot be read here
+
+    mp3 = eyed3.load(filepath)
+    if mp3 is None or mp3.tag is None:
+        return Tag()
+
+    tag = Tag(version=mp3.tag.version[1:], size=mp3.tag.header.tag_size)
+    for frame in mp3.tag.user_text_frames:
+        tag.user_text_frames[frame.description] = frame.text
+    for ch in mp3.tag.chapters:
+        start, end = ch.times
+        tag.chapter_frames[ch.element_id] = ChapterFrame(ch.element_id, start, end, ch.title)
+    for toc in mp3.tag.table_of_contents:
+        tag.toc_frames.append(TocFrame(toc.element_id, toc.toplevel, toc.ordered, list(toc.child_ids)))
+    return tag
+
+
+def read_tag(filepath, decode=_DECODED_FRAMES) -> Tag:
+    """
+    Reads the ID3v2 tag at the start of an mp3 file without looking at the audio stream.
+    Tags using features not handled here are read through eyed3 instead.
+    :param filepath: path to mp3 file
+    :param decode: ids of the frames to decode, any of b'TXXX', b'CHAP', b'CTOC' and text frames such as b'TIT2'.
+                   Other frames are only located.
+    :return: the tag, which is empty if the file has no ID3v2 tag
+    """
+    try:
+        with open(filepath, 'rb') as f, FrameIndex(f) as index:
+            return _tag_from_index(index, decode)
+    except (UnsupportedTagError, struct.error, IndexError):
+        pass
+    return _read_eyed3(filepath)
+
+
+def _encode_size(size: int, major: int) -> bytes:
+    if major == 4:
+        return bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return struct.pack('>I', size)
+
+
+def _render_frame(frame_id: bytes, body: bytes, major: int, flags: int = 0) -> bytes:
+    return frame_id + _encode_size(len(body), major) + struct.pack('>H', flags) + body
+
+
+def _render_text(text: str, major: int) -> bytes:
+    """
+    Encodes text with a leading encoding byte, using latin-1 where possible
+    """
+    try:
+        return b'\x00' + text.encode('latin-1')
+    except UnicodeEncodeError:
+        if major == 4:
+            return b'\x03' + text.encode('utf-8')
+        return b'\x01' + text.encode('utf-16')
+
+
+def _render_chap(element_id: bytes, title: Optional[str], start: int, end: int, major: int,
+                 start_offset: int = _NO_OFFSET, end_offset: int = _NO_OFFSET) -> bytes:
+    body = element_id + b'\x00' + struct.pack('>IIII', start, end, start_offset, end_offset)
+    if title is not None:
+        body += _render_frame(b'TIT2', _render_text(title, major), major)
+    return _render_frame(b'CHAP', body, major)
+
+
+def _render_ctoc(element_id: bytes, child_ids: List[bytes], major: int, description: str) -> bytes:
+    body = element_id + b'\x00' + bytes([0x03, len(child_ids)])  # top-level, ordered
+    body += b''.join(child_id + b'\x00' for child_id in child_ids)
+    body += _render_frame(b'TIT2', _render_text(description, major), major)
+    return _render_frame(b'CTOC', body, major)
+
+
+def layout_frames(tag: Tag, chapters: ChapterList,
+                  offsets: Optional[List[Tuple[int, int]]] = None) -> List[Union[bytes, Tuple[int, int]]]:
+    """
+    Lays out the frames of tag, with its CTOC/CHAP frames replaced by chapters. Other frames, such as cover
+    art, are kept as byte ranges of the file, so that they are copied unchanged without being read or decoded.
+    :param tag: the tag as read from the file
+    :param chapters: chapters to write, an empty list removes all chapter frames
+    :param offsets: byte offsets of the start and end of every chapter from the start of the file, if known.
+                    They do not change the size of the frames.
+    :return: frames area of the new tag, without header or padding, as rendered bytes and (offset, size) ranges
+             of the file, adjacent ranges merged
+    """
+    major = tag.version[0] if tag.version is not None else 4
+    layout = []
+    for frame in tag.frames:
+        if frame.id in (b'CHAP', b'CTOC'):
+            continue
+        if len(layout) > 0 and sum(layout[-1]) == frame.offset:
+            layout[-1] = (layout[-1][0], layout[-1][1] + _HEADER_SIZE + frame.size)
+        else:
+            layout.append((frame.offset, _HEADER_SIZE + frame.size))
+    rendered = _render_chapters(chapters, major, offsets)
+    if len(rendered) > 0:
+        layout.append(rendered)
+    return layout
+
+
+def _layout_size(layout: List[Union[bytes, Tuple[int, int]]]) -> int:
+    return sum(len(item) if isinstance(item, bytes) else item[1] for item in layout)
+
+
+def _render_chapters(chapters: ChapterList, major: int, offsets: Optional[List[Tuple[int, int]]] = None) -> bytes:
+    """
+    Renders a top-level CTOC frame and a CHAP frame per chapter, nothing if there are no chapters
+    """
+    if len(chapters) == 0:
+        return b''
+    if len(chapters) > 255:
+        raise ValueError("A table of contents can hold at most 255 chapters")
+
+    child_ids = ['ch{}'.format(index).encode('ascii') for index in range(1, len(chapters) + 1)]
+    rendered = [_render_ctoc(TOC_ELEMENT_ID, child_ids, major, u'Table of Contents')]
+    if offsets is None:
+        offsets = [(_NO_OFFSET, _NO_OFFSET)] * len(chapters)
+    for child_id, (title, start, end), (start_offset, end_offset) in zip(
+            child_ids, chapters.iter_milliseconds(), offsets):
+        rendered.append(_render_chap(child_id, title, start, end, major,
+                                     min(start_offset, _NO_OFFSET), min(end_offset, _NO_OFFSET)))
+    return b''.join(rendered)
+
+
+def _render_header(major: int, revision: int, flags: int, size: int) -> bytes:
+    return b'ID3' + bytes([major, revision, flags]) + _encode_size(size - _HEADER_SIZE, 4)
+
+
+def _chapter_offsets(chapters: ChapterList, seek_index: SeekIndex, tag_size: int) -> List[Tuple[int, int]]:
+    """
+    :return: byte offsets of the frames at the start and end of every chapter, behind a tag of tag_size bytes
+    """
+    return [(tag_size + seek_index.offset_at(start), tag_size + seek_index.offset_at(end))
+            for _, start, end in chapters.iter_milliseconds()]
+
+
+def render_tag(text_frames: Dict[bytes, str], major: int = 3, padding: int = 0,
+               chapters: Optional[ChapterList] = None) -> bytes:
+    """
+    Renders a new tag holding only text frames and chapters, e.g. for a file created from others
+    :param text_frames: text by frame id, e.g. {b'TIT2': 'Chapter 1'}
+    :param major: major version of the tag, 3 is read by the most players
+    :param padding: padding reserved for later edits
+    :param chapters: chapters to add, if any
+    :return: the tag including its header
+    """
+    frames = b''.join(_render_frame(frame_id, _render_text(text, major), major)
+                      for frame_id, text in text_frames.items())
+    if chapters is not None:
+        frames += _render_chapters(chapters, major)
+    size = _HEADER_SIZE + len(frames) + padding
+    return _render_header(major, 0, 0, size) + frames + bytes(padding)
+
+
+def _patch_start(layout: List[Union[bytes, Tuple[int, int]]]) -> Optional[int]:
+    """
+    :return: offset from which only rendered frames and padding follow, if every other frame of layout stays
+             where it is, else None
+    """
+    pos = _HEADER_SIZE
+    for position, item in enumerate(layout):
+        if isinstance(item, bytes):
+            return pos if all(isinstance(rest, bytes) for rest in layout[position:]) else None
+        if item[0] != pos:
+            return None
+        pos += item[1]
+    return pos
+
+
+def write_chapters(filepath, chapters: ChapterList, padding: int = DEFAULT_PADDING,
+                   seek_index: Optional[SeekIndex] = None) -> int:
+    """
+    Replaces the chapter frames of an mp3 file. Other frames are never decoded or read into memory: they
+    are copied as byte ranges of the file, or not touched at all. If the other frames keep their place and
+    the chapter frames fit in the rest of the existing tag, they are patched in with a single write over
+    the chapter frames and padding. Otherwise the file is rewritten once, with a tag that reserves padding
+    for later edits if it has to grow, in a temporary file that is renamed over the original once complete.
+    The audio and the other frames are copied inside the kernel, without passing through Python.
+    :param filepath: path to mp3 file
+    :param chapters: chapters to write, an empty list removes all chapter frames
+    :param padding: padding reserved when the tag has to grow
+    :param seek_index: seek index of the file, if given the CHAP frames get the byte offsets of their chapters
+    :return: number of bytes written
+    :raises UnsupportedTagError: if the existing tag cannot be rewritten here, callers should fall back to eyed3
+    """
+    if not isinstance(chapters, ChapterList):
+        chapters = ChapterList(chapters)
+
+    try:
+        with open(filepath, 'rb') as f, FrameIndex(f) as index:
+            tag = _tag_from_index(index, decode=())
+    except (struct.error, IndexError):
+        raise UnsupportedTagError("Unable to parse the existing tag")
+    layout = layout_frames(tag, chapters)
+    frames_size = _layout_size(layout)
+    fits = tag.size > 0 and _HEADER_SIZE + frames_size <= tag.size
+    size = tag.size if fits else _HEADER_SIZE + frames_size + padding
+    if seek_index is not None and len(chapters) > 0:
+        # Byte offsets depend on the size of the new tag, but do not change it
+        layout = layout_frames(tag, chapters, _chapter_offsets(chapters, seek_index, size))
+    major, revision = tag.version if tag.version is not None else (4, 0)
+    # Extended headers are dropped as their CRC would no longer match. Only the experimental flag carries over.
+    flags = tag.flags & 0x20
+
+    # Patching is limited to one write behind the frames that stay, so the header has to stay as it is too
+    start = _patch_start(layout) if fits and flags == tag.flags else None
+    if start is not None:
+        rendered = b''.join(item for item in layout if isinstance(item, bytes))
+        with open(filepath, 'r+b') as f:
+            f.seek(start)
+            f.write(rendered + bytes(tag.size - start - len(rendered)))
+            f.flush()
+            os.fsync(f.fileno())
+        return tag.size - start
+
+    header = _render_header(major, revision, flags, size)
+    with open(filepath, 'rb') as src, fileio.atomic_replace(filepath) as dst:
+        dst.write(header)
+        for item in layout:
+            if isinstance(item, bytes):
+                dst.write(item)
+            else:
+                fileio.copy_exact(src, dst, item[0], item[1])
+        dst.write(bytes(size - _HEADER_SIZE - frames_size))
+        fileio.copy_exact(src, dst, tag.size, os.fstat(src.fileno()).st_size - tag.size)
+        written = dst.tell()
+    return written
+
+
+def _save_eyed3(filepath, chapters: ChapterList) -> int:
+    """
+    Saves chapters through eyed3, for tags that write_chapters cannot rewrite. eyed3 edits a copy of the
+    file, which then replaces the original, so that the original survives an interrupted save.
+    :return: number of bytes written
+    """
+    import eyed3
+
+    with fileio.atomic_replace(filepath, copy_original=True) as tmp:
+        mp3 = eyed3.load(tmp.name)
+        if mp3 is None:
+            raise IOError("Unable to read mp3 file")
+        if mp3.tag is None:
+            mp3.initTag()
+        tag = mp3.tag
+
+        for chap_eid in [chap.element_id for chap in tag.chapters]:
+            tag.chapters.remove(chap_eid)
+        for toc_eid in [toc.element_id for toc in tag.table_of_contents]:
+            tag.table_of_contents.remove(toc_eid)
+
+        if len(chapters) > 0:
+            toc = tag.table_of_contents.set(TOC_ELEMENT_ID, toplevel=True, description=u'Table of Contents')
+            for index, (title, start, end) in zip(range(1, len(chapters) + 1), chapters.iter_milliseconds()):
+                ch = tag.chapters.set('ch{}'.format(index).encode('ascii'), (start, end))
+                ch.title = title
+                toc.child_ids.append(ch.element_id)
+
+        tag.save()
+        # eyed3 saves through a file of its own renamed over tmp, which the handle of tmp does not see
+        fileio.fsync_path(tmp.name)
+    return os.path.getsize(filepath)
+
+
+def save_chapters(filepath, chapters: ChapterList, padding: int = DEFAULT_PADDING,
+                  seek_index: Optional[SeekIndex] = None) -> int:
+    """
+    Replaces the chapter frames of an mp3 file, through eyed3 for tags that write_chapters cannot rewrite.
+    Whenever the audio has to be moved, the new file is built next to the original and renamed over it.
+    :param filepath: path to mp3 file
+    :param chapters: chapters to write, an empty list removes all chapter frames
+    :param padding: padding reserved when the tag has to be rewritten
+    :param seek_index: seek index of the file, if given the CHAP frames get the byte offsets of their chapters.
+                       Chapters saved through eyed3 do not get byte offsets.
+    :return: number of bytes written
+    """
+    if not isinstance(chapters, ChapterList):
+        chapters = ChapterList(chapters)
+    try:
+        return write_chapters(filepath, chapters, padding, seek_index)
+    except UnsupportedTagError:
+        return _save_eyed3(filepath, chapters)
@@ -0,0 +1,76 @@
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from cache import ChapterizedState
+
+
+def is_mp3(name: str) -> bool:
+    """
+    :return: True if a file name has the mp3 extension, in any case
+    """
+    return name.lower().endswith('.mp3')
+
+
+class LibraryScanner(object):
+    def __init__(self, state: Optional[ChapterizedState] = None, recursive: bool = True):
+        """
+        Finds mp3 files under one or more directories, lazily, so that files can be processed
+        while the rest of the library is still being scanned
+        :param state: record of chapterized files; files unchanged since they were chapterized are skipped
+        :param recursive: if True, also look into all subdirectories
+        """
+        self._state = state
+        self._recursive = recursive
+        self.found = 0
+        self.unchanged = 0
+
+    def entries(self, roots: Iterable[str], directories: bool = False) -> Iterator[os.DirEntry]:
+        """
+        Walks directories depth first, entries of each directory in name order, without checking any state
+        :param roots: directories to walk
+        :param directories: if True, subdirectories are yielded as well as mp3 files
+        :return: generator of directory entries
+        """
+        pending = list(reversed(list(roots)))
+        while len(pending) > 0:
+            try:
+                with os.scandir(pending.pop()) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                try:
+                    if entry.is_file() and is_mp3(entry.name):
+                        yield entry
+                    elif self._recursive and entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                        if directories:
+                            yield entry
+                except OSError:
+                    continue
+            pending.extend(reversed(subdirectories))
+
+    def scan(self, roots: Iterable[str]) -> Iterator[Path]:
+        """
+        :param roots: directories or mp3 files to scan
+        :return: generator of paths to mp3 files that need chapterizing
+        """
+        for root in roots:
+            if os.path.isfile(root):
+                candidates = [(root, os.stat)]
+            else:
+                candidates = ((entry.path, lambda _, entry=entry: entry.stat()) for entry in self.entries([root]))
+
+            for path, stat in candidates:
+                self.found += 1
+                if self._state is not None:
+                    try:
+                        if self._state.unchanged(path, stat(path)):
+                            self.unchanged += 1
+                            continue
+                    except OSError:
+                        continue
+                yield Path(path)
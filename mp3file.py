@@ -1,78 +1,104 @@
-from typing import List
+from typing import List, Optional
 from pathlib import Path
+import sys
 
-import eyed3
-
-from chapter import Chapter
+import id3tag
+import profiling
+from cache import CachedMetadata, MetadataCache, SeekIndexCache
+from chapter import ChapterList
+from duration import SeekIndex, build_seek_index, read_duration
 from overdrive import MediaMarker
 from timestamp import Timestamp
 
 
+def load_seek_index(filepath, cache: Optional[SeekIndexCache] = None) -> Optional[SeekIndex]:
+    """
+    Looks up the seek index of an mp3 file, building it and storing it in the cache if it is not there
+    :param filepath: path to mp3 file
+    :param cache: seek index cache, if any
+    :return: the index, None if the file has no audio frames
+    """
+    index = cache.get(filepath) if cache is not None else None
+    if index is None:
+        with profiling.stage('seek_index', filepath):
+            index = build_seek_index(filepath)
+        if index is not None and cache is not None:
+            cache.put(filepath, index)
+    return index
+
+
 class Mp3File(object):
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache: Optional[MetadataCache] = None):
+        """
+        :param filepath: path to mp3 file
+        :param cache: metadata cache consulted before reading the file, if given
+        """
         self._filepath = Path(filepath)
-        self._mp3 = eyed3.load(self._filepath)
-        if self._mp3 is not None:
-            self._media_markers = self._read_media_markers()
-            self._chapters = self._read_id3v2_chapters()
-            if len(self._chapters) == 0:
-                self._chapters = self.media_markers_as_chapters
-
-    def _read_id3v2_chapters(self):
-        chapters = []
-        # Find top-level toc
-        for toc in self._mp3.tag.table_of_contents:
-            if toc.toplevel:
-                for ch_eid in toc.child_ids:
-                    ch = self._mp3.tag.chapters.get(ch_eid)
-                    title = ch.title
-                    start, end = map(Timestamp.from_milliseconds, ch.times)
-                    chapters.append(Chapter(title, start=start, end=end))
-        return chapters
-
-    def _read_media_markers(self):
-        user_frames = self._mp3.tag.user_text_frames
-        if 'OverDrive MediaMarkers' in user_frames:
-            markers_frame = user_frames.get('OverDrive MediaMarkers')
-            return MediaMarker.from_xml(markers_frame.text)
+        self._cache = cache
+        # Shares the database of the metadata cache, and only connects if the seek index is used
+        self._seek_cache = SeekIndexCache(cache.path) if cache is not None else None
+
+        metadata = cache.get(self._filepath) if cache is not None else None
+        cached = metadata is not None
+        if not cached:
+            metadata = self._read_metadata()
+        self._metadata = metadata
+        self._duration = metadata.duration
+        self._chapters = ChapterList.from_milliseconds(metadata.chapters)
+        if len(self._chapters) == 0:
+            self._chapters = self.media_markers_as_chapters
+
+        # Computing the duration above already stores the metadata
+        if cache is not None and not cached and self._duration is None:
+            cache.put(self._filepath, metadata)
+
+    def _read_metadata(self) -> CachedMetadata:
+        with profiling.stage('read_tag', self._filepath):
+            tag = id3tag.read_tag(self._filepath)
+        with profiling.stage('parse_markers', self._filepath):
+            markers = [(marker.name, marker.time.total_milliseconds) for marker in self._read_media_markers(tag)]
+        chapters = [(ch.title, ch.start.total_milliseconds, ch.end.total_milliseconds)
+                    for ch in self._read_id3v2_chapters(tag)]
+        return CachedMetadata(markers, chapters, tag.has_chapters, None)
+
+    def _read_id3v2_chapters(self, tag: id3tag.Tag):
+        return tag.chapters
+
+    def _read_media_markers(self, tag: id3tag.Tag):
+        markers = tag.media_markers
+        if markers is not None:
+            return MediaMarker.from_xml(markers)
         return []
 
-    def clean(self):
+    def _write_chapters(self, chapters: ChapterList, seek_index: Optional[SeekIndex] = None) -> int:
+        with profiling.stage('save', self._filepath):
+            written = id3tag.save_chapters(self._filepath, chapters, seek_index=seek_index)
+        # The file now holds these chapters, which its metadata has to say, e.g. for files kept open after saving
+        self._metadata.chapters = list(chapters.iter_milliseconds())
+        self._metadata.has_chapters = len(chapters) > 0
+        if self._cache is not None:
+            self._cache.put(self._filepath, self._metadata)
+        if self._seek_cache is not None and seek_index is not None:
+            # Only the tag was rewritten, so the index still describes the audio
+            self._seek_cache.put(self._filepath, seek_index)
+        return written
+
+    def clean(self) -> int:
         """
         Removes existing chapter tags from the mp3 file if present.
+        :return: number of bytes written
         """
-        # Remove chapters
-        for chap in self._mp3.tag.chapters:
-            self._mp3.tag.chapters.remove(chap.element_id)
+        return self._write_chapters(ChapterList())
 
-        # Remove TOCs
-        for toc in self._mp3.tag.table_of_contents:
-            self._mp3.tag.table_of_contents.remove(toc.element_id)
-
-        self._mp3.tag.save()
-
-    def save(self) -> None:
+    def save(self, seek_offsets: bool = False) -> int:
         """
-        Saves the chapters
-        :return:
+        Saves the chapters. When the chapter frames end the tag and the new ones fit in the existing padding,
+        they are patched in with a single write. Any other save builds the new file next to the original and
+        renames it over it, so an interrupted save leaves the original intact.
+        :param seek_offsets: if True, chapters are written with the byte offsets of their first and last frames
+        :return: number of bytes written
         """
-        self.clean()
-
-        if len(self.chapters) == 0:
-            return
-
-        toc = self._mp3.tag.table_of_contents.set(b'toc', toplevel=True, description=u'Table of Contents')
-
-        for index, chapter in zip(range(1, len(self.chapters) + 1), self.chapters):
-            start = chapter.start.total_milliseconds
-            end = chapter.end.total_milliseconds
-            ch_eid = 'ch{}'.format(index).encode('ascii')
-
-            ch = self._mp3.tag.chapters.set(ch_eid, (start, end))
-            ch.title = chapter.title
-            toc.child_ids.append(ch.element_id)
-
-        self._mp3.tag.save()
+        return self._write_chapters(self.chapters, self.seek_index if seek_offsets else None)
 
     @property
     def path(self):
@@ -84,30 +110,78 @@ class Mp3File(object):
         Duration of audio file in milliseconds
         :return: number of milliseconds in mp3 file
         """
-        return int(self._mp3.info.time_secs * 1000)
+        if self._duration is None:
+            with profiling.stage('duration', self._filepath):
+                self._duration = read_duration(self._filepath).milliseconds
+            self._metadata.duration = self._duration
+            if self._cache is not None:
+                self._cache.put(self._filepath, self._metadata)
+        return self._duration
+
 
+    @property
+    def seek_index(self) -> Optional[SeekIndex]:
+        """
+        Byte offsets of the audio frames, None if the file has no audio frames. The index takes 4 bytes per
+        frame, over 500 KB for an hour of audio, so it is not kept with the file but looked up in the cache,
+        or built, on every use.
+        """
+        return load_seek_index(self._filepath, self._seek_cache)
 
     @property
-    def chapters(self) -> List[Chapter]:
+    def chapters(self) -> ChapterList:
         return self._chapters
 
+    @chapters.setter
+    def chapters(self, chapters: ChapterList):
+        self._chapters = chapters
+
     @property
-    def media_markers_as_chapters(self) -> List[Chapter]:
-        markers = self.media_markers
-        chapters = []
-
-        if len(markers) > 0:
-            for prev, cur in zip(markers[:-1], markers[1:]):
-                chapters.append(Chapter(title=prev.name, start=prev.time, end=cur.time))
-            last_marker = markers[-1]
-            chapters.append(Chapter(title=last_marker.name,
-                                    start=last_marker.time,
-                                    end=Timestamp.from_milliseconds(self.duration)))
-        return chapters
+    def media_markers_as_chapters(self) -> ChapterList:
+        markers = self._metadata.markers
+
+        if len(markers) == 0:
+            return ChapterList()
+
+        starts = [time for _, time in markers]
+        ends = starts[1:] + [self.duration]
+        return ChapterList.from_milliseconds(zip((name for name, _ in markers), starts, ends))
+
+    @property
+    def media_markers(self) -> List[MediaMarker]:
+        """
+        Overdrive markers of the file, created on every use from the (name, milliseconds) pairs kept
+        """
+        return [MediaMarker(name, Timestamp.from_milliseconds(time)) for name, time in self._metadata.markers]
+
+    @property
+    def id3v2_chapters(self) -> ChapterList:
+        """
+        Chapters in the top-level table of contents of the file when it was loaded or last saved
+        """
+        return ChapterList.from_milliseconds(self._metadata.chapters)
+
+    @property
+    def has_id3v2_chapters(self) -> bool:
+        """
+        True if the file had CTOC or CHAP frames when it was loaded or last saved
+        """
+        return self._metadata.has_chapters
 
     @property
-    def media_markers(self):
-        return self._media_markers
+    def memory_usage(self) -> int:
+        """
+        Approximate memory held by the file in bytes: its markers, the chapters it was loaded with and the
+        current chapters. No frames of the tag are kept, they are located again when saving.
+        """
+        metadata = self._metadata
+        markers = sys.getsizeof(metadata.markers) + \
+            sum(sys.getsizeof(marker) + sys.getsizeof(marker[0]) + sys.getsizeof(marker[1])
+                for marker in metadata.markers)
+        chapters = sys.getsizeof(metadata.chapters) + \
+            sum(sys.getsizeof(chapter) + sys.getsizeof(chapter[0]) + 2 * sys.getsizeof(chapter[1])
+                for chapter in metadata.chapters)
+        return sys.getsizeof(self) + sys.getsizeof(metadata) + markers + chapters + self._chapters.memory_usage
 
     def __str__(self):
         return "{}:\n{}".format(self.path.name,
@@ -1,6 +1,66 @@
-import xml.etree.ElementTree as ET
+import html
+import re
+from typing import Iterator, List, Tuple
 
-from timestamp import Timestamp
+from timestamp import Timestamp, parse_milliseconds
+
+_MARKER = r'<Marker>\s*<Name>([^<]*)</Name>\s*<Time>([^<]*)</Time>\s*</Marker>'
+
+# The layout written by OverDrive: an optional XML declaration, then <Markers> holding nothing but
+# <Marker> elements, each with a <Name> followed by a <Time>. Text without this exact layout is
+# parsed with the XML parser instead.
+_STANDARD_LAYOUT = r'\s*(?:<\?xml[^>]*\?>)?\s*<Markers>(?:\s*' + _MARKER.replace('(', '(?:') + r')*\s*</Markers>\s*'
+
+# Amount of text fed to the XML parser at a time
+_FEED_SIZE = 64 * 1024
+
+
+def _iter_standard(xml_txt: str) -> Iterator[Tuple[str, int]]:
+    # re caches compiled patterns, which are only built the first time markers are read
+    for match in re.finditer(_MARKER, xml_txt):
+        name, time = match.groups()
+        try:
+            millisecs = parse_milliseconds(time)
+        except ValueError:
+            continue
+        yield (html.unescape(name) if '&' in name else name), millisecs
+
+
+def _iter_xml(xml_txt: str) -> Iterator[Tuple[str, int]]:
+    import xml.etree.ElementTree as ET  # Not needed for the standard layout, so not imported up front
+
+    parser = ET.XMLPullParser(events=('end',))
+    try:
+        for pos in range(0, len(xml_txt), _FEED_SIZE):
+            parser.feed(xml_txt[pos:pos + _FEED_SIZE])
+            for _, element in parser.read_events():
+                if element.tag != 'Marker':
+                    continue
+                name = element.find('Name')
+                time = element.find('Time')
+                if name is not None and time is not None and time.text is not None:
+                    try:
+                        yield name.text or '', parse_milliseconds(time.text)
+                    except ValueError:
+                        pass
+                element.clear()
+        parser.close()
+    except ET.ParseError:
+        # Malformed XML, keep the markers parsed up to the error
+        return
+
+
+def iter_markers(xml_txt: str) -> Iterator[Tuple[str, int]]:
+    """
+    Lazily parses Overdrive MediaMarkers. The standard OverDrive layout is read with a regular
+    expression, anything else with a streaming XML parser. Markers with an invalid time are skipped,
+    and parsing stops quietly at the first error in malformed XML.
+    :param xml_txt: XML formatted markers from the user frame called 'OverDrive MediaMarkers'
+    :return: generator of (name, milliseconds) pairs
+    """
+    if re.fullmatch(_STANDARD_LAYOUT, xml_txt):
+        return _iter_standard(xml_txt)
+    return _iter_xml(xml_txt)
 
 
 class MediaMarker(object):
@@ -9,15 +69,8 @@ class MediaMarker(object):
         self._time = time
 
     @classmethod
-    def from_xml(cls, xml_txt: str):
-        markers = []
-        root = ET.fromstring(xml_txt)
-        for marker in root.iter('Marker'):
-            name = marker.find('Name')
-            time = marker.find('Time')
-            if name is not None and time is not None:
-                markers.append(cls(name.text, Timestamp.from_string(time.text)))
-        return markers
+    def from_xml(cls, xml_txt: str) -> List['MediaMarker']:
+        return [cls(name, Timestamp.from_milliseconds(time)) for name, time in iter_markers(xml_txt)]
 
     @property
     def name(self):
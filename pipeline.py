@@ -0,0 +1,237 @@
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+_END = object()
+
+
+class Stage(object):
+    def __init__(self, name: str, func: Callable, workers: int = 1, limit: Optional[str] = None,
+                 inline: bool = False):
+        """
+        A step of a pipeline, applied to every item that is not done yet
+        :param name: name of the stage in the statistics
+        :param func: called with each item, in a worker thread unless inline
+        :param workers: number of items worked on at the same time
+        :param limit: name of a concurrency limit shared with other stages, e.g. for all stages that read files
+        :param inline: if True, func is called in the event loop, which only suits work that never blocks
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.limit = limit
+        self.inline = inline
+
+
+class StageStats(object):
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+
+    def sample(self, depth: int) -> None:
+        """
+        Records the depth of the input queue of the stage
+        """
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_total += depth
+        self._depth_samples += 1
+
+    @property
+    def mean_depth(self) -> float:
+        return self._depth_total / self._depth_samples if self._depth_samples > 0 else 0.0
+
+
+class PipelineStats(object):
+    def __init__(self, stages: List[StageStats]):
+        """
+        Throughput and queue depths of a pipeline run
+        :param stages: statistics per stage, the first being the source
+        """
+        self.stages = stages
+        self.items = 0
+        self.seconds = 0.0
+        self.max_in_flight = 0
+        self.bytes_written = None  # type: Optional[int]
+        self.pool_tasks = None  # type: Optional[int]
+        self.pool_processes = 0
+        self.pool_busy = 0.0
+
+    def print_summary(self) -> None:
+        rate = self.items / self.seconds if self.seconds > 0 else 0.0
+        line = "Pipeline: {} files in {:.2f} s, {:.1f} files/s".format(self.items, self.seconds, rate)
+        if self.bytes_written is not None:
+            line += ", {:.1f} MB written ({:.1f} MB/s)".format(
+                self.bytes_written / 1e6, self.bytes_written / 1e6 / self.seconds if self.seconds > 0 else 0.0)
+        print(line + ", at most {} in flight.".format(self.max_in_flight))
+        if self.pool_tasks == 0:
+            print("Process pool: not used.")
+        elif self.pool_tasks is not None:
+            print("Process pool: {} tasks in {} processes, {:.2f} s busy.".format(
+                self.pool_tasks, self.pool_processes, self.pool_busy))
+        print("{:<16}{:>8}{:>8}{:>12}{:>8}{:>12}{:>12}".format('Stage', 'Workers', 'Files', 'Busy (s)', 'Util',
+                                                             'Max queue', 'Mean queue'))
+        for stage in self.stages:
+            utilization = stage.busy / (self.seconds * stage.workers) if self.seconds > 0 else 0.0
+            print("{:<16}{:>8}{:>8}{:>12.2f}{:>7.0%}{:>12}{:>12.1f}".format(
+                stage.name, stage.workers, stage.items, stage.busy, utilization, stage.max_depth,
+                stage.mean_depth))
+
+
+class _OutputRouter(object):
+    """
+    Stands in for sys.stdout, sending what each thread prints to the buffer that thread is capturing into
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @contextmanager
+    def capture(self, buffer):
+        self._local.buffer = buffer
+        try:
+            yield
+        finally:
+            self._local.buffer = None
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self._local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def _call(router: _OutputRouter, func: Callable, item) -> float:
+    """
+    :return: seconds spent in func
+    """
+    start = time.perf_counter()
+    with router.capture(getattr(item, 'output', None)):
+        func(item)
+    return time.perf_counter() - start
+
+
+async def _run(items: Iterable, stages: List[Stage], on_done: Callable, limits: Dict[str, int], window: int,
+               queue_size: int, router: _OutputRouter, executor: ThreadPoolExecutor) -> PipelineStats:
+    loop = asyncio.get_event_loop()
+    semaphores = {name: asyncio.Semaphore(value) for name, value in limits.items()}
+    in_flight = asyncio.Semaphore(window)
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages] + [asyncio.Queue()]
+    stats = PipelineStats([StageStats('scan', 1)] + [StageStats(stage.name, stage.workers) for stage in stages])
+    started = time.perf_counter()
+    active = 0
+
+    async def put(position: int, entry) -> None:
+        await queues[position].put(entry)
+        if position < len(stages):
+            stats.stages[position + 1].sample(queues[position].qsize())
+
+    async def source():
+        nonlocal active
+        iterator = iter(items)
+        sequence = 0
+        while True:
+            # Bounds the items waiting to be reported in order behind a slow one, not just the queues
+            await in_flight.acquire()
+            start = time.perf_counter()
+            item = await loop.run_in_executor(executor, next, iterator, _END)
+            stats.stages[0].busy += time.perf_counter() - start
+            if item is _END:
+                in_flight.release()
+                break
+            stats.stages[0].items += 1
+            active += 1
+            stats.max_in_flight = max(stats.max_in_flight, active)
+            await put(0, (sequence, item))
+            sequence += 1
+        for _ in range(stages[0].workers):
+            await queues[0].put(None)
+
+    async def worker(position: int):
+        stage = stages[position]
+        semaphore = semaphores.get(stage.limit)
+        while True:
+            entry = await queues[position].get()
+            if entry is None:
+                return
+            _, item = entry
+            if not getattr(item, 'done', False):
+                if semaphore is not None:
+                    await semaphore.acquire()
+                try:
+                    if stage.inline:
+                        seconds = _call(router, stage.func, item)
+                    else:
+                        seconds = await loop.run_in_executor(executor, _call, router, stage.func, item)
+                finally:
+                    if semaphore is not None:
+                        semaphore.release()
+                stats.stages[position + 1].items += 1
+                stats.stages[position + 1].busy += seconds
+            await put(position + 1, entry)
+
+    async def run_stage(position: int):
+        await asyncio.gather(*(worker(position) for _ in range(stages[position].workers)))
+        following = stages[position + 1].workers if position + 1 < len(stages) else 1
+        for _ in range(following):
+            await queues[position + 1].put(None)
+
+    async def sink():
+        nonlocal active
+        waiting = {}
+        expected = 0
+        while True:
+            entry = await queues[-1].get()
+            if entry is None:
+                return
+            waiting[entry[0]] = entry[1]
+            while expected in waiting:
+                on_done(waiting.pop(expected))
+                stats.items += 1
+                expected += 1
+                active -= 1
+                in_flight.release()
+
+    await asyncio.gather(source(), sink(), *(run_stage(position) for position in range(len(stages))))
+    stats.seconds = time.perf_counter() - started
+    return stats
+
+
+def run_pipeline(items: Iterable, stages: List[Stage], on_done: Callable, limits: Optional[Dict[str, int]] = None,
+                 window: int = 16, queue_size: int = 4) -> PipelineStats:
+    """
+    Passes items through stages connected by bounded queues, running the stages concurrently on an asyncio
+    event loop so that, e.g., one file is read while another is parsed and a third is written. Blocking work
+    runs in a thread pool. An item whose done attribute is True skips the remaining stages. What a stage prints
+    while working on an item goes to the output attribute of the item, if it has one.
+    :param items: items to process, e.g. a generator of paths, consumed in a worker thread as they are needed
+    :param stages: stages every item passes through in order
+    :param on_done: called in the event loop with every item once it has passed all stages, in the order of items
+    :param limits: largest number of calls at the same time by the name given as the limit of stages
+    :param window: largest number of items between the source and on_done
+    :param queue_size: largest number of items waiting in front of each stage
+    :return: throughput and queue depths of the run
+    """
+    router = _OutputRouter(sys.stdout)
+    workers = 1 + sum(stage.workers for stage in stages if not stage.inline)
+    sys.stdout = router
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(_run(items, stages, on_done, limits or {}, window, queue_size,
+                                                    router, executor))
+            finally:
+                loop.close()
+    finally:
+        sys.stdout = router.stream
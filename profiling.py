@@ -0,0 +1,231 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Per-thread I/O counters where the kernel provides them, so that stages running concurrently in a
+# thread pool are not charged for each other's reads and writes. They only see read and write calls, so
+# bytes of memory-mapped files, and of in-kernel copies on some kernels and filesystems, are added with add_io.
+_IO_COUNTERS = next((path for path in ('/proc/thread-self/io', '/proc/self/io') if os.path.exists(path)), None)
+
+_enabled = False
+_cprofile = None  # type: Optional[Tuple[str, str]]
+_records = []  # type: List[dict]
+_lock = threading.Lock()
+_added = threading.local()  # Bytes read and written that the I/O counters missed, by thread
+
+
+def enable(cprofile: Optional[Tuple[str, str]] = None) -> None:
+    """
+    Starts recording stages in this process
+    :param cprofile: path of an mp3 file and of a file to dump cProfile statistics of its processing to, if any
+    """
+    global _enabled, _cprofile
+    _enabled = True
+    _cprofile = (os.path.abspath(cprofile[0]), cprofile[1]) if cprofile is not None else None
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def cprofile_target() -> Optional[Tuple[str, str]]:
+    """
+    :return: the file chosen for cProfile in enable() and the file its statistics are dumped to, if any
+    """
+    return _cprofile
+
+
+def _io_counters() -> Tuple[Optional[int], Optional[int]]:
+    """
+    :return: bytes read and written so far, None where unknown
+    """
+    if _IO_COUNTERS is None:
+        return None, None
+    read = written = None
+    with open(_IO_COUNTERS) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name == 'rchar':
+                read = int(value)
+            elif name == 'wchar':
+                written = int(value)
+    return read, written
+
+
+def _added_io() -> Tuple[int, int]:
+    return getattr(_added, 'read', 0), getattr(_added, 'written', 0)
+
+
+def add_io(read: int = 0, written: int = 0) -> None:
+    """
+    Charges bytes that the I/O counters of the kernel do not see, such as those of a memory-mapped file,
+    to the stages running in this thread, if profiling is enabled
+    """
+    if _enabled:
+        _added.read = getattr(_added, 'read', 0) + read
+        _added.written = getattr(_added, 'written', 0) + written
+
+
+def io_snapshot() -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """
+    :return: the I/O counters of this thread, for add_copied, None if profiling is disabled
+    """
+    return _io_counters() if _enabled else None
+
+
+def add_copied(count: int, before: Optional[Tuple[Optional[int], Optional[int]]]) -> None:
+    """
+    Charges a copy made inside the kernel, e.g. with copy_file_range, for the part the I/O counters missed
+    :param count: bytes copied since before
+    :param before: result of io_snapshot() taken before the copy
+    """
+    if before is None or before[0] is None:
+        return
+    read, written = _io_counters()
+    add_io(max(0, count - (read - before[0])), max(0, count - (written - before[1])))
+
+
+def _peak_rss() -> Optional[int]:
+    """
+    :return: peak resident set size of this process in bytes, None where unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def _record(name: str, path):
+    read_before, written_before = _io_counters()
+    added_read_before, added_written_before = _added_io()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        read_after, written_after = _io_counters()
+        added_read, added_written = _added_io()
+        bytes_read = bytes_written = None
+        if read_before is not None:
+            bytes_read = read_after - read_before + added_read - added_read_before
+            bytes_written = written_after - written_before + added_written - added_written_before
+        record = {'file': str(path) if path is not None else None, 'stage': name, 'seconds': seconds,
+                  'bytes_read': bytes_read, 'bytes_written': bytes_written, 'peak_rss': _peak_rss()}
+        with _lock:
+            _records.append(record)
+
+
+def stage(name: str, path=None):
+    """
+    Records wall time, bytes read and written, including those of memory-mapped files and in-kernel copies,
+    and peak memory of a block of code, if profiling is enabled:
+
+        with profiling.stage('duration', filepath):
+            ...
+
+    :param name: name of the stage
+    :param path: file the stage works on, if any
+    :return: a context manager
+    """
+    if not _enabled:
+        return nullcontext()
+    return _record(name, path)
+
+
+def run(path, func, *args, **kwargs):
+    """
+    Calls func, under cProfile if path is the file chosen in enable()
+    :param path: file func works on
+    :return: result of func
+    """
+    if _cprofile is None or os.path.abspath(path) != _cprofile[0]:
+        return func(*args, **kwargs)
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(_cprofile[1])
+
+
+def take_records() -> List[dict]:
+    """
+    Removes and returns the stages recorded so far, e.g. to send them from a worker process to its parent
+    """
+    global _records
+    with _lock:
+        records, _records = _records, []
+    return records
+
+
+def add_records(records: List[dict]) -> None:
+    """
+    Adds stages recorded elsewhere, e.g. in a worker process
+    """
+    with _lock:
+        _records.extend(records)
+
+
+def _percentile(values: List[float], percent: int) -> float:
+    # Nearest rank on sorted values
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[index]
+
+
+def aggregate(records: List[dict]) -> Dict[str, dict]:
+    """
+    Summarizes stages by name
+    :param records: recorded stages
+    :return: count, total, p50, p95 and max seconds and total bytes read and written, by stage name
+    """
+    stages = {}  # type: Dict[str, List[dict]]
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+
+    summary = {}
+    for name, items in stages.items():
+        seconds = sorted(item['seconds'] for item in items)
+        summary[name] = {'count': len(items), 'total': sum(seconds), 'p50': _percentile(seconds, 50),
+                         'p95': _percentile(seconds, 95), 'max': seconds[-1],
+                         'bytes_read': sum(item['bytes_read'] or 0 for item in items),
+                         'bytes_written': sum(item['bytes_written'] or 0 for item in items)}
+    return summary
+
+
+def print_summary(records: List[dict]) -> None:
+    summary = aggregate(records)
+    if len(summary) == 0:
+        return
+    print("{:<16}{:>8}{:>12}{:>12}{:>12}{:>12}{:>12}".format('Stage', 'Count', 'p50 (ms)', 'p95 (ms)', 'Max (ms)',
+                                                           'Read (MB)', 'Write (MB)'))
+    for name, item in summary.items():
+        print("{:<16}{:>8}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+            name, item['count'], item['p50'] * 1000, item['p95'] * 1000, item['max'] * 1000,
+            item['bytes_read'] / 1e6, item['bytes_written'] / 1e6))
+    peaks = [record['peak_rss'] for record in records if record['peak_rss'] is not None]
+    if len(peaks) > 0:
+        print("Peak RSS: {:.1f} MB".format(max(peaks) / 1e6))
+
+
+def write_report(records: List[dict], report_file: str) -> None:
+    """
+    Writes recorded stages and their summary as JSON
+    :param records: recorded stages
+    :param report_file: path of the report to write
+    """
+    peaks = [record['peak_rss'] for record in records if record['peak_rss'] is not None]
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump({'stages': aggregate(records), 'peak_rss': max(peaks) if len(peaks) > 0 else None,
+                   'records': records}, f, indent=2)
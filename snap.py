@@ -0,0 +1,223 @@
+from array import array
+from typing import List, Optional, Tuple
+
+import profiling
+from cache import SeekIndexCache
+from chapter import ChapterList
+from duration import CBR, INFO, FrameHeader, audio_range, find_first_frame, parse_frame_header, read_duration
+from mp3file import load_seek_index
+from timestamp import Timestamp
+
+# Step of global_gain in decibels, as the quantizer step size is 2^(1/4)
+_GAIN_STEP_DB = 1.5
+
+# Bytes searched past an expected frame offset for a frame header, in case the estimate is off
+_RESYNC_LIMIT = 4096
+
+
+class ConstantBitrateIndex(object):
+    """
+    Frame offsets of a constant bitrate stream, computed instead of read. Encoders spread padding slots
+    so that n frames take exactly n * samples * bitrate / 8 / sample rate bytes, rounded down.
+    Has the same interface as SeekIndex.
+    """
+
+    def __init__(self, first_offset: int, audio_size: int, header: FrameHeader):
+        """
+        :param first_offset: offset of the first audio frame relative to the end of the ID3v2 tag
+        :param audio_size: offset at which the audio ends relative to the end of the ID3v2 tag
+        :param header: header of the first audio frame
+        """
+        self._first = first_offset
+        self._bytes_per_frame = (header.samples * header.bitrate, 8 * header.sample_rate)
+        self.audio_size = audio_size
+        self.sample_rate = header.sample_rate
+        self.samples_per_frame = header.samples
+        # The most frames whose combined length, rounded down, fits in the audio
+        self._frames = ((audio_size - first_offset + 1) * self._bytes_per_frame[1] - 1) // self._bytes_per_frame[0]
+
+    def __len__(self):
+        return self._frames
+
+    def frame_at(self, milliseconds: int) -> int:
+        frame = milliseconds * self.sample_rate // (1000 * self.samples_per_frame)
+        return min(max(frame, 0), self._frames)
+
+    def time_at(self, frame: int) -> int:
+        return -(-frame * self.samples_per_frame * 1000 // self.sample_rate)
+
+    def offset_of(self, frame: int) -> int:
+        if frame >= self._frames:
+            return self.audio_size
+        numerator, denominator = self._bytes_per_frame
+        return self._first + frame * numerator // denominator
+
+
+def frame_index(filepath, seek_cache: Optional[SeekIndexCache] = None):
+    """
+    Finds an index of the frames of an mp3 file without reading the whole file where possible: a cached
+    seek index, else computed offsets for a constant bitrate file. Only variable bitrate files without a
+    cached index need a pass over all frame headers, after which the index is cached.
+    :param filepath: path to mp3 file
+    :param seek_cache: seek index cache, if any
+    :return: a SeekIndex or ConstantBitrateIndex, None if the file has no audio frames
+    """
+    index = seek_cache.get(filepath) if seek_cache is not None else None
+    if index is not None:
+        return index
+
+    duration = read_duration(filepath)
+    if duration.method in (CBR, INFO):
+        with open(filepath, 'rb') as f:
+            audio_start, audio_end = audio_range(f)
+            offset, first = find_first_frame(f, audio_start)
+        if first is None:
+            return None
+        if duration.method == INFO:
+            offset += first.length
+        return ConstantBitrateIndex(offset - audio_start, audio_end - audio_start, first)
+
+    return load_seek_index(filepath, seek_cache)
+
+
+def frame_loudness(frame: bytes, header: FrameHeader) -> int:
+    """
+    Estimates the loudness of a layer III frame from its side information, without decoding it: the
+    largest global gain of its granules, where a granule without Huffman coded data counts as silent
+    :param frame: the frame, or at least its header and side information
+    :param header: parsed header of the frame
+    :return: loudness in global gain steps of 1.5 dB, 0 for digital silence
+    """
+    channels = 1 if header.mono else 2
+    start = 4 if frame[1] & 0x01 else 6  # The side information follows the CRC if there is one
+    side = int.from_bytes(frame[start:start + header.side_info_size], 'big')
+    bits = header.side_info_size * 8
+
+    if header.version == 3:
+        pos = 9 + (5 if channels == 1 else 3) + 4 * channels
+        granules, granule_bits = 2, 59
+    else:
+        pos = 8 + (1 if channels == 1 else 2)
+        granules, granule_bits = 1, 63
+
+    loudness = 0
+    for _ in range(granules * channels):
+        # part2_3_length, big_values and global_gain lead every granule
+        fields = (side >> (bits - pos - 29)) & 0x1FFFFFFF
+        if fields >> 17 > 0:
+            loudness = max(loudness, fields & 0xFF)
+        pos += granule_bits
+    return loudness
+
+
+def _window_loudness(f, audio_start: int, index, first: int, last: int) -> array:
+    """
+    Reads the frames first to last - 1 and estimates their loudness
+    :return: loudness per frame, shorter than asked if the frames could not all be found
+    """
+    loudness = array('B')
+    f.seek(audio_start + index.offset_of(first))
+    buf = f.read(index.offset_of(last) - index.offset_of(first) + _RESYNC_LIMIT)
+
+    pos = 0
+    while len(loudness) < last - first and pos + 4 <= len(buf):
+        header = parse_frame_header(buf, pos)
+        if header is None or header.layer != 3:
+            pos = _resync(buf, pos + 1)
+            if pos is None:
+                break
+            continue
+        loudness.append(frame_loudness(buf[pos:pos + 6 + header.side_info_size], header))
+        pos += header.length
+    return loudness
+
+
+def _resync(buf: bytes, pos: int) -> Optional[int]:
+    """
+    :return: position of the next frame header in buf that is followed by another one, None if there is none
+    """
+    pos = buf.find(b'\xff', pos)
+    while pos >= 0:
+        header = parse_frame_header(buf, pos)
+        if header is not None and (pos + header.length + 4 > len(buf) or
+                                   parse_frame_header(buf, pos + header.length) is not None):
+            return pos
+        pos = buf.find(b'\xff', pos + 1)
+    return None
+
+
+def _quiet_gap(loudness: array, center: int, quiet_db: float, min_frames: int) -> Optional[int]:
+    """
+    :param loudness: loudness per frame of a window
+    :param center: position of the current boundary in the window
+    :param quiet_db: how far below the loudest frame of the window a frame has to be to count as quiet
+    :param min_frames: shortest run of quiet frames that counts as a gap
+    :return: position in the window of the middle of the quiet gap closest to center, None if there is none
+    """
+    if len(loudness) == 0:
+        return None
+    threshold = max(loudness) - quiet_db / _GAIN_STEP_DB
+    best = None
+    run_start = None
+    for pos in range(len(loudness) + 1):
+        quiet = pos < len(loudness) and loudness[pos] <= threshold
+        if quiet and run_start is None:
+            run_start = pos
+        elif not quiet and run_start is not None:
+            if pos - run_start >= min_frames:
+                middle = (run_start + pos) // 2
+                if best is None or abs(middle - center) < abs(best - center):
+                    best = middle
+            run_start = None
+    return best
+
+
+def snap_chapters(filepath, chapters: ChapterList, max_shift: int = 1500, min_silence: int = 200,
+                  quiet_db: float = 30.0, index=None) -> List[Tuple[int, int, int]]:
+    """
+    Moves the start of every chapter to the middle of the nearest quiet gap, so that skipping to a chapter
+    does not clip speech. Loudness is estimated from the side information of the frames in a window of
+    max_shift around each start, and only those windows are read. Chapters starting at 0 are left alone.
+    The end of the chapter before a moved start is moved with it, if the two met.
+    :param filepath: path to mp3 file
+    :param chapters: chapters to change
+    :param max_shift: largest move of a start in milliseconds
+    :param min_silence: shortest quiet gap in milliseconds
+    :param quiet_db: how far in dB below the loudest frame around a start a frame has to be to count as quiet
+    :param index: frame index of the file from frame_index, found if not given
+    :return: index, old start and new start in milliseconds of every chapter moved
+    """
+    if index is None:
+        index = frame_index(filepath)
+    if index is None or len(chapters) == 0:
+        return []
+
+    ms_per_frame = index.samples_per_frame * 1000 / index.sample_rate
+    min_frames = max(1, int(min_silence / ms_per_frame))
+
+    moves = []
+    starts = chapters.starts
+    ends = chapters.ends
+    with open(filepath, 'rb') as f, profiling.stage('snap', filepath):
+        audio_start, _ = audio_range(f)
+        for position, start in enumerate(starts):
+            if start <= 0:
+                continue
+            first = index.frame_at(start - max_shift)
+            last = index.frame_at(start + max_shift)
+            loudness = _window_loudness(f, audio_start, index, first, last)
+            gap = _quiet_gap(loudness, index.frame_at(start) - first, quiet_db, min_frames)
+            if gap is None:
+                continue
+            new_start = index.time_at(first + gap)
+            if new_start == start or abs(new_start - start) > max_shift or new_start >= ends[position]:
+                continue
+            if position > 0 and new_start <= starts[position - 1]:
+                continue
+
+            starts[position] = new_start
+            chapters.set_start(position, Timestamp.from_milliseconds(new_start))
+            if position > 0 and ends[position - 1] == start:
+                chapters.set_end(position - 1, Timestamp.from_milliseconds(new_start))
+            moves.append((position, start, new_start))
+    return moves
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_REPO, os.path.join(_REPO, 'benchmarks')]
+
+import fixtures  # noqa: E402
+
+
+@pytest.fixture
+def build_mp3(tmp_path):
+    """
+    Writes synthetic mp3 files into a temporary directory, see fixtures.build_mp3 for the arguments
+    """
+    def build(name: str = 'book.mp3', **kwargs) -> dict:
+        return fixtures.build_mp3(tmp_path / name, **kwargs)
+    return build
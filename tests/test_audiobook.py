@@ -0,0 +1,42 @@
+from audiobook import Audiobook
+from timestamp import Timestamp
+
+
+def test_chapters_are_indexed_over_all_parts(build_mp3, tmp_path):
+    parts = [build_mp3('Part{}.mp3'.format(index), duration=20.0, markers=3, seed=index) for index in (1, 2, 10)]
+
+    book = Audiobook(tmp_path)
+
+    assert [part.path.name for part in book.parts] == ['Part1.mp3', 'Part2.mp3', 'Part10.mp3']
+    assert book.duration == sum(part['duration'] for part in parts)
+    starts = list(book.chapters.starts)
+    assert starts == sorted(starts)
+    assert book.chapters.ends[-1] == book.duration
+    assert book.locate(Timestamp.from_milliseconds(parts[0]['duration'] + 5)) == (1, Timestamp.from_milliseconds(5))
+    for index in range(len(book.parts)):
+        chapters = book.part_chapters(index)
+        assert chapters.starts[0] == 0
+        assert chapters.ends[-1] == book.parts[index].duration
+
+
+def test_only_chapters_repeated_across_a_part_boundary_are_merged(build_mp3, tmp_path):
+    build_mp3('Part1.mp3', duration=20.0, markers=[('Intro', 0), ('Interlude', 5000), ('Interlude', 10000),
+                                                    ('Chapter 1', 15000)])
+    build_mp3('Part2.mp3', duration=20.0, markers=[('Chapter 1', 0), ('Chapter 2', 8000)])
+
+    book = Audiobook(tmp_path)
+
+    offset = book.parts[1].offset
+    assert list(book.chapters.iter_milliseconds()) == [
+        ('Intro', 0, 5000), ('Interlude', 5000, 10000), ('Interlude', 10000, 15000),
+        ('Chapter 1', 15000, offset + 8000), ('Chapter 2', offset + 8000, book.duration)]
+
+
+def test_parts_are_found_whatever_the_case_of_their_extension(build_mp3, tmp_path):
+    build_mp3('Part1.mp3', duration=20.0, markers=2)
+    build_mp3('Part2.MP3', duration=20.0, markers=2, seed=1)
+    (tmp_path / 'notes.txt').write_text('')
+
+    book = Audiobook(tmp_path)
+
+    assert [part.path.name for part in book.parts] == ['Part1.mp3', 'Part2.MP3']
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import id3tag
+from cache import CachedMetadata, MetadataCache, SeekIndexCache
+from duration import build_seek_index
+from mp3file import Mp3File
+
+
+def _touch_bytes(path, offset: int, data: bytes, keep_mtime: bool = False) -> None:
+    st = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+    if keep_mtime:
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+@pytest.fixture
+def metadata():
+    return CachedMetadata([('Chapter 1', 0), ('Chapter 2', 60000)], [], False, 120000)
+
+
+def test_entries_are_returned_until_the_file_changes(build_mp3, tmp_path, metadata):
+    info = build_mp3(duration=10.0, markers=2)
+    cache = MetadataCache(tmp_path / 'cache.db')
+    assert cache.get(info['path']) is None
+
+    cache.put(info['path'], metadata)
+    cached = cache.get(info['path'])
+    assert cached.markers == metadata.markers
+    assert cached.chapters == metadata.chapters
+    assert cached.has_chapters is False
+    assert cached.duration == 120000
+
+    st = os.stat(info['path'])
+    os.utime(info['path'], ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert cache.get(info['path']) is None
+
+    cache.put(info['path'], metadata)
+    cache.invalidate(info['path'])
+    assert cache.get(info['path']) is None
+    cache.close()
+
+
+@pytest.mark.parametrize('hash_contents', [False, True])
+def test_hashing_catches_edits_that_keep_size_and_mtime(build_mp3, tmp_path, metadata, hash_contents):
+    info = build_mp3(duration=10.0, markers=2)
+    cache = MetadataCache(tmp_path / 'cache.db', hash_contents=hash_contents)
+    cache.put(info['path'], metadata)
+
+    # Overwrites some of the tag padding, at the end of the tag
+    _touch_bytes(info['path'], info['tag_size'] - 16, b'\xff' * 4, keep_mtime=True)
+
+    assert (cache.get(info['path']) is None) == hash_contents
+    cache.close()
+
+
+def test_files_are_opened_from_the_cache_without_reading_the_tag(build_mp3, tmp_path, monkeypatch):
+    info = build_mp3(duration=30.0, markers=3)
+    cache = MetadataCache(tmp_path / 'cache.db')
+    expected = list(Mp3File(info['path'], cache=cache).chapters.iter_milliseconds())
+
+    def read_tag(*args, **kwargs):
+        raise AssertionError("Tag read although it is cached")
+
+    monkeypatch.setattr(id3tag, 'read_tag', read_tag)
+    assert list(Mp3File(info['path'], cache=cache).chapters.iter_milliseconds()) == expected
+    cache.close()
+
+
+def test_seek_indices_are_kept_until_the_file_changes(build_mp3, tmp_path):
+    info = build_mp3(duration=10.0, markers=2)
+    cache = SeekIndexCache(tmp_path / 'cache.db')
+    index = build_seek_index(info['path'])
+    assert cache.get(info['path']) is None
+
+    cache.put(info['path'], index)
+    cached = cache.get(info['path'])
+    assert len(cached) == len(index)
+    assert [cached.offset_of(frame) for frame in range(len(index) + 1)] == \
+        [index.offset_of(frame) for frame in range(len(index) + 1)]
+
+    _touch_bytes(info['path'], info['tag_size'] - 16, b'\xff' * 4)
+    st = os.stat(info['path'])
+    os.utime(info['path'], ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert cache.get(info['path']) is None
+    cache.close()
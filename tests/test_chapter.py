@@ -0,0 +1,56 @@
+from chapter import Chapter, ChapterList, diff_chapters
+from mp3file import Mp3File
+from timestamp import Timestamp
+
+
+def _linear_chapter_at(chapters: ChapterList, ms: int):
+    return next((index for index, (_, start, end) in enumerate(chapters.iter_milliseconds()) if start <= ms < end),
+                None)
+
+
+def test_chapter_at_after_shifting_past_previous_chapter(build_mp3):
+    info = build_mp3(duration=60.0, markers=5)
+    chapters = Mp3File(info['path']).chapters
+    starts = list(chapters.starts)
+    assert chapters.chapter_at(Timestamp.from_milliseconds(starts[2])) == 2  # Caches the sorted order
+
+    # Moves chapter 2 onwards to before chapter 1, so the starts are no longer sorted
+    chapters.shift(2, starts[1] - starts[2] - 1000)
+
+    assert chapters.starts[2] < chapters.starts[1]
+    for ms in range(0, info['duration'], 100):
+        assert chapters.chapter_at(Timestamp.from_milliseconds(ms)) == _linear_chapter_at(chapters, ms)
+
+
+def test_chapter_at_matches_linear_search_after_shifts():
+    chapters = ChapterList.from_milliseconds(('Chapter {}'.format(i), i * 1000, (i + 1) * 1000) for i in range(1, 20))
+    for index, delta in ((5, -3000), (12, 2500), (3, -1500), (15, -9000)):
+        chapters.chapter_at(Timestamp.from_milliseconds(0))
+        chapters.shift(index, delta)
+        for ms in range(0, 22000, 250):
+            assert chapters.chapter_at(Timestamp.from_milliseconds(ms)) == _linear_chapter_at(chapters, ms)
+
+
+def test_chapters_are_found_by_value():
+    chapters = ChapterList.from_milliseconds([('One', 0, 1000), ('Two', 1000, 2000), ('One', 2000, 3000)])
+
+    assert chapters[1] in chapters
+    assert Chapter('Two', Timestamp.from_milliseconds(1000), Timestamp.from_milliseconds(1500)) not in chapters
+    assert chapters.index(chapters[2]) == 2
+    assert chapters.count(chapters[0]) == 1
+    assert len({chapters[0], chapters[0], chapters[1]}) == 2
+
+    chapters.remove(chapters[1])
+    assert list(chapters.iter_milliseconds()) == [('One', 0, 1000), ('One', 2000, 3000)]
+
+
+def test_diff_chapters_within_tolerance():
+    existing = ChapterList.from_milliseconds([('One', 0, 1000), ('Two', 1000, 2005), ('Three', 2005, 3000)])
+    computed = ChapterList.from_milliseconds([('One', 0, 1000), ('Two', 1000, 2000), ('Four', 2000, 3000),
+                                              ('Five', 3000, 4000)])
+
+    assert [(index, old is not None, new is not None) for index, old, new in diff_chapters(existing, computed)] == \
+        [(1, True, True), (2, True, True), (3, False, True)]
+    # Titles still have to match
+    assert [index for index, _, _ in diff_chapters(existing, computed, tolerance=5)] == [2, 3]
+    assert diff_chapters(computed, computed) == []
@@ -0,0 +1,109 @@
+import json
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+
+import chapterize_cmd
+import id3tag
+from chapter import ChapterList
+from fixtures import SAMPLE_RATE, SAMPLES_PER_FRAME
+
+
+def test_pipeline_hands_parsing_durations_and_snapping_to_worker_processes(build_mp3):
+    paths = [Path(build_mp3('part{}.mp3'.format(number), duration=120.0, markers=5, seed=number)['path'])
+             for number in range(3)]
+
+    serial, serial_stats = chapterize_cmd._run_pipeline(paths, False, 1, 2, 1, None, dry_run=True, snap=500)
+    pooled, pooled_stats = chapterize_cmd._run_pipeline(paths, False, 2, 2, 1, None, dry_run=True, snap=500)
+
+    assert pooled == serial
+    assert [result['status'] for result in pooled] == ['dry-run'] * 3
+    assert serial_stats.pool_tasks == 0
+    # Markers, duration and snapping of every file
+    assert pooled_stats.pool_tasks == 3 * len(paths)
+    assert pooled_stats.pool_processes >= 1
+
+
+def test_watch_chapterizes_a_file_once_and_ignores_its_own_save(build_mp3, tmp_path, monkeypatch):
+    import watch
+
+    library = tmp_path / 'library'
+    library.mkdir()
+    info = build_mp3('library/book.mp3', duration=20.0, markers=3)
+    original = os.stat(info['path']).st_mtime_ns
+    saved_at = []
+
+    class StoppingWatcher(watch.PollingWatcher):
+        def read(self, timeout):
+            # Stops a few settle times after the save, once its change has been seen
+            if len(saved_at) == 0 and os.stat(info['path']).st_mtime_ns != original:
+                saved_at.append(time.monotonic())
+            if len(saved_at) > 0 and time.monotonic() > saved_at[0] + 0.5:
+                raise KeyboardInterrupt
+            return super().read(min(timeout, 0.02))
+
+    monkeypatch.setattr(watch, 'create_watcher', lambda roots, poll_interval: StoppingWatcher(roots, 0.02))
+    status_file = str(tmp_path / 'status.json')
+
+    results = chapterize_cmd._run_watch([str(library)], False, 1, None, None, False, 0.05,
+                                        status_file=status_file)
+
+    assert [result['status'] for result in results] == ['chapterized']
+    with open(status_file) as f:
+        processed = json.load(f)['processed']
+    assert processed['chapterized'] == 1
+    assert processed['unchanged'] == 0
+
+
+def test_workers_ignore_ctrl_c():
+    with ProcessPoolExecutor(max_workers=1, initializer=chapterize_cmd._init_worker, initargs=(None,)) as executor:
+        assert executor.submit(signal.getsignal, signal.SIGINT).result() == signal.SIG_IGN
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_pipeline_snaps_chapter_starts_to_quiet_gaps(build_mp3, jobs):
+    frame_ms = SAMPLES_PER_FRAME * 1000 / SAMPLE_RATE
+    info = build_mp3(duration=30.0, markers=[('One', 0), ('Two', 10000), ('Three', 20000)],
+                     gain=lambda frame: 0 if 10500 <= frame * frame_ms < 10900 else 180)
+
+    results, _ = chapterize_cmd._run_pipeline([Path(info['path'])], False, jobs, 2, 1, None, snap=1500)
+
+    assert results[0]['status'] == 'chapterized'
+    starts = [ch.start.total_milliseconds for ch in id3tag.read_tag(info['path']).chapters]
+    assert starts[0] == 0 and starts[2] == 20000
+    assert abs(starts[1] - 10700) <= frame_ms
+
+
+def _read_bytes(path) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _read_chapters(path) -> list:
+    return [(ch.title, ch.start.total_milliseconds, ch.end.total_milliseconds)
+            for ch in id3tag.read_tag(path).chapters]
+
+
+def test_dry_run_and_tolerance_leave_matching_chapters_alone(build_mp3, capsys):
+    info = build_mp3(duration=30.0, markers=[('One', 0), ('Two', 10000), ('Three', 20000)])
+    path = Path(info['path'])
+    assert chapterize_cmd._chapterize_file(path)['status'] == 'chapterized'
+    computed = _read_chapters(path)
+
+    # Existing chapters a few milliseconds off, as written by another tool
+    id3tag.save_chapters(path, ChapterList.from_milliseconds((title, start + 3 if start > 0 else 0, end)
+                                                              for title, start, end in computed))
+    before = _read_bytes(path)
+    capsys.readouterr()
+
+    assert chapterize_cmd._chapterize_file(path, overwrite=True, dry_run=True)['status'] == 'dry-run'
+    assert "Chapters differ: 2 changed, 0 added, 0 removed." in capsys.readouterr().out
+    assert chapterize_cmd._chapterize_file(path, overwrite=True, tolerance=3)['status'] == 'unchanged'
+    assert _read_bytes(path) == before
+
+    assert chapterize_cmd._chapterize_file(path, overwrite=True, tolerance=2)['status'] == 'chapterized'
+    assert _read_chapters(path) == computed
@@ -0,0 +1,76 @@
+import pytest
+
+from duration import CBR, INFO, SCAN, XING, SeekIndex, build_seek_index, parse_frame_header, read_duration
+from fixtures import SAMPLE_RATE, SAMPLES_PER_FRAME
+
+# Position of the LAME extension in the header frame of a mono fixture: the side information, then the Xing
+# fields with frame count, byte count, table of contents and quality
+_LAME_POS = 4 + 17 + 8 + 4 + 4 + 100 + 4
+
+
+def _add_lame_tag(info: dict, delay: int, padding: int) -> None:
+    with open(info['path'], 'r+b') as f:
+        f.seek(info['tag_size'] + _LAME_POS)
+        f.write(b'LAME3.100' + bytes(12) + bytes([delay >> 4, (delay & 0x0F) << 4 | padding >> 8, padding & 0xFF]))
+
+
+@pytest.mark.parametrize('vbr, method', [(False, INFO), (True, XING)])
+def test_duration_from_header(build_mp3, vbr, method):
+    info = build_mp3(duration=30.0, vbr=vbr)
+    duration = read_duration(info['path'])
+    assert duration.method == method
+    assert duration.frames == info['frames']
+    assert duration.milliseconds == info['duration']
+
+
+def test_duration_leaves_out_encoder_delay_and_padding(build_mp3):
+    info = build_mp3(duration=30.0, vbr=True)
+    _add_lame_tag(info, 576, 1500)
+
+    duration = read_duration(info['path'])
+
+    assert (duration.encoder_delay, duration.encoder_padding) == (576, 1500)
+    assert duration.milliseconds == (info['frames'] * SAMPLES_PER_FRAME - 576 - 1500) * 1000 // SAMPLE_RATE
+
+
+@pytest.mark.parametrize('vbr, method', [(False, CBR), (True, SCAN)])
+def test_duration_without_header(build_mp3, vbr, method):
+    info = build_mp3(duration=30.0, vbr=vbr)
+    with open(info['path'], 'r+b') as f:
+        # Turns the header frame into a plain silent frame
+        f.seek(info['tag_size'] + 4 + 17)
+        f.write(bytes(4))
+
+    duration = read_duration(info['path'])
+
+    assert duration.method == method
+    # The header frame is then counted as audio
+    assert abs(duration.milliseconds - info['duration']) <= SAMPLES_PER_FRAME * 1000 // SAMPLE_RATE + 1
+
+
+@pytest.mark.parametrize('vbr', [False, True])
+def test_seek_index_maps_times_to_frame_headers(build_mp3, vbr):
+    info = build_mp3(duration=30.0, vbr=vbr, markers=2)
+    index = build_seek_index(info['path'])
+    with open(info['path'], 'rb') as f:
+        audio = f.read()[info['tag_size']:]
+
+    # The header frame holds no audio and is left out
+    assert len(index) == info['frames']
+    assert index.audio_size == len(audio)
+    headers = [parse_frame_header(audio, index.offset_of(frame)) for frame in range(len(index))]
+    assert all(header is not None for header in headers)
+    assert [index.offset_of(frame) + header.length for frame, header in enumerate(headers)] == \
+        [index.offset_of(frame) for frame in range(1, len(index) + 1)]
+
+    frame_ms = SAMPLES_PER_FRAME * 1000 / SAMPLE_RATE
+    for frame in (0, 1, 100, len(index) - 1):
+        assert index.frame_at(index.time_at(frame)) == frame
+        assert index.nearest_frame(round(frame * frame_ms)) == frame
+        assert index.frame_at_offset(index.offset_of(frame) + 1) == frame
+    assert index.offset_at(info['duration'] + 1000) == index.audio_size
+
+    restored = SeekIndex.from_bytes(index.to_bytes())
+    assert [restored.offset_of(frame) for frame in range(len(restored) + 1)] == \
+        [index.offset_of(frame) for frame in range(len(index) + 1)]
+    assert (restored.sample_rate, restored.samples_per_frame) == (SAMPLE_RATE, SAMPLES_PER_FRAME)
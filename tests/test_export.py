@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import fileio
+import id3tag
+from audiobook import Audiobook
+from duration import read_duration
+from export import merge_book, split_chapters
+from fixtures import SAMPLE_RATE, SAMPLES_PER_FRAME
+from mp3file import Mp3File
+
+_FRAME_MS = SAMPLES_PER_FRAME * 1000 / SAMPLE_RATE
+
+
+def test_split_writes_a_file_per_chapter(build_mp3, tmp_path):
+    info = build_mp3(duration=60.0, markers=4)
+    chapters = Mp3File(info['path']).chapters
+    out_dir = tmp_path / 'split'
+
+    planned = split_chapters(info['path'], chapters, out_dir, dry_run=True)
+    assert not out_dir.exists()
+    written = split_chapters(info['path'], chapters, out_dir)
+
+    assert written == planned
+    assert [path.name for path, _ in written] == sorted(os.listdir(out_dir))
+    frames = 0
+    for (path, size), (title, start, end) in zip(written, chapters.iter_milliseconds()):
+        assert os.path.getsize(path) == size
+        assert id3tag.read_tag(path, decode=(b'TIT2',)).text_frames[b'TIT2'] == title
+        duration = read_duration(path)
+        assert abs(duration.milliseconds - (end - start)) <= _FRAME_MS
+        frames += duration.frames
+    assert frames == info['frames']
+
+
+def test_split_fails_without_files_on_a_short_copy(build_mp3, tmp_path, monkeypatch):
+    info = build_mp3(duration=60.0, markers=4)
+    chapters = Mp3File(info['path']).chapters
+    monkeypatch.setattr(fileio, 'copy_range', lambda src, dst, offset, count: count - 1)
+
+    with pytest.raises(IOError):
+        split_chapters(info['path'], chapters, tmp_path / 'split')
+
+    assert os.listdir(tmp_path / 'split') == []
+
+
+def _build_parts(build_mp3, directory):
+    directory.mkdir()
+    return [build_mp3('parts/Part{}.mp3'.format(index), duration=20.0, markers=2, seed=index) for index in (1, 2, 3)]
+
+
+def test_merge_joins_the_parts_into_one_chaptered_file(build_mp3, tmp_path):
+    parts = _build_parts(build_mp3, tmp_path / 'parts')
+    book = Audiobook(tmp_path / 'parts')
+
+    chapters, size = merge_book(tmp_path / 'parts', tmp_path / 'book.mp3')
+
+    assert os.path.getsize(tmp_path / 'book.mp3') == size
+    duration = read_duration(tmp_path / 'book.mp3')
+    assert duration.frames == sum(part['frames'] for part in parts)
+    tag = id3tag.read_tag(tmp_path / 'book.mp3')
+    assert chapters == len(tag.chapters) == len(book.chapters)
+    assert [ch.title for ch in tag.chapters] == book.chapters.titles
+    assert [ch.start.total_milliseconds for ch in tag.chapters] == list(book.chapters.starts)
+
+
+def test_merge_fails_without_a_file_on_a_short_copy(build_mp3, tmp_path, monkeypatch):
+    _build_parts(build_mp3, tmp_path / 'parts')
+    monkeypatch.setattr(fileio, 'copy_range', lambda src, dst, offset, count: count - 1)
+
+    with pytest.raises(IOError):
+        merge_book(tmp_path / 'parts', tmp_path / 'book.mp3')
+
+    assert sorted(os.listdir(tmp_path)) == ['parts']
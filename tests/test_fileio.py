@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import fileio
+import id3tag
+from chapter import ChapterList
+
+
+def _no_copy(*args):
+    return 0
+
+
+@pytest.mark.parametrize('disabled', [('copy_file_range',), ('copy_file_range', 'sendfile')])
+def test_copy_range_falls_back_when_a_method_copies_nothing(tmp_path, monkeypatch, disabled):
+    for name in disabled:
+        monkeypatch.setattr(os, name, _no_copy, raising=False)
+    data = os.urandom(100000)
+    (tmp_path / 'src').write_bytes(data)
+    with open(tmp_path / 'src', 'rb') as src, open(tmp_path / 'dst', 'w+b') as dst:
+        dst.write(b'head')
+        assert fileio.copy_range(src, dst, 1000, 50000) == 50000
+        dst.write(b'tail')
+    assert (tmp_path / 'dst').read_bytes() == b'head' + data[1000:51000] + b'tail'
+
+
+def test_copy_exact_raises_when_the_source_ends_first(tmp_path):
+    (tmp_path / 'src').write_bytes(bytes(1000))
+    with open(tmp_path / 'src', 'rb') as src, open(tmp_path / 'dst', 'wb') as dst:
+        with pytest.raises(IOError):
+            fileio.copy_exact(src, dst, 500, 1000)
+
+
+def test_rewrite_keeps_the_audio_when_copy_file_range_copies_nothing(build_mp3, monkeypatch):
+    monkeypatch.setattr(os, 'copy_file_range', _no_copy, raising=False)
+    info = build_mp3(duration=30.0, markers=5, padding=0)
+    with open(info['path'], 'rb') as f:
+        audio = f.read()[info['tag_size']:]
+
+    id3tag.write_chapters(info['path'], ChapterList.from_milliseconds(
+        ('Chapter {}'.format(i), i * 100, (i + 1) * 100) for i in range(50)))
+
+    tag = id3tag.read_tag(info['path'])
+    with open(info['path'], 'rb') as f:
+        assert f.read()[tag.size:] == audio
+
+
+def test_short_copy_leaves_the_original_in_place(build_mp3, monkeypatch):
+    info = build_mp3(duration=30.0, markers=5, padding=0)
+    with open(info['path'], 'rb') as f:
+        before = f.read()
+    monkeypatch.setattr(fileio, 'copy_range', lambda src, dst, offset, count: 0)
+
+    with pytest.raises(IOError):
+        id3tag.write_chapters(info['path'], ChapterList.from_milliseconds(
+            ('Chapter {}'.format(i), i * 100, (i + 1) * 100) for i in range(50)))
+
+    with open(info['path'], 'rb') as f:
+        assert f.read() == before
+    assert os.listdir(os.path.dirname(info['path'])) == [os.path.basename(info['path'])]
@@ -0,0 +1,127 @@
+import os
+import struct
+
+import pytest
+
+import id3tag
+from chapter import ChapterList
+from duration import build_seek_index, parse_frame_header
+
+
+def test_read_tag_finds_markers_and_chapters(build_mp3):
+    info = build_mp3(duration=30.0, markers=5, chapters=True)
+    tag = id3tag.read_tag(info['path'])
+    assert tag.size == info['tag_size']
+    assert tag.has_chapters
+    assert [ch.title for ch in tag.chapters] == [name for name, _ in info['markers']]
+    assert [ch.start.total_milliseconds for ch in tag.chapters] == [start for _, start in info['markers']]
+
+
+def test_write_chapters_in_place_keeps_other_frames(build_mp3):
+    info = build_mp3(duration=30.0, markers=5, cover_size=64 * 1024, padding=8192)
+    with open(info['path'], 'rb') as f:
+        before = f.read()
+    chapters = ChapterList.from_milliseconds([('One', 0, 10000), ('Two', 10000, info['duration'])])
+
+    id3tag.write_chapters(info['path'], chapters)
+
+    with open(info['path'], 'rb') as f:
+        after = f.read()
+    assert len(after) == len(before)
+    assert after[info['tag_size']:] == before[info['tag_size']:]
+    tag = id3tag.read_tag(info['path'])
+    assert [ch.title for ch in tag.chapters] == ['One', 'Two']
+    assert tag.media_markers is not None
+
+
+def test_write_chapters_grows_tag(build_mp3):
+    info = build_mp3(duration=30.0, markers=5, padding=0)
+    with open(info['path'], 'rb') as f:
+        audio = f.read()[info['tag_size']:]
+    chapters = ChapterList.from_milliseconds(('Chapter {}'.format(i), i * 100, (i + 1) * 100) for i in range(50))
+
+    id3tag.write_chapters(info['path'], chapters)
+
+    tag = id3tag.read_tag(info['path'])
+    assert tag.size > info['tag_size'] + id3tag.DEFAULT_PADDING
+    assert len(tag.chapters) == 50
+    with open(info['path'], 'rb') as f:
+        assert f.read()[tag.size:] == audio
+
+
+def test_frames_behind_chapters_are_moved_through_a_new_file(build_mp3):
+    info = build_mp3(duration=30.0, markers=5, chapters=True, cover_size=32 * 1024, padding=8192)
+    with open(info['path'], 'rb') as f:
+        data = bytearray(f.read())
+    # Puts the chapter frames first, so that replacing them moves the cover art
+    tag = id3tag.read_tag(info['path'], decode=())
+    frames = [bytes(data[frame.offset:frame.offset + 10 + frame.size]) for frame in tag.frames]
+    chapter_frames = [raw for frame, raw in zip(tag.frames, frames) if frame.id in (b'CHAP', b'CTOC')]
+    other_frames = [raw for frame, raw in zip(tag.frames, frames) if frame.id not in (b'CHAP', b'CTOC')]
+    body = b''.join(chapter_frames + other_frames)
+    data[10:10 + len(body)] = body
+    with open(info['path'], 'wb') as f:
+        f.write(data)
+    inode = os.stat(info['path']).st_ino
+
+    id3tag.write_chapters(info['path'], ChapterList.from_milliseconds([('Only', 0, info['duration'])]))
+
+    assert os.stat(info['path']).st_ino != inode
+    tag = id3tag.read_tag(info['path'], decode=())
+    with open(info['path'], 'rb') as f:
+        after = f.read()
+    assert tag.size == info['tag_size']
+    assert [bytes(after[frame.offset:frame.offset + 10 + frame.size]) for frame in tag.frames
+            if frame.id not in (b'CHAP', b'CTOC')] == other_frames
+    assert [ch.title for ch in id3tag.read_tag(info['path']).chapters] == ['Only']
+
+
+def _chapter_offsets(path) -> list:
+    with open(path, 'rb') as f, id3tag.FrameIndex(f) as index:
+        payloads = [bytes(index.payload(frame)) for frame in index.find(b'CHAP')]
+    return [struct.unpack('>IIII', payload[payload.index(b'\x00') + 1:][:16]) for payload in payloads]
+
+
+@pytest.mark.parametrize('padding', [8192, 0])
+def test_write_chapters_with_byte_offsets(build_mp3, padding):
+    info = build_mp3(duration=30.0, markers=3, padding=padding)
+    seek_index = build_seek_index(info['path'])
+    chapters = ChapterList.from_milliseconds([('One', 0, 10000), ('Two', 10000, 20000),
+                                              ('Three', 20000, info['duration'])])
+
+    id3tag.write_chapters(info['path'], chapters, seek_index=seek_index)
+
+    tag_size = id3tag.read_tag(info['path']).size
+    with open(info['path'], 'rb') as f:
+        data = f.read()
+    offsets = _chapter_offsets(info['path'])
+    assert [(start, end) for start, end, _, _ in offsets] == [(start, end) for _, start, end in
+                                                              chapters.iter_milliseconds()]
+    for start, end, start_offset, end_offset in offsets:
+        assert start_offset == tag_size + seek_index.offset_at(start)
+        assert end_offset == tag_size + seek_index.offset_at(end)
+        assert parse_frame_header(data, start_offset) is not None
+        assert seek_index.frame_at_offset(start_offset - tag_size) == seek_index.frame_at(start)
+
+
+def test_frame_index_locates_frames_without_decoding_them(build_mp3):
+    info = build_mp3(duration=10.0, markers=3, chapters=True, cover_size=32 * 1024)
+    with open(info['path'], 'rb') as f:
+        data = f.read(info['tag_size'])
+
+    with open(info['path'], 'rb') as f, id3tag.FrameIndex(f) as index:
+        assert index.size == info['tag_size']
+        assert [len(index.find(frame_id)) for frame_id in (b'TXXX', b'APIC', b'CTOC', b'CHAP')] == [1, 1, 1, 3]
+        # Frames follow each other from behind the header up to the padding
+        assert index.frames[0].offset == 10
+        assert all(frame.offset + 10 + frame.size == following.offset
+                   for frame, following in zip(index.frames, index.frames[1:]))
+        for frame in index.frames:
+            assert data[frame.offset:frame.offset + 4] == frame.id
+            assert bytes(index.body(frame)) == data[frame.offset + 10:frame.offset + 10 + frame.size]
+        cover, = index.find(b'APIC')
+        assert cover.size > 32 * 1024
+
+    tag = id3tag.read_tag(info['path'], decode=(b'CHAP',))
+    assert len(tag.chapter_frames) == 3
+    assert tag.user_text_frames == {} and tag.text_frames == {} and tag.toc_frames == []
@@ -0,0 +1,67 @@
+import os
+
+import chapterize_cmd
+from cache import ChapterizedState
+from library import LibraryScanner
+
+
+def _library(build_mp3, tmp_path):
+    for name in ('b/two.mp3', 'a/one.MP3', 'a/deep/three.mp3', 'four.mp3'):
+        (tmp_path / os.path.dirname(name)).mkdir(parents=True, exist_ok=True)
+        build_mp3(name, duration=10.0, markers=2)
+    (tmp_path / 'a' / 'cover.jpg').write_bytes(b'\xff\xd8')
+    (tmp_path / 'notes.mp3.txt').write_text('')
+    return [str(tmp_path / name) for name in ('four.mp3', 'a/one.MP3', 'a/deep/three.mp3', 'b/two.mp3')]
+
+
+def test_scanner_finds_mp3_files_of_a_directory_before_its_subdirectories(build_mp3, tmp_path):
+    expected = _library(build_mp3, tmp_path)
+
+    scanner = LibraryScanner()
+    assert [str(path) for path in scanner.scan([str(tmp_path)])] == expected
+    assert scanner.found == 4
+    assert scanner.unchanged == 0
+
+    flat = LibraryScanner(recursive=False)
+    assert [str(path) for path in flat.scan([str(tmp_path)])] == [str(tmp_path / 'four.mp3')]
+
+
+def test_scanner_skips_files_unchanged_since_they_were_chapterized(build_mp3, tmp_path):
+    paths = _library(build_mp3, tmp_path)
+    state = ChapterizedState(tmp_path / 'cache.db')
+    for path in paths[:2]:
+        state.record(path)
+
+    scanner = LibraryScanner(state)
+    assert [str(path) for path in scanner.scan([str(tmp_path)])] == paths[2:]
+    assert scanner.found == 4
+    assert scanner.unchanged == 2
+
+    st = os.stat(paths[0])
+    os.utime(paths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    scanner = LibraryScanner(state)
+    assert [str(path) for path in scanner.scan([str(tmp_path)])] == [paths[0]] + paths[2:]
+    assert scanner.unchanged == 1
+    state.close()
+
+
+def test_chapterized_files_are_skipped_on_the_next_run(build_mp3, tmp_path):
+    info = build_mp3(duration=20.0, markers=3)
+    state = ChapterizedState(tmp_path / 'cache.db')
+
+    results, _ = chapterize_cmd._run_pipeline(LibraryScanner(state).scan([str(tmp_path)]), False, 1, 1, 1, None,
+                                              state)
+    assert [result['status'] for result in results] == ['chapterized']
+    assert state.unchanged(info['path'])
+
+    scanner = LibraryScanner(state)
+    results, stats = chapterize_cmd._run_pipeline(scanner.scan([str(tmp_path)]), False, 1, 1, 1, None, state)
+    assert results == []
+    assert stats is None
+    assert scanner.unchanged == 1
+
+    # A dry run changes nothing, so it is not remembered
+    other = build_mp3('other.mp3', duration=20.0, markers=3)
+    chapterize_cmd._run_pipeline([other['path']], False, 1, 1, 1, None, state, dry_run=True)
+    assert not state.unchanged(other['path'])
+    state.close()
@@ -0,0 +1,21 @@
+from cache import MetadataCache
+from mp3file import Mp3File
+
+
+def test_saving_updates_the_chapters_read_from_the_file(build_mp3, tmp_path):
+    info = build_mp3(markers=4)
+    cache = MetadataCache(tmp_path / 'cache.db')
+    mp3 = Mp3File(info['path'], cache=cache)
+    assert not mp3.has_id3v2_chapters
+
+    mp3.save()
+    expected = list(mp3.chapters.iter_milliseconds())
+    for reopened in (mp3, Mp3File(info['path'], cache=cache), Mp3File(info['path'])):
+        assert reopened.has_id3v2_chapters
+        assert list(reopened.id3v2_chapters.iter_milliseconds()) == expected
+
+    mp3.clean()
+    for reopened in (mp3, Mp3File(info['path'], cache=cache), Mp3File(info['path'])):
+        assert not reopened.has_id3v2_chapters
+        assert len(reopened.id3v2_chapters) == 0
+    cache.close()
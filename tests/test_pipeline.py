@@ -0,0 +1,32 @@
+import time
+
+from pipeline import Stage, run_pipeline
+
+
+class _Item(object):
+    def __init__(self, number: int):
+        self.number = number
+        self.done = False
+        self.output = None
+        self.steps = []
+
+
+def test_items_are_reported_in_order_and_done_items_skip_stages():
+    def slow_for_even(item):
+        time.sleep(0.01 if item.number % 2 == 0 else 0)
+        item.steps.append('first')
+        item.done = item.number == 3
+
+    def second(item):
+        item.steps.append('second')
+
+    reported = []
+    stats = run_pipeline((_Item(number) for number in range(10)),
+                         [Stage('first', slow_for_even, workers=3), Stage('second', second, workers=2, limit='one')],
+                         reported.append, limits={'one': 1})
+
+    assert [item.number for item in reported] == list(range(10))
+    assert reported[3].steps == ['first']
+    assert all(item.steps == ['first', 'second'] for item in reported if item.number != 3)
+    assert stats.items == 10
+    assert [stage.items for stage in stats.stages] == [10, 10, 9]
@@ -0,0 +1,49 @@
+import pytest
+
+import id3tag
+import profiling
+from chapter import ChapterList
+
+
+@pytest.fixture
+def records(monkeypatch):
+    monkeypatch.setattr(profiling, '_enabled', True)
+    profiling.take_records()
+    yield profiling.take_records
+    profiling.take_records()
+
+
+@pytest.fixture(params=['kernel', 'uncounted'])
+def counters(request, monkeypatch):
+    """
+    The I/O counters of the kernel, or counters that see no in-kernel copies, nor anything else
+    """
+    if request.param == 'uncounted':
+        monkeypatch.setattr(profiling, '_io_counters', lambda: (0, 0))
+    elif profiling._IO_COUNTERS is None:
+        pytest.skip("No per-thread I/O counters")
+    return request.param
+
+
+def test_reading_a_mapped_tag_counts_the_tag(build_mp3, records, counters):
+    info = build_mp3(duration=30.0, cover_size=300 * 1024)
+
+    with profiling.stage('read_tag', info['path']):
+        id3tag.read_tag(info['path'])
+
+    record, = records()
+    assert record['bytes_read'] >= info['tag_size']
+
+
+def test_rewriting_a_file_counts_the_audio_once(build_mp3, records, counters):
+    info = build_mp3(duration=30.0, padding=0)
+    chapters = ChapterList.from_milliseconds(('Chapter {}'.format(i), i * 100, (i + 1) * 100) for i in range(50))
+
+    with profiling.stage('save', info['path']):
+        written = id3tag.write_chapters(info['path'], chapters)
+
+    record = [record for record in records() if record['stage'] == 'save'][0]
+    assert info['audio_size'] <= record['bytes_written'] <= written
+    assert record['bytes_read'] >= info['audio_size']
+    if counters == 'kernel':
+        assert record['bytes_read'] < 2 * info['size']
@@ -0,0 +1,42 @@
+import pytest
+
+from chapter import ChapterList
+from fixtures import SAMPLE_RATE, SAMPLES_PER_FRAME
+from snap import snap_chapters
+
+_FRAME_MS = SAMPLES_PER_FRAME * 1000 / SAMPLE_RATE
+
+# Quiet gaps in otherwise loud audio, as (start, end) in milliseconds
+_GAPS = [(10500, 10900), (17000, 17400), (24000, 24400)]
+
+
+def _gain(frame: int) -> int:
+    ms = frame * _FRAME_MS
+    return 0 if any(start <= ms < end for start, end in _GAPS) else 180
+
+
+@pytest.mark.parametrize('vbr', [False, True])
+def test_chapter_starts_move_to_the_nearest_quiet_gap_within_the_window(build_mp3, vbr):
+    info = build_mp3(duration=30.0, vbr=vbr, gain=_gain)
+    chapters = ChapterList.from_milliseconds([('One', 0, 10000), ('Two', 10000, 20000), ('Three', 20000, 25000),
+                                              ('Four', 25000, info['duration'])])
+
+    moves = snap_chapters(info['path'], chapters, max_shift=1500, min_silence=200)
+
+    # The gap of Three is 2.6 s away, beyond the window
+    assert [(position, old) for position, old, _ in moves] == [(1, 10000), (3, 25000)]
+    for position, old, new in moves:
+        assert abs(new - old) <= 1500
+    starts = list(chapters.starts)
+    assert abs(starts[1] - 10700) <= _FRAME_MS
+    assert abs(starts[3] - 24200) <= _FRAME_MS
+    assert starts[0] == 0 and starts[2] == 20000
+    assert list(chapters.ends)[:3] == starts[1:]
+
+
+def test_silent_audio_leaves_chapters_alone(build_mp3):
+    info = build_mp3(duration=30.0)
+    chapters = ChapterList.from_milliseconds([('One', 0, 10000), ('Two', 10000, info['duration'])])
+
+    assert snap_chapters(info['path'], chapters, max_shift=1500) == []
+    assert list(chapters.starts) == [0, 10000]
@@ -0,0 +1,25 @@
+import pytest
+
+import fixtures
+from overdrive import iter_markers
+from timestamp import Timestamp, parse_milliseconds
+
+
+@pytest.mark.parametrize('text, milliseconds', [('0', 0), ('0.5', 500), ('1:02.25', 62250), ('1:00:00', 3600000),
+                                                ('12.3456', 12346), ('.5', 500)])
+def test_parse_milliseconds(text, milliseconds):
+    assert parse_milliseconds(text) == milliseconds
+
+
+@pytest.mark.parametrize('text', ['-0.5', '-1', '-1:00.000', '1:-30.000', ' -0:00.500'])
+def test_parse_milliseconds_rejects_negative_times(text):
+    with pytest.raises(ValueError):
+        parse_milliseconds(text)
+    with pytest.raises(ValueError):
+        Timestamp.from_string(text)
+
+
+def test_markers_with_negative_times_are_skipped():
+    markers = [('Intro', 0), ('Chapter 1', 1500), ('Chapter 2', 62250)]
+    xml = fixtures.markers_xml(markers).replace(fixtures._format_time(1500), '-0:00.500')
+    assert list(iter_markers(xml)) == [('Intro', 0), ('Chapter 2', 62250)]
@@ -1,90 +1,153 @@
+def parse_milliseconds(s: str) -> int:
+    """
+    Parse a string into a number of milliseconds, without creating a Timestamp
+    :param s: a string formatted as [[hh:]mm:]ss[.zzz]
+    :return: number of milliseconds
+    :raises ValueError: if s is not a valid timestamp, or is negative
+    """
+    time_comp = s.strip().split(':')
+    if len(time_comp) > 3:
+        raise ValueError("Invalid timestamp: {}".format(s))
+    if any(comp.strip().startswith('-') for comp in time_comp):
+        # int() would accept a sign on any component, and the fraction would then count the wrong way
+        raise ValueError("Timestamps cannot be negative: {}".format(s))
+
+    secs, _, frac = time_comp[-1].partition('.')
+    millisecs = int(secs or '0') * 1000
+    if frac != '':
+        if not frac.isdigit():
+            raise ValueError("Invalid timestamp: {}".format(s))
+        millisecs += int(frac[:3].ljust(3, '0'))
+        if len(frac) > 3 and frac[3] >= '5':
+            millisecs += 1  # Round to the nearest millisecond
+    if len(time_comp) > 1:
+        millisecs += int(time_comp[-2]) * 60000
+        if len(time_comp) > 2:
+            millisecs += int(time_comp[-3]) * 3600000
+    return millisecs
+
+
 class Timestamp(object):
+    """
+    A point in time stored as a whole number of milliseconds. Timestamps are immutable.
+    """
+    __slots__ = ('_ms', '_str')
+
     def __init__(self, hours: int = 0, mins: int = 0, secs: float = 0.0):
-        self.hours = hours
-        self.minutes = mins
-        self.seconds = secs
+        if hours < 0:
+            raise ValueError("Hours cannot be negative")
+        if mins < 0:
+            raise ValueError("Minutes cannot be negative")
+        elif mins >= 60:
+            raise ValueError("Minutes cannot be more than 59")
+        if secs < 0.0:
+            raise ValueError("Seconds cannot be negative")
+        elif secs >= 60.0:
+            raise ValueError("Seconds cannot be more than 60.0")
+        self._ms = (hours * 3600 + mins * 60) * 1000 + int(round(secs * 1000))
+        self._str = None
 
     @classmethod
     def from_string(cls, s):
         """
-        Parse a string into a Timestamp
+        Parse a string into a Timestamp. Seconds are read digit by digit, so that
+        a string produced by str() parses back to exactly the same Timestamp.
         :param s: a string formatted as [[hh:]mm:]ss[.zzz]
         :return: a Timestamp
         """
-        time_comp = s.strip().split(':')
-
-        hours = 0
-        mins = 0
-        secs = 0.0
-        if len(time_comp) > 0:
-            secs = float(time_comp[-1])
-            if len(time_comp) > 1:
-                mins = int(time_comp[-2])
-                if len(time_comp) > 2:
-                    hours = int(time_comp[-3])
-
-        # Safety checks if ths string is not well formatted
-        if secs >= 60.0:
-            add_mins = int(secs) // 60
-            secs -= add_mins * 60.0
-            mins += add_mins
-
-        if mins >= 60:
-            add_hours = mins // 60
-            mins -= add_hours * 60
-            hours += add_hours
-        # Safety checks end
-
-        return cls(hours=hours, mins=mins, secs=secs)
+        # Minutes and seconds of 60 or more are carried over, as the total is all that is stored
+        return cls.from_milliseconds(parse_milliseconds(s))
 
     @classmethod
     def from_milliseconds(cls, millisecs: int):
-        secs = millisecs / 1000.0
+        if millisecs < 0:
+            raise ValueError("Timestamp cannot be negative")
+        ts = cls.__new__(cls)
+        ts._ms = int(millisecs)
+        ts._str = None
+        return ts
 
-        hours = int(secs) // 3600
-        secs -= hours * 3600.0
-
-        mins = int(secs) // 60
-        secs -= mins * 60.0
+    def __str__(self):
+        if self._str is None:
+            secs, millisecs = divmod(self._ms, 1000)
+            mins, secs = divmod(secs, 60)
+            hours, mins = divmod(mins, 60)
+            self._str = "{hh:02d}:{mm:02d}:{ss:02d}.{zzz:03d}".format(hh=hours, mm=mins, ss=secs, zzz=millisecs)
+        return self._str
+
+    def __repr__(self):
+        return "Timestamp('{}')".format(self)
+
+    def __eq__(self, other):
+        if isinstance(other, Timestamp):
+            return self._ms == other._ms
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, Timestamp):
+            return self._ms != other._ms
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, Timestamp):
+            return self._ms < other._ms
+        return NotImplemented
+
+    def __le__(self, other):
+        if isinstance(other, Timestamp):
+            return self._ms <= other._ms
+        return NotImplemented
+
+    def __gt__(self, other):
+        if isinstance(other, Timestamp):
+            return self._ms > other._ms
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, Timestamp):
+            return self._ms >= other._ms
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._ms)
+
+    def __add__(self, other):
+        """
+        Offsets a Timestamp
+        :param other: a Timestamp or a number of milliseconds
+        :return: a new Timestamp
+        """
+        if isinstance(other, Timestamp):
+            return Timestamp.from_milliseconds(self._ms + other._ms)
+        if isinstance(other, int):
+            return Timestamp.from_milliseconds(self._ms + other)
+        return NotImplemented
 
-        return Timestamp(hours=hours, mins=mins, secs=secs)
+    __radd__ = __add__
 
-    def __str__(self):
-        return "{hh:02d}:{mm:02d}:{ss:06.3f}".format(hh=self.hours, mm=self.minutes, ss=self.seconds)
+    def __sub__(self, other):
+        """
+        Offsets a Timestamp backwards
+        :param other: a Timestamp or a number of milliseconds
+        :return: a new Timestamp
+        """
+        if isinstance(other, Timestamp):
+            return Timestamp.from_milliseconds(self._ms - other._ms)
+        if isinstance(other, int):
+            return Timestamp.from_milliseconds(self._ms - other)
+        return NotImplemented
 
     @property
     def hours(self) -> int:
-        return self._hours
-
-    @hours.setter
-    def hours(self, hours: int):
-        if hours < 0:
-            raise ValueError("Hours cannot be negative")
-        self._hours = hours
+        return self._ms // 3600000
 
     @property
-    def minutes(self):
-        return self._mins
-
-    @minutes.setter
-    def minutes(self, mins):
-        if mins < 0:
-            raise ValueError("Minutes cannot be negative")
-        elif mins >= 60:
-            raise ValueError("Minutes cannot be more than 59")
-        self._mins = mins
+    def minutes(self) -> int:
+        return self._ms // 60000 % 60
 
     @property
-    def seconds(self):
-        return self._secs
-
-    @seconds.setter
-    def seconds(self, secs):
-        if secs < 0.0:
-            raise ValueError("Seconds cannot be negative")
-        elif secs >= 60.0:
-            raise ValueError("Seconds cannot be more than 60.0")
-        self._secs = secs
+    def seconds(self) -> float:
+        return self._ms % 60000 / 1000.0
 
     @property
     def total_milliseconds(self) -> int:
@@ -92,5 +155,4 @@ class Timestamp(object):
         Converts hh:mm:ss.zzz into integer milliseconds
         :return: number of milliseconds
         """
-        seconds = (self.hours * 3600) + (self.minutes * 60) + self.seconds
-        return int(seconds * 1000)
+        return self._ms
@@ -0,0 +1,247 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from library import LibraryScanner
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def _is_mp3(name: str) -> bool:
+    return name.lower().endswith('.mp3')
+
+
+class PollingWatcher(object):
+    kind = 'polling'
+
+    def __init__(self, roots: Iterable[str], interval: float = 30.0):
+        """
+        Finds new and changed mp3 files by comparing the size and modification time of all files
+        in the watched directories against the previous scan
+        :param roots: directories to watch, including their subdirectories
+        :param interval: seconds between scans
+        """
+        self._roots = list(roots)
+        self._interval = interval
+        self._next_scan = time.monotonic() + interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for entry in LibraryScanner().entries(self._roots):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout: float) -> List[str]:
+        """
+        Waits for changes
+        :param timeout: maximum seconds to wait
+        :return: paths of new or changed mp3 files, possibly none
+        """
+        remaining = self._next_scan - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return []
+        if remaining > 0:
+            time.sleep(remaining)
+        self._next_scan = time.monotonic() + self._interval
+
+        snapshot = self._scan()
+        changed = [path for path, key in snapshot.items() if self._snapshot.get(path) != key]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(object):
+    kind = 'inotify'
+
+    def __init__(self, roots: Iterable[str]):
+        """
+        Receives changes to mp3 files from the Linux kernel through inotify, called via ctypes
+        :param roots: directories to watch, including their subdirectories
+        :raise OSError: if inotify is not available
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("C library not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+
+        self._roots = list(roots)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._directories = {}  # type: Dict[int, str]
+        try:
+            for root in self._roots:
+                self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self._directories[wd] = directory
+
+    def _watch_tree(self, directory: str) -> List[str]:
+        """
+        Watches a directory and all its subdirectories
+        :return: mp3 files already in them, e.g. when a whole directory was moved in
+        """
+        self._watch(directory)
+        found = []
+        for entry in LibraryScanner().entries([directory], directories=True):
+            if entry.is_dir(follow_symlinks=False):
+                self._watch(entry.path)
+            else:
+                found.append(entry.path)
+        return found
+
+    def _rescan(self) -> List[str]:
+        return [entry.path for entry in LibraryScanner().entries(self._roots)]
+
+    def read(self, timeout: float) -> List[str]:
+        """
+        Waits for changes
+        :param timeout: maximum seconds to wait
+        :return: paths of new or changed mp3 files, possibly none
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        changed = []  # type: List[str]
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + name_len].rstrip(b'\0'))
+            pos += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so every file has to be looked at again
+                changed.extend(self._rescan())
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+
+            directory = self._directories.get(wd)
+            if directory is None or name == '':
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        changed.extend(self._watch_tree(path))
+                    except OSError:
+                        pass
+            elif _is_mp3(name):
+                changed.append(path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_watcher(roots: Iterable[str], poll_interval: Optional[float] = None):
+    """
+    Watches directories with inotify where it is available, and by polling elsewhere
+    :param roots: directories to watch, including their subdirectories
+    :param poll_interval: if given, poll at this interval in seconds even if inotify is available
+    :return: an InotifyWatcher or a PollingWatcher
+    """
+    roots = list(roots)
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError):
+            poll_interval = 30.0
+    return PollingWatcher(roots, poll_interval)
+
+
+class Debouncer(object):
+    def __init__(self, settle: float = 10.0):
+        """
+        Holds back files that are still being written. A file is ready once nothing has touched it
+        for the settle time and its size and modification time have stopped changing.
+        :param settle: seconds a file has to stay unchanged
+        """
+        self._settle = settle
+        self._pending = {}  # type: Dict[str, Tuple[float, Optional[Tuple[int, int]]]]
+
+    def __len__(self):
+        return len(self._pending)
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def touch(self, path: str) -> None:
+        """
+        Records a change to a file, restarting its settle time
+        """
+        self._pending[path] = (time.monotonic() + self._settle, self._stat(path))
+
+    def ready(self, limit: Optional[int] = None, exclude: Set[str] = frozenset()) -> List[str]:
+        """
+        Takes files that have settled. Files beyond the limit stay pending, so a busy consumer
+        holds them back without losing any.
+        :param limit: maximum number of files to take
+        :param exclude: files that must not be taken yet, e.g. because they are being processed
+        :return: paths of settled files
+        """
+        now = time.monotonic()
+        ready = []
+        for path, (deadline, key) in list(self._pending.items()):
+            if limit is not None and len(ready) >= limit:
+                break
+            if deadline > now or path in exclude:
+                continue
+            current = self._stat(path)
+            if current is None:
+                del self._pending[path]  # Deleted or moved away before it settled
+            elif current != key:
+                self._pending[path] = (now + self._settle, current)
+            else:
+                del self._pending[path]
+                ready.append(path)
+        return ready